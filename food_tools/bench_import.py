@@ -0,0 +1,87 @@
+# %%
+"""
+Import-time benchmark: how long a fresh interpreter takes to import each
+food_tools module, and which heavy dependencies that drags in.
+
+    python food_tools/bench_import.py [--repeat 5]
+
+Each target is imported in a new subprocess (no warm sys.modules), the
+median of --repeat runs is reported. Exits non-zero when importing
+compute_kcal takes longer than COMPUTE_KCAL_BUDGET_MS or loads any of
+the heavy modules.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HEAVY_MODULES = ["cv2", "numpy", "pandas", "requests", "langchain", "langchain_core",
+                 "langchain_google_genai", "google.genai"]
+
+TARGETS = [
+    "from utils_00 import compute_kcal",
+    "import utils_00",
+    "import data_preprocessing_01",
+    "import food_identification_02",
+    "import nutrition_estimation_03",
+    "import langchain_agent_analysis_04",
+    # reference: what the lazy imports avoid
+    "import cv2",
+    "import langchain_google_genai",
+]
+
+COMPUTE_KCAL_BUDGET_MS = 100
+
+_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+{statement}
+ms = (time.perf_counter() - start) * 1000
+print(json.dumps({{"ms": ms, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(statement, repeat):
+    runs, heavy = [], []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(statement=statement, heavy=HEAVY_MODULES)],
+            cwd=BASE_DIR, capture_output=True, text=True,
+        )
+        if out.returncode != 0:
+            return None, out.stderr.strip().splitlines()[-1:]
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        runs.append(result["ms"])
+        heavy = result["heavy"]
+    return statistics.median(runs), heavy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    ok = True
+    print(f"{'import':42} {'ms':>9}  heavy modules loaded")
+    for statement in TARGETS:
+        ms, heavy = time_import(statement, args.repeat)
+        if ms is None:
+            print(f"{statement:42} {'failed':>9}  {' '.join(heavy)}")
+            continue
+        print(f"{statement:42} {ms:9.1f}  {', '.join(heavy) or '-'}")
+
+        if statement == TARGETS[0] and (ms > COMPUTE_KCAL_BUDGET_MS or heavy):
+            ok = False
+
+    print("compute_kcal import:", "OK" if ok else f"over budget ({COMPUTE_KCAL_BUDGET_MS} ms, no heavy modules)")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
@@ -0,0 +1,339 @@
+# %%
+"""
+End-to-end pipeline benchmark on synthetic data, against the offline fakes.
+
+    python food_tools/bench_pipeline.py --users 200 --days 7 --images 60
+    python food_tools/bench_pipeline.py --save-baseline            # record
+    python food_tools/bench_pipeline.py --compare                  # check for regressions
+
+Generates a wearable-style CSV (users × days, three meal codes per day)
+and synthetic meal photos in a scratch directory, then runs every stage
+there with LLM_BACKEND=fake / USDA_BACKEND=fake and cold caches:
+
+    link        data_preprocessing_01 linking (rows/s, per-chunk latency)
+    preprocess  preprocess_for_gemini, one image at a time (images/s, latency)
+    identify    parallel preprocessing + identify_images (images/s, LLM latency)
+    kcal        compute_kcal per distinct image, cold USDA cache (images/s, latency)
+    nutrition   nutrition_estimation_03.main (rows/s)
+    reports     langchain_agent_analysis_04.main (users/s, LLM latency)
+
+Peak RSS is the process high-water mark after each stage (plus the
+preprocessing workers). --compare exits non-zero when a stage's throughput
+drops, or its p95 grows, by more than --tolerance against the baseline.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(BASE_DIR, "../Data/bench/pipeline_baseline.json")
+
+MEAL_COLUMNS = ["First Meal", "Second Meal", "Third Meal"]
+DEFAULT_TOLERANCE = 0.25
+
+
+# ============================================================
+# Synthetic data
+# ============================================================
+def make_dataset(path, users, days, n_images, seed=0):
+    """Wearable-style rows like the Smart Healthcare CSV; meal codes '001'.. point at the synthetic images."""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    n = users * days
+    ids = np.repeat(np.arange(1, users + 1), days)
+    height = np.repeat(rng.uniform(1.5, 1.95, users).round(2), days)
+    weight = np.repeat(rng.uniform(45, 110, users).round(1), days)
+    steps = rng.integers(1500, 15000, n)
+
+    df = pd.DataFrame({
+        "ID": ids,
+        "Day": np.tile(np.arange(1, days + 1), users),
+        "Gender": np.repeat(rng.choice(["M", "F"], users), days),
+        "Age (years)": np.repeat(rng.integers(18, 70, users), days),
+        "Height (meter)": height,
+        "Weight (kg)": weight,
+        "BMI": (weight / height ** 2).round(1),
+        "Step Count": steps,
+        "Distance Travel (Km)": (steps * 0.00076).round(2),
+        "Blood Pressure": [f"{s}/{d}" for s, d in zip(rng.integers(105, 140, n), rng.integers(65, 90, n))],
+        "Heart Rate (BPM)": rng.integers(58, 100, n),
+        "Blood Oxygen Level": rng.uniform(95, 100, n),
+        "Sleep Duration (minutes)": rng.integers(300, 560, n),
+        "Screen Time (minute)": rng.integers(120, 720, n),
+        "Earphone Time (minute)": rng.integers(0, 240, n),
+    })
+    for col in MEAL_COLUMNS:
+        df[col] = [f"{c:03d}" for c in rng.integers(1, n_images + 1, n)]
+    for col, (lo, hi) in zip(["First Calories", "Second Calories", "Third Calories"],
+                             [(150, 500), (300, 900), (300, 1000)]):
+        df[col] = rng.integers(lo, hi, n)
+
+    df.to_csv(path, index=False)
+    return len(df)
+
+
+def make_images(image_dir, n_images, size=(1024, 768), seed=0):
+    """Plates with random food-coloured blobs, saved as 001.jpg, 002.jpg, ..."""
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    w, h = size
+    for i in range(1, n_images + 1):
+        img = np.full((h, w, 3), rng.integers(150, 230, 3), dtype=np.uint8)
+        cv2.circle(img, (w // 2, h // 2), int(min(w, h) * 0.45), (235, 235, 235), -1)
+        for _ in range(rng.integers(3, 9)):
+            center = (int(rng.integers(w * 0.25, w * 0.75)), int(rng.integers(h * 0.25, h * 0.75)))
+            axes = (int(rng.integers(20, w // 8)), int(rng.integers(20, h // 8)))
+            color = tuple(int(c) for c in rng.integers(20, 230, 3))
+            cv2.ellipse(img, center, axes, float(rng.uniform(0, 180)), 0, 360, color, -1)
+        noise = rng.normal(0, 6, img.shape)
+        img = np.clip(img + noise, 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(image_dir, f"{i:03d}.jpg"), img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return n_images
+
+
+# ============================================================
+# Measurement
+# ============================================================
+def peak_rss_mib():
+    """High-water RSS of this process and of its finished children (ru_maxrss is KiB on Linux)."""
+    scale = 1 if sys.platform != "darwin" else 1 / 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1024
+    return round(max(own, children), 1)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def stage_result(items, unit, seconds, latencies=()):
+    latencies = list(latencies)
+    return {
+        "items": items,
+        "unit": unit,
+        "seconds": round(seconds, 4),
+        "rate": round(items / seconds, 2) if seconds > 0 else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        "peak_rss_mib": peak_rss_mib(),
+    }
+
+
+def llm_latencies():
+    """Request durations recorded by the shared LLM client registry so far."""
+    from llm_clients import LLM_CLIENTS
+    return LLM_CLIENTS.stats.durations()
+
+
+# ============================================================
+# Stages
+# ============================================================
+def bench_link(paths):
+    from data_preprocessing_01 import list_images, read_in_chunks, link_meal_images
+    from storage import TableWriter
+
+    start = time.perf_counter()
+    images = list_images(paths["images"])
+    chunk_times = []
+    with TableWriter(paths["linked"], fmt="csv") as writer:
+        for chunk in read_in_chunks(paths["dataset"], chunk_rows=20000):
+            t = time.perf_counter()
+            writer.write(link_meal_images(chunk, images))
+            chunk_times.append(time.perf_counter() - t)
+    return stage_result(writer.rows, "rows", time.perf_counter() - start, chunk_times)
+
+
+def bench_preprocess(paths, limit):
+    from utils_00 import preprocess_for_gemini
+
+    files = sorted(os.listdir(paths["images"]))[:limit]
+    latencies = []
+    start = time.perf_counter()
+    for name in files:
+        t = time.perf_counter()
+        preprocess_for_gemini(os.path.join(paths["images"], name))
+        latencies.append(time.perf_counter() - t)
+    return stage_result(len(files), "images", time.perf_counter() - start, latencies)
+
+
+def bench_identify(paths):
+    import food_identification_02 as m02
+
+    before = len(llm_latencies())
+    start = time.perf_counter()
+    df = m02.main(paths["linked"], paths["ingredients"], paths["processed"])
+    seconds = time.perf_counter() - start
+    return stage_result(len(df), "images", seconds, llm_latencies()[before:])
+
+
+def bench_kcal(paths):
+    import pandas as pd
+    from utils_00 import compute_kcal
+
+    df = pd.read_csv(paths["ingredients"])
+    lists = [json.loads(raw) for raw in df["ingredients_json"]]
+    latencies = []
+    start = time.perf_counter()
+    for ingredients in lists:
+        t = time.perf_counter()
+        compute_kcal(ingredients)
+        latencies.append(time.perf_counter() - t)
+    return stage_result(len(lists), "images", time.perf_counter() - start, latencies)
+
+
+def bench_nutrition(paths):
+    import nutrition_estimation_03 as m03
+
+    start = time.perf_counter()
+    daily = m03.main(paths["linked"], paths["ingredients"], paths["user_reports"])
+    return stage_result(len(daily), "rows", time.perf_counter() - start)
+
+
+def bench_reports(paths):
+    import langchain_agent_analysis_04 as m04
+
+    before = len(llm_latencies())
+    start = time.perf_counter()
+    m04.main(paths["linked"], paths["weekly"], reports_dir=paths["user_reports"])
+    seconds = time.perf_counter() - start
+    users = len([f for f in os.listdir(paths["weekly"]) if f.endswith("_weekly_report.txt")])
+    return stage_result(users, "users", seconds, llm_latencies()[before:])
+
+
+# ============================================================
+# Baseline comparison
+# ============================================================
+def compare(results, baseline, tolerance):
+    """[(stage, message), ...] for every metric worse than the baseline by more than tolerance."""
+    problems = []
+    for stage, base in baseline.get("stages", {}).items():
+        now = results["stages"].get(stage)
+        if now is None:
+            continue
+        if base.get("rate") and now.get("rate") is not None and now["rate"] < base["rate"] * (1 - tolerance):
+            problems.append((stage, f"{now['rate']} {now['unit']}/s < baseline {base['rate']}"))
+        if base.get("p95_ms") and now.get("p95_ms") is not None and now["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append((stage, f"p95 {now['p95_ms']} ms > baseline {base['p95_ms']} ms"))
+    return problems
+
+
+def print_table(results):
+    print(f"\n{'stage':11} {'items':>8} {'unit':>7} {'s':>8} {'rate/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'RSS MiB':>8}")
+    for stage, r in results["stages"].items():
+        fmt = lambda v: "-" if v is None else v
+        print(f"{stage:11} {r['items']:8} {r['unit']:>7} {r['seconds']:8.2f} {fmt(r['rate']):>10} "
+              f"{fmt(r['p50_ms']):>9} {fmt(r['p95_ms']):>9} {r['peak_rss_mib']:8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--images", type=int, default=40, help="distinct synthetic meal photos")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[1024, 768], metavar=("W", "H"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--usda-latency-ms", type=float, default=20)
+    parser.add_argument("--workdir", help="scratch directory (default: a new temp dir, removed afterwards)")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE_PATH, metavar="PATH")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH, metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--output", metavar="PATH", help="also write this run's results here")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="food_tools_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    paths = {
+        "dataset": os.path.join(workdir, "dataset.csv"),
+        "images": os.path.join(workdir, "raw_images"),
+        "processed": os.path.join(workdir, "processed_images"),
+        "linked": os.path.join(workdir, "linked_dataset.csv"),
+        "ingredients": os.path.join(workdir, "image_ingredients.csv"),
+        "user_reports": os.path.join(workdir, "user_reports"),
+        "weekly": os.path.join(workdir, "weekly_ai_reports"),
+    }
+    cache = os.path.join(workdir, "cache")
+
+    # before any stage module is imported: their config is read at import time
+    os.environ.update({
+        "LLM_BACKEND": "fake",
+        "USDA_BACKEND": "fake",
+        "STORAGE_FORMAT": "csv",
+        "FAKE_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "FAKE_USDA_LATENCY_MS": str(args.usda_latency_ms),
+        "FAKE_SEED": str(args.seed),
+        "FAKE_USDA_CACHE_PATH": os.path.join(cache, "usda_fake.sqlite"),
+        "VISION_CACHE_PATH": os.path.join(cache, "vision.sqlite"),
+        "PIPELINE_STATE_PATH": os.path.join(cache, "pipeline_state.sqlite"),
+        "REVIEW_QUEUE_PATH": os.path.join(cache, "review_queue.sqlite"),
+    })
+    # the fake is not rate limited; set GEMINI_RPM / GEMINI_TPM to benchmark a real tier's limits
+    sys.path.insert(0, BASE_DIR)
+
+    try:
+        print(f"Workdir: {workdir}")
+        t = time.perf_counter()
+        rows = make_dataset(paths["dataset"], args.users, args.days, args.images, args.seed)
+        make_images(paths["images"], args.images, tuple(args.image_size), args.seed)
+        print(f"Synthetic data: {rows} rows, {args.images} images in {time.perf_counter() - t:.1f}s")
+
+        results = {
+            "config": {k: getattr(args, k) for k in ("users", "days", "images", "image_size", "seed",
+                                                     "llm_latency_ms", "usda_latency_ms")},
+            "stages": {},
+        }
+        stages = [
+            ("link", lambda: bench_link(paths)),
+            ("preprocess", lambda: bench_preprocess(paths, args.images)),
+            ("identify", lambda: bench_identify(paths)),
+            ("kcal", lambda: bench_kcal(paths)),
+            ("nutrition", lambda: bench_nutrition(paths)),
+            ("reports", lambda: bench_reports(paths)),
+        ]
+        for name, run in stages:
+            print(f"\n######## bench: {name} ########")
+            results["stages"][name] = run()
+
+        from llm_clients import llm_stats
+        print("\nLLM clients:", llm_stats())
+        print_table(results)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for path in filter(None, [args.save_baseline, args.output]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved:", path)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("[WARN] baseline was recorded with a different config:", baseline.get("config"))
+        problems = compare(results, baseline, args.tolerance)
+        for stage, message in problems:
+            print(f"REGRESSION {stage}: {message}")
+        print("Baseline comparison:", "OK" if not problems else f"{len(problems)} regression(s)")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
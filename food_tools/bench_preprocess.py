@@ -0,0 +1,114 @@
+# %%
+"""
+Micro-benchmark: legacy preprocess_for_gemini vs the LUT / fused version.
+
+    python food_tools/bench_preprocess.py [--repeat 5] [image_dir]
+
+Reports ms per image, peak traced memory per call, and how far the new
+output is from the legacy one. Expected: identical pixels; the only allowed
+difference is where the legacy uint8 cast wrapped a/b around (now clamped),
+so the check is |diff| <= PIXEL_TOLERANCE on at least 99.9 % of pixels and
+mean |diff| < 0.5.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from utils_00 import enhance_for_gemini, PREPROCESS_SIZE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_DIR = os.path.join(BASE_DIR, "../Images/raw_images")
+
+PIXEL_TOLERANCE = 1
+
+
+# ------------------------------
+# Legacy pipeline (reference output)
+# ------------------------------
+def enhance_reference(img):
+    img = cv2.resize(img, PREPROCESS_SIZE)
+
+    result = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    avg_a = np.average(result[:, :, 1])
+    avg_b = np.average(result[:, :, 2])
+    result[:, :, 1] = result[:, :, 1] - ((avg_a - 128) * (result[:, :, 0] / 255.0) * 1.1)
+    result[:, :, 2] = result[:, :, 2] - ((avg_b - 128) * (result[:, :, 0] / 255.0) * 1.1)
+    img = cv2.cvtColor(result, cv2.COLOR_LAB2BGR)
+
+    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+    ycrcb[:, :, 0] = cv2.equalizeHist(ycrcb[:, :, 0])
+    img = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+
+    img = np.power(img / 255.0, 1.1)
+    img = (img * 255).astype("uint8")
+    return img
+
+
+def measure(fn, images, repeat):
+    # warm-up (OpenCV lazily initialises its dispatch tables)
+    fn(images[0])
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in images:
+            fn(img)
+    ms = (time.perf_counter() - start) * 1000 / (repeat * len(images))
+
+    peaks = []
+    for img in images:
+        tracemalloc.start()
+        fn(img)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return ms, max(peaks) / 2**20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("image_dir", nargs="?", default=RAW_DIR)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(os.path.join(args.image_dir, "*.jpg")))
+    images = [img for img in (cv2.imread(p) for p in paths) if img is not None]
+    if not images:
+        print("No images found in", args.image_dir)
+        return 1
+
+    # OpenCV's own thread pool would blur the per-image comparison
+    cv2.setNumThreads(1)
+
+    old_ms, old_mb = measure(enhance_reference, images, args.repeat)
+    new_ms, new_mb = measure(enhance_for_gemini, images, args.repeat)
+
+    diffs = [
+        np.abs(enhance_reference(img).astype(np.int16) - enhance_for_gemini(img).astype(np.int16))
+        for img in images
+    ]
+    all_diff = np.concatenate([d.ravel() for d in diffs])
+    within = float(np.mean(all_diff <= PIXEL_TOLERANCE)) * 100
+
+    print(f"images: {len(images)}  repeat: {args.repeat}")
+    print(f"{'':10} {'ms/image':>10} {'peak MiB':>10}")
+    print(f"{'legacy':10} {old_ms:10.2f} {old_mb:10.2f}")
+    print(f"{'optimized':10} {new_ms:10.2f} {new_mb:10.2f}")
+    print(f"speed-up: {old_ms / new_ms:.2f}x   memory: {old_mb / max(new_mb, 1e-9):.1f}x less")
+    print(f"|diff| mean {all_diff.mean():.3f}  max {all_diff.max()}  "
+          f"within ±{PIXEL_TOLERANCE}: {within:.3f}% of pixels")
+
+    ok = all_diff.mean() < 0.5 and within >= 99.9
+    print("tolerance:", "OK" if ok else "EXCEEDED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
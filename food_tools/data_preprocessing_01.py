@@ -2,6 +2,9 @@
 import pandas as pd
 import os
 
+from pipeline_state import run_output_path
+from storage import TableWriter
+
 # --------------------------
 # Config (modify paths only if needed)
 # --------------------------
@@ -9,11 +12,12 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATASET_PATH = os.path.join(BASE_DIR, "../Data/Smart Healthcare - Daily Lifestyle Dataset (Wearable device).csv")
 IMAGE_DIR = os.path.join(BASE_DIR, "../Images/raw_images")
 
-OUTPUT_PATH = os.path.join(BASE_DIR, "../Data/linked_dataset.csv")
+OUTPUT_PATH = run_output_path(os.path.join(BASE_DIR, "../Data/linked_dataset.csv"))
+
+MEAL_COLUMNS = ["First Meal", "Second Meal", "Third Meal"]
 
-print("Loading dataset...")
-df = pd.read_csv(DATASET_PATH)
-print("Dataset loaded:", df.shape)
+# rows per chunk: the wearable CSV is streamed, never loaded whole
+LINK_CHUNK_ROWS = int(os.getenv("LINK_CHUNK_ROWS", "200000"))
 
 
 # ============================================================
@@ -50,32 +54,88 @@ def code_to_image_path(code):
 
 
 # ============================================================
-# Apply mapping to the 3 image columns
+# Vectorized linking: list the folder once, normalize each distinct
+# code once, then one lookup for all three meal columns
 # ============================================================
-MEAL_COLUMNS = ["First Meal", "Second Meal", "Third Meal"]
+def list_images(image_dir=IMAGE_DIR):
+    """file name → full path for every file in image_dir (one directory scan)."""
+    if not os.path.isdir(image_dir):
+        return {}
+    with os.scandir(image_dir) as it:
+        return {e.name: os.path.join(image_dir, e.name) for e in it if e.is_file()}
 
-for col in MEAL_COLUMNS:
-    new_col = col + " Path"
-    df[new_col] = df[col].apply(code_to_image_path)
 
+def codes_to_file_names(codes):
+    """
+    Same rules as code_to_image_path, on a whole Series at once:
+    '3.jpg' → as is, 1 / 1.0 / '12' → '001.jpg' / '012.jpg', other → code + '.jpg'.
+    """
+    text = codes.astype(str).str.strip()
+    is_jpg = text.str.lower().str.endswith(".jpg")
+    is_number = text.str.replace(".", "", regex=False).str.isdigit() & ~is_jpg
 
-# ============================================================
-# Report missing images
-# ============================================================
-missing = df[[c+" Path" for c in MEAL_COLUMNS]].isna().sum()
-print("\nMissing image counts:")
-print(missing)
+    numbers = pd.to_numeric(text.where(is_number), errors="coerce")
+    padded = numbers.dropna().astype("int64").astype(str).str.zfill(3) + ".jpg"
 
+    names = text + ".jpg"
+    names[is_jpg] = text[is_jpg]
+    names[padded.index] = padded
+    return names
 
-# ============================================================
-# Save final linked dataset
-# ============================================================
-df.to_csv(OUTPUT_PATH, index=False)
-print("\nSaved linked dataset: ", OUTPUT_PATH)
 
-df.head()
+def link_meal_images(df, images=None):
+    """Add '<meal> Path' columns (None where the image is missing)."""
+    images = list_images() if images is None else images
 
+    # distinct codes across all three columns: a few hundred, not millions of cells
+    long = df[MEAL_COLUMNS].stack().dropna()
+    codes = pd.Series(pd.unique(long))
+    names = codes_to_file_names(codes)
+    code_to_path = dict(zip(codes, names.map(images)))
 
-# %%
+    paths = long.map(code_to_path).unstack()
+    for col in MEAL_COLUMNS:
+        column = paths[col] if col in paths else pd.Series(index=df.index, dtype=object)
+        df[col + " Path"] = column.reindex(df.index).astype(object).where(lambda s: s.notna(), None)
+    return df
+
+
+def read_in_chunks(dataset_path, chunk_rows=LINK_CHUNK_ROWS):
+    """
+    Stream the wearable CSV. Meal codes are read as text (a chunk of
+    numeric codes and one of '4.jpg' codes parse alike) and ID / Day as
+    nullable Int64; every other column is inferred per chunk.
+    """
+    dtypes = {"ID": "Int64", "Day": "Int64", **{col: str for col in MEAL_COLUMNS}}
+    header = pd.read_csv(dataset_path, nrows=0).columns
+    return pd.read_csv(dataset_path, dtype={c: t for c, t in dtypes.items() if c in header},
+                       chunksize=chunk_rows)
+
+
+def main(dataset_path=DATASET_PATH, output_path=OUTPUT_PATH, chunk_rows=LINK_CHUNK_ROWS):
+    print("Loading dataset...")
+    images = list_images()
+    print("Images available:", len(images))
+
+    missing = pd.Series(0, index=[c+" Path" for c in MEAL_COLUMNS])
+
+    # CSV, or Parquet when STORAGE_FORMAT=parquet; written chunk by chunk
+    with TableWriter(output_path) as writer:
+        for chunk in read_in_chunks(dataset_path, chunk_rows):
+            chunk = link_meal_images(chunk, images)
+            missing += chunk[missing.index].isna().sum()
+            writer.write(chunk)
+    print("Dataset linked:", writer.rows, "rows")
+
+    # ============================================================
+    # Report missing images
+    # ============================================================
+    print("\nMissing image counts:")
+    print(missing)
+
+    print("\nSaved linked dataset: ", writer.path)
+    return writer.path
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+# %%
+"""
+Offline stand-ins for Gemini and USDA FoodData Central, for load tests and
+concurrency tuning without API keys.
+
+    LLM_BACKEND=fake USDA_BACKEND=fake python food_tools/run_pipeline.py --force
+    python food_tools/fake_backends.py usda --port 8765     # standalone server
+    USDA_BASE_URL=http://127.0.0.1:8765 USDA_API_KEY=x python ...
+
+- FakeGeminiChat: in-process LangChain chat model. Vision prompts get the
+  image's own ingredient list from Data/image_ingredients.csv (looked up by
+  the file name passed in the request's image_ids metadata), batch prompts
+  a JSON object per image id, report prompts a Markdown report with the
+  five required sections.
+- FakeUSDAServer: local HTTP server speaking the /foods/search and /foods
+  endpoints used by USDAClient, with kcal per 100 g derived from the
+  Detail columns of Data/user_reports.
+
+Latency, error and 429 rates come from FAKE_* env vars. Outcomes are
+derived from a hash of (seed, request, attempt), so a run is reproducible
+regardless of thread timing, and a retried request can succeed.
+
+Runs on either fake write their outputs and state under Data/fake_run/
+(FAKE_RUN_DIR in pipeline_state.py), not over the real files read above.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import threading
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from pipeline_state import CACHE_DIR
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_ING = os.path.join(BASE_DIR, "../Data/image_ingredients.csv")
+USER_REPORT_DIR = os.path.join(BASE_DIR, "../Data/user_reports")
+USER_REPORTS_TABLE = os.path.join(BASE_DIR, "../Data/user_reports.parquet")
+
+# fake answers are kept out of the real caches
+FAKE_USDA_CACHE_PATH = os.getenv("FAKE_USDA_CACHE_PATH", os.path.join(CACHE_DIR, "usda_nutrients_fake.sqlite"))
+FAKE_VISION_MODEL = "fake-gemini"
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+FAKE_SEED = os.getenv("FAKE_SEED", "0")
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "800"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_429_RATE = float(os.getenv("FAKE_LLM_429_RATE", "0"))
+FAKE_LLM_GARBAGE_RATE = float(os.getenv("FAKE_LLM_GARBAGE_RATE", "0"))   # unparseable answers
+FAKE_USDA_LATENCY_MS = float(os.getenv("FAKE_USDA_LATENCY_MS", "50"))
+FAKE_USDA_ERROR_RATE = float(os.getenv("FAKE_USDA_ERROR_RATE", "0"))
+FAKE_USDA_429_RATE = float(os.getenv("FAKE_USDA_429_RATE", "0"))
+FAKE_USDA_NO_MATCH_RATE = float(os.getenv("FAKE_USDA_NO_MATCH_RATE", "0.05"))   # unknown names only
+FAKE_JITTER = 0.25          # ± fraction of the latency
+FAKE_RETRY_AFTER = 1.0      # seconds, sent with every 429
+
+
+def _unit(*parts) -> float:
+    """Deterministic uniform [0, 1) from the given parts."""
+    digest = hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+# ============================================================
+# Behaviour: latency, errors, 429s
+# ============================================================
+@dataclass
+class FakeBehaviour:
+    latency_ms: float = 0.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    garbage_rate: float = 0.0
+    retry_after: float = FAKE_RETRY_AFTER
+    jitter: float = FAKE_JITTER
+    seed: str = FAKE_SEED
+
+    def __post_init__(self):
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "garbage": 0}
+
+    def decide(self, key):
+        """
+        (delay seconds, "ok" | "error" | "429" | "garbage") for one request. The n-th
+        attempt of the same request always gets the same outcome.
+        """
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+            self.stats["requests"] += 1
+
+        spread = 1 + self.jitter * (2 * _unit(self.seed, key, attempt, "latency") - 1)
+        delay = max(0.0, self.latency_ms * spread / 1000)
+
+        roll = _unit(self.seed, key, attempt, "outcome")
+        if roll < self.rate_limit_rate:
+            outcome = "429"
+        elif roll < self.rate_limit_rate + self.error_rate:
+            outcome = "error"
+        elif roll < self.rate_limit_rate + self.error_rate + self.garbage_rate:
+            outcome = "garbage"
+        else:
+            outcome = "ok"
+
+        with self._lock:
+            self.stats[{"ok": "ok", "error": "errors", "429": "rate_limited", "garbage": "garbage"}[outcome]] += 1
+        return delay, outcome
+
+
+def llm_behaviour():
+    return FakeBehaviour(FAKE_LLM_LATENCY_MS, FAKE_LLM_ERROR_RATE, FAKE_LLM_429_RATE, FAKE_LLM_GARBAGE_RATE)
+
+
+def usda_behaviour():
+    return FakeBehaviour(FAKE_USDA_LATENCY_MS, FAKE_USDA_ERROR_RATE, FAKE_USDA_429_RATE)
+
+
+# ============================================================
+# Canned responses
+# ============================================================
+class CannedData:
+    """Vision answers and kcal/100 g values taken from the pipeline's own outputs."""
+
+    def __init__(self, ingredients_path=DATA_ING, reports_dir=USER_REPORT_DIR, reports_table=USER_REPORTS_TABLE):
+        self.vision_answers = []        # ingredient lists, in file order
+        self.answers_by_image = {}      # image file name → its ingredient list
+        self.kcal_per_100g = {}         # normalized name → kcal per 100 g
+        self._load_ingredients(ingredients_path)
+        self._load_reports(reports_dir, reports_table)
+
+    def _load_ingredients(self, path):
+        if not os.path.exists(path):
+            return
+        import pandas as pd
+        df = pd.read_csv(path)
+        names = df["raw_image_path"].map(lambda p: os.path.basename(str(p))) if "raw_image_path" in df else None
+        for row, raw in enumerate(df.get("ingredients_json", [])):
+            try:
+                items = json.loads(raw)
+            except Exception:
+                continue
+            if isinstance(items, list) and items and all(isinstance(i, dict) and i.get("ingredient") for i in items):
+                self.vision_answers.append(items)
+                if names is not None:
+                    self.answers_by_image.setdefault(names.iloc[row], items)
+
+    def _load_reports(self, reports_dir, reports_table):
+        import pandas as pd
+        frames = [pd.read_csv(p) for p in sorted(glob.glob(os.path.join(reports_dir, "*.csv")))]
+        if os.path.exists(reports_table):
+            from storage import read_table
+            frames.append(read_table(reports_table, nested="json"))
+
+        for df in frames:
+            for col in [c for c in df.columns if str(c).endswith("_Detail")]:
+                for raw in df[col]:
+                    try:
+                        items = json.loads(raw)
+                    except Exception:
+                        continue
+                    for item in items if isinstance(items, list) else []:
+                        grams, kcal = item.get("grams") or 0, item.get("kcal")
+                        name = item.get("normalized")
+                        if name and kcal is not None and grams > 0:
+                            self.kcal_per_100g.setdefault(name, round(100.0 * kcal / grams, 2))
+
+    # ---- answers ----
+    def ingredients_for(self, image_id):
+        """
+        The recorded ingredient list of an image (matched by file name). Images
+        without one get a canned list picked by their id.
+        """
+        name = os.path.basename(str(image_id))
+        if name in self.answers_by_image:
+            return self.answers_by_image[name]
+        if not self.vision_answers:
+            return [{"ingredient": "rice", "grams": 150}, {"ingredient": "chicken", "grams": 100}]
+        return self.vision_answers[zlib.crc32(name.encode("utf-8")) % len(self.vision_answers)]
+
+    def kcal_for(self, name):
+        """kcal per 100 g for a name; None (no match) for a share of unknown names."""
+        name = name.strip().lower()
+        if name in self.kcal_per_100g:
+            return self.kcal_per_100g[name]
+        if _unit(FAKE_SEED, name, "no-match") < FAKE_USDA_NO_MATCH_RATE:
+            return None
+        return float(30 + zlib.crc32(name.encode("utf-8")) % 470)
+
+
+_canned = None
+_singleton_lock = threading.RLock()   # canned data, shared behaviour and server
+
+
+def canned_data():
+    global _canned
+    with _singleton_lock:
+        if _canned is None:
+            _canned = CannedData()
+        return _canned
+
+
+# ============================================================
+# Fake Gemini chat model
+# ============================================================
+class FakeRateLimitError(Exception):
+    """Looks like a Gemini 429 to rate_limiter.is_rate_limited / retry_after_seconds."""
+    status_code = 429
+
+
+REPORT_SECTIONS = [
+    "#### 1. Weekly Calorie Overview",
+    "#### 2. Eating Pattern Insights",
+    "#### 3. Ingredient-Based Evaluation",
+    "#### 4. Lifestyle Interaction Analysis",
+    "#### 5. Personalized Weekly Recommendations",
+]
+
+
+def _split_content(messages):
+    """All text parts and image payloads of a chat request."""
+    texts, images = [], []
+    for m in messages:
+        content = m.content if hasattr(m, "content") else m
+        parts = content if isinstance(content, list) else [content]
+        for part in parts:
+            if isinstance(part, str):
+                texts.append(part)
+            elif part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                url = part.get("image_url")
+                images.append(url.get("url") if isinstance(url, dict) else url)
+    return texts, images
+
+
+def fake_answer(messages, canned=None, image_ids=None):
+    """
+    What the fake model says to a request (vision, batch vision or report).
+    image_ids: file names of the request's images, in order; without them
+    images are told apart by a hash of their bytes.
+    """
+    canned = canned or canned_data()
+    texts, images = _split_content(messages)
+    ids = list(image_ids or []) or [hashlib.sha1(img.encode()).hexdigest() for img in images]
+
+    if len(images) > 1 or (images and any(t.startswith("Image id:") for t in texts)):
+        slots = [t.split(":", 1)[1].strip() for t in texts if t.startswith("Image id:")]
+        return json.dumps({slot: canned.ingredients_for(image_id) for slot, image_id in zip(slots, ids)})
+    if images:
+        return json.dumps(canned.ingredients_for(ids[0]))
+
+    prompt = "\n".join(texts)
+    digest = hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8]
+    body = [f"{section}\n- Generated offline by the fake backend (prompt {digest}, {len(prompt)} chars)."
+            for section in REPORT_SECTIONS]
+    return "\n\n".join(body)
+
+
+def _request_key(messages):
+    texts, images = _split_content(messages)
+    return hashlib.sha1(json.dumps([texts, images]).encode("utf-8")).hexdigest()
+
+
+_fake_chat_class = None
+
+
+def fake_chat_model(model=FAKE_VISION_MODEL, temperature=0.0, callbacks=None, behaviour=None):
+    """
+    FakeGeminiChat instance (a real LangChain BaseChatModel, so callbacks
+    such as the rate limiter's run as usual).
+    """
+    global _fake_chat_class
+    if _fake_chat_class is None:
+        from typing import Any
+        from langchain_core.language_models import BaseChatModel
+        from langchain_core.messages import AIMessage
+        from langchain_core.outputs import ChatGeneration, ChatResult
+
+        class FakeGeminiChat(BaseChatModel):
+            model: str = FAKE_VISION_MODEL
+            temperature: float = 0.0
+            behaviour: Any = None
+
+            @property
+            def _llm_type(self):
+                return "fake-gemini"
+
+            def bind_tools(self, tools, **kwargs):
+                # never calls tools: an agent gets its final answer in one step
+                return self
+
+            def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+                delay, outcome = self.behaviour.decide(_request_key(messages))
+                time.sleep(delay)
+                if outcome == "429":
+                    raise FakeRateLimitError(
+                        f"429 RESOURCE_EXHAUSTED (fake): retry in {self.behaviour.retry_after}s")
+                if outcome == "error":
+                    raise RuntimeError("500 INTERNAL (fake backend error)")
+                if outcome == "ok":
+                    image_ids = (run_manager.metadata or {}).get("image_ids") if run_manager else None
+                    text = fake_answer(messages, image_ids=image_ids)
+                else:
+                    text = "Sorry, I can't identify this meal."
+                message = AIMessage(content=text)
+                return ChatResult(generations=[ChatGeneration(message=message)])
+
+        _fake_chat_class = FakeGeminiChat
+
+    return _fake_chat_class(model=model, temperature=temperature, callbacks=callbacks,
+                            behaviour=behaviour or shared_llm_behaviour())
+
+
+_llm_behaviour = None
+
+
+def shared_llm_behaviour():
+    """One behaviour (attempt counters + stats) for every fake chat model in the process."""
+    global _llm_behaviour
+    with _singleton_lock:
+        if _llm_behaviour is None:
+            _llm_behaviour = llm_behaviour()
+        return _llm_behaviour
+
+
+# ============================================================
+# Fake USDA FoodData Central server
+# ============================================================
+def _fdc_id(name):
+    return 100000 + zlib.crc32(name.encode("utf-8")) % 900000
+
+
+def _search_hit(name, kcal):
+    return {
+        "fdcId": _fdc_id(name),
+        "description": name,
+        "foodNutrients": [
+            {"nutrientNumber": "208", "nutrientName": "Energy", "unitName": "KCAL", "value": kcal},
+            {"nutrientNumber": "203", "nutrientName": "Protein", "unitName": "G", "value": round(kcal * 0.05, 2)},
+            {"nutrientNumber": "204", "nutrientName": "Total lipid (fat)", "unitName": "G",
+             "value": round(kcal * 0.03, 2)},
+            {"nutrientNumber": "205", "nutrientName": "Carbohydrate, by difference", "unitName": "G",
+             "value": round(kcal * 0.12, 2)},
+        ],
+    }
+
+
+class FakeUSDAServer:
+    """
+    Local FoodData Central look-alike on a background thread.
+    GET /foods/search?query=..  and  POST /foods {"fdcIds": [...]}
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, behaviour=None, canned=None):
+        self.behaviour = behaviour or usda_behaviour()
+        self.canned = canned or canned_data()
+        self._names = {}    # fdcId → name, filled by searches
+        self._names_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self):
+        return dict(self.behaviour.stats)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, headers=None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _gate(self, key):
+                delay, outcome = server.behaviour.decide(key)
+                time.sleep(delay)
+                if outcome == "429":
+                    self._send(429, {"error": "rate limited"}, {"Retry-After": str(server.behaviour.retry_after)})
+                    return False
+                if outcome == "error":
+                    self._send(503, {"error": "fake backend error"})
+                    return False
+                return True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if not url.path.rstrip("/").endswith("/foods/search"):
+                    return self._send(404, {"error": "not found"})
+                query = (parse_qs(url.query).get("query") or [""])[0]
+                if not self._gate(("search", query)):
+                    return
+                kcal = server.canned.kcal_for(query)
+                if kcal is None:
+                    return self._send(200, {"totalHits": 0, "foods": []})
+                with server._names_lock:
+                    server._names[_fdc_id(query.strip().lower())] = query.strip().lower()
+                self._send(200, {"totalHits": 1, "foods": [_search_hit(query.strip().lower(), kcal)]})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not url.path.rstrip("/").endswith("/foods"):
+                    return self._send(404, {"error": "not found"})
+                ids = [int(i) for i in body.get("fdcIds", [])]
+                if not self._gate(("foods", tuple(ids))):
+                    return
+                foods = []
+                for fdc_id in ids:
+                    with server._names_lock:
+                        name = server._names.get(fdc_id)
+                    kcal = server.canned.kcal_for(name) if name else None
+                    if kcal is not None:
+                        foods.append(_search_hit(name, kcal))
+                self._send(200, foods)
+
+        return Handler
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, name="fake-usda", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+_usda_server = None
+
+
+def shared_usda_server():
+    """In-process fake USDA server, started on first use (USDA_BACKEND=fake)."""
+    global _usda_server
+    with _singleton_lock:
+        if _usda_server is None:
+            _usda_server = FakeUSDAServer().start()
+        return _usda_server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline Gemini / USDA stand-ins")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_usda = sub.add_parser("usda", help="serve the fake USDA API until interrupted")
+    p_usda.add_argument("--host", default="127.0.0.1")
+    p_usda.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    server = FakeUSDAServer(args.host, args.port)
+    print(f"Fake USDA API on {server.url} ({len(server.canned.kcal_per_100g)} canned foods)")
+    print(f"    USDA_BASE_URL={server.url} USDA_API_KEY=fake")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        print("Stats:", server.stats)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
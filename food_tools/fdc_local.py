@@ -0,0 +1,270 @@
+# %%
+import os
+import re
+import csv
+import sys
+import json
+import sqlite3
+import argparse
+import threading
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+FDC_LOCAL_DB = os.getenv("FDC_LOCAL_DB", os.path.join(BASE_DIR, "../Data/fdc/fdc_local.sqlite"))
+
+# FDC nutrient *ids* (food_nutrient.csv / full JSON) → vector slot
+# kcal falls back to the Atwater energy values Foundation foods use.
+NUTRIENT_IDS = {
+    1008: "kcal_per_100g",
+    2047: "kcal_per_100g",
+    2048: "kcal_per_100g",
+    1003: "protein_g",
+    1004: "fat_g",
+    1005: "carbs_g",
+}
+# lower = preferred when two ids fill the same slot
+NUTRIENT_PRIORITY = {1008: 0, 2047: 1, 2048: 2}
+
+VECTOR_FIELDS = ("kcal_per_100g", "protein_g", "fat_g", "carbs_g")
+
+# generic reference foods match ingredient names better than branded products
+DATA_TYPE_BONUS = {
+    "sr_legacy_food": 0.10,
+    "foundation_food": 0.10,
+    "survey_fndds_food": 0.05,
+    "branded_food": 0.0,
+}
+
+FTS_CANDIDATES = 50
+MIN_MATCH_SCORE = 0.45
+
+
+def _norm(text):
+    return " ".join(re.findall(r"[a-z0-9]+", str(text).lower()))
+
+
+def _singular(token):
+    """Crude singular for token overlap (carrots → carrot, berries → berry, tomatoes → tomato)."""
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 4 and token.endswith("oes"):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+# ============================================================
+# Import: FDC CSV / JSON dump → SQLite (+ FTS5 index)
+# ============================================================
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS foods (
+    fdc_id        INTEGER PRIMARY KEY,
+    description   TEXT NOT NULL,
+    data_type     TEXT,
+    kcal_per_100g REAL,
+    protein_g     REAL,
+    fat_g         REAL,
+    carbs_g       REAL
+);
+-- porter stemming: "carrot" finds "Carrots, raw" and the other way round
+CREATE VIRTUAL TABLE IF NOT EXISTS foods_fts USING fts5(
+    description, content='foods', content_rowid='fdc_id', tokenize='porter unicode61'
+);
+"""
+
+
+def _read_csv_dump(dump_dir):
+    """
+    food.csv + food_nutrient.csv (the "Full Download" layout).
+    food_nutrient.csv is streamed; only the nutrients we keep are held in memory.
+    """
+    vectors = {}
+    with open(os.path.join(dump_dir, "food_nutrient.csv"), newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            try:
+                nutrient_id = int(row["nutrient_id"])
+            except (KeyError, ValueError):
+                continue
+            if nutrient_id not in NUTRIENT_IDS or not row.get("amount"):
+                continue
+            _set_nutrient(vectors.setdefault(int(row["fdc_id"]), {}), nutrient_id, float(row["amount"]))
+
+    with open(os.path.join(dump_dir, "food.csv"), newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            fdc_id = int(row["fdc_id"])
+            yield fdc_id, row["description"], row.get("data_type"), vectors.pop(fdc_id, {})
+
+
+def _read_json_dump(path):
+    """FoodData_Central_*.json: {"<Kind>Foods": [food, ...]} with full nutrient objects."""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    foods = data if isinstance(data, list) else next(
+        (v for v in data.values() if isinstance(v, list)), []
+    )
+    for food in foods:
+        vector = {}
+        for n in food.get("foodNutrients", []):
+            nutrient_id = (n.get("nutrient") or {}).get("id")
+            amount = n.get("amount")
+            if nutrient_id in NUTRIENT_IDS and amount is not None:
+                _set_nutrient(vector, nutrient_id, float(amount))
+        data_type = _norm(food.get("dataType", "")).replace(" ", "_") + "_food"
+        yield int(food["fdcId"]), food.get("description", ""), data_type, vector
+
+
+def _set_nutrient(vector, nutrient_id, amount):
+    field = NUTRIENT_IDS[nutrient_id]
+    priority = NUTRIENT_PRIORITY.get(nutrient_id, 0)
+    current = vector.get(field)
+    if current is None or priority < current[1]:
+        vector[field] = (amount, priority)
+
+
+def import_fdc_dump(source, db_path=FDC_LOCAL_DB, batch_size=10000):
+    """
+    Load a downloaded FDC dump (CSV directory or JSON file) into db_path.
+    Re-importing replaces rows with the same fdc_id and rebuilds the
+    full-text index (with the current tokenizer).
+    """
+    rows = _read_csv_dump(source) if os.path.isdir(source) else _read_json_dump(source)
+
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("DROP TABLE IF EXISTS foods_fts")   # rebuilt below
+    conn.executescript(SCHEMA)
+
+    count = 0
+    batch = []
+    for fdc_id, description, data_type, vector in rows:
+        batch.append((fdc_id, description, (data_type or "").lower(),
+                       *(vector[f][0] if f in vector else None for f in VECTOR_FIELDS)))
+        if len(batch) >= batch_size:
+            conn.executemany("INSERT OR REPLACE INTO foods VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.executemany("INSERT OR REPLACE INTO foods VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        count += len(batch)
+
+    conn.execute("INSERT INTO foods_fts(foods_fts) VALUES ('rebuild')")
+    conn.commit()
+    conn.close()
+    return count
+
+
+# ============================================================
+# Lookup backend (usda_search-compatible)
+# ============================================================
+class LocalFDCIndex:
+    """
+    Fuzzy name lookup against the imported FDC store.
+    FTS5 narrows to FTS_CANDIDATES rows, then each is rescored on
+    string similarity + token overlap + data-type preference.
+    in_memory=True copies the store into RAM once at open.
+    """
+
+    def __init__(self, path=FDC_LOCAL_DB, in_memory=True, min_score=MIN_MATCH_SCORE):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No local FDC index at {path}; run: python fdc_local.py import <dump>")
+
+        disk = sqlite3.connect(path, check_same_thread=False)
+        if in_memory:
+            self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+            disk.backup(self._conn)
+            disk.close()
+        else:
+            self._conn = disk
+
+        self.min_score = min_score
+        self._lock = threading.Lock()
+        self.search = lru_cache(maxsize=65536)(self._search)
+
+    def _candidates(self, tokens):
+        # all tokens first, any token if that finds nothing
+        for op in (" AND ", " OR "):
+            match = op.join(f'"{t}"' for t in tokens)
+            with self._lock:
+                rows = self._conn.execute(
+                    """
+                    SELECT f.fdc_id, f.description, f.data_type,
+                           f.kcal_per_100g, f.protein_g, f.fat_g, f.carbs_g
+                    FROM foods_fts JOIN foods f ON f.fdc_id = foods_fts.rowid
+                    WHERE foods_fts MATCH ? AND f.kcal_per_100g IS NOT NULL
+                    ORDER BY bm25(foods_fts) LIMIT ?
+                    """,
+                    (match, FTS_CANDIDATES),
+                ).fetchall()
+            if rows:
+                return rows
+        return []
+
+    def _score(self, query, tokens, description, data_type):
+        desc = _norm(description)
+        desc_tokens = {_singular(t) for t in desc.split()}
+        overlap = len({_singular(t) for t in tokens} & desc_tokens) / len(tokens)
+        ratio = SequenceMatcher(None, query, desc).ratio()
+        return 0.5 * ratio + 0.4 * overlap + DATA_TYPE_BONUS.get(data_type, 0.0)
+
+    def _search(self, query):
+        q = _norm(query)
+        tokens = set(q.split())
+        if not tokens:
+            return None
+
+        best, best_score = None, 0.0
+        for fdc_id, description, data_type, *vector in self._candidates(sorted(tokens)):
+            score = self._score(q, tokens, description, data_type)
+            if score > best_score:
+                best, best_score = (fdc_id, description, vector), score
+
+        if best is None or best_score < self.min_score:
+            return None
+
+        fdc_id, description, vector = best
+        record = dict(zip(VECTOR_FIELDS, vector))
+        record["fdc_id"] = fdc_id
+        record["description"] = description
+        return record
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# ------------------------------
+# CLI
+# ------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local FoodData Central index")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_import = sub.add_parser("import", help="load an FDC CSV directory or JSON file")
+    p_import.add_argument("source")
+    p_import.add_argument("--db", default=FDC_LOCAL_DB)
+
+    p_search = sub.add_parser("search", help="try a lookup")
+    p_search.add_argument("query", nargs="+")
+    p_search.add_argument("--db", default=FDC_LOCAL_DB)
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "import":
+        n = import_fdc_dump(args.source, args.db)
+        print(f"Imported {n} foods → {args.db}")
+    else:
+        index = LocalFDCIndex(args.db)
+        print(index.search(" ".join(args.query)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
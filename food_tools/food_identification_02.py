@@ -1,89 +1,198 @@
 
 from utils_00 import *
+from preprocess_images import preprocess_images
+from rate_limiter import GEMINI_LIMITER, GEMINI_MAX_IN_FLIGHT, RequestScheduler
+from pipeline_state import CheckpointStore, hash_obj, run_output_path, stat_fingerprint
+from storage import read_table
 import pandas as pd
 from tqdm import tqdm
 import os
 import json
-import cv2
-import time
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_PATH = os.path.join(BASE_DIR, "../Data/linked_dataset.csv")
-OUTPUT_PATH = os.path.join(BASE_DIR, "../Data/image_ingredients.csv")
+DATA_PATH = run_output_path(os.path.join(BASE_DIR, "../Data/linked_dataset.csv"))
+OUTPUT_PATH = run_output_path(os.path.join(BASE_DIR, "../Data/image_ingredients.csv"))
 
 
 PROCESSED_DIR = os.path.join(BASE_DIR, "../Images/processed_images")
-os.makedirs(PROCESSED_DIR, exist_ok=True)
 
-df = pd.read_csv(DATA_PATH)
-records = []
-processed = set()
-
-print("Loaded dataset:", df.shape)
-
-# ---- Gemini Vision free tier allows only 10 requests/min ----
-REQUEST_INTERVAL = 7   # seconds, safe for 10 req/min
-
-
-for idx, row in tqdm(df.iterrows(), total=len(df)):
-
-    for meal_col in ["First Meal Path", "Second Meal Path", "Third Meal Path"]:
-
-        img_path = row.get(meal_col)
-
-        if not isinstance(img_path, str) or not os.path.exists(img_path):
-            continue
-
-        if img_path in processed:
-            continue
-
-        processed.add(img_path)
-
-        # --------------------------------------------
-        # 1. preprocessing
-        # --------------------------------------------
-        try:
-            enhanced = preprocess_for_gemini(img_path)
-        except Exception as e:
-            print("Preprocessing failed:", img_path, e)
-            continue
-
-        # save processed
-        save_path = os.path.join(PROCESSED_DIR, os.path.basename(img_path))
-        cv2.imwrite(save_path, enhanced)
-
-        # --------------------------------------------
-        # 2. Gemini recognition (with rate limit control)
-        # --------------------------------------------
-        try:
-            ing = identify_food_with_gemini(save_path)
-        except Exception as e:
-            print("Gemini failed:", img_path, e)
-            ing = []
-
-        # ---- RATE LIMIT CONTROL ----
-        print(f"Waiting {REQUEST_INTERVAL}s before next Gemini call...")
-        time.sleep(REQUEST_INTERVAL)
-
-        # --------------------------------------------
-        # 3. Save record
-        # --------------------------------------------
+MEAL_PATH_COLUMNS = ["First Meal Path", "Second Meal Path", "Third Meal Path"]
+
+# images packed into one Gemini request (1 = one image per request)
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", "1"))
+
+# checkpoint stage name in Data/cache/pipeline_state.sqlite
+CHECKPOINT_STAGE = "identify"
+
+
+def identify_input_hash(save_path):
+    """A result stays valid while the processed JPEG, backend, model and prompt are unchanged."""
+    return hash_obj([
+        stat_fingerprint(save_path), LLM_BACKEND, VISION_MODEL, VISION_PROMPT_VERSION, VISION_TEMPERATURE,
+    ])
+
+
+def identify_processed(job):
+    """(raw path, processed path) → ingredients, sending the processed JPEG as is."""
+    img_path, save_path = job
+    with open(save_path, "rb") as f:
+        jpeg = f.read()
+    return identify_food_with_gemini(jpeg, image_id=img_path, check_cache=False)
+
+
+def identify_processed_batch(batch):
+    """[(raw path, processed path), ...] → {raw path: ingredients} for the images the batch answered."""
+    images = {}
+    for img_path, save_path in batch:
+        with open(save_path, "rb") as f:
+            images[img_path] = f.read()
+    return identify_foods_batch_with_gemini(images, fallback=False, check_cache=False)
+
+
+def cached_answers(jobs):
+    """
+    Vision-cache hits among the jobs, looked up before anything is
+    scheduled: a hit takes no rate-limit budget, only misses are paced.
+    """
+    hits = {}
+    for img_path, save_path in jobs:
+        with open(save_path, "rb") as f:
+            _, cached = vision_cache_lookup(f.read(), os.path.basename(img_path))
+        if cached is not None:
+            hits[img_path] = cached
+    return hits
+
+
+# --------------------------------------------
+# Gemini recognition
+#    several requests in flight, paced by the shared RPM/TPM budget;
+#    the processed JPEG on disk is sent as is (no re-encode);
+#    every finished image is checkpointed (committed in small batches),
+#    failures are not, so the next run retries them; images the model
+#    cannot answer wait in the review queue instead of blocking the run
+# --------------------------------------------
+def identify_images(jobs, store=None, batch_size=VISION_BATCH_SIZE):
+    """
+    jobs: [(raw path, processed path), ...] → {raw path: ingredients}.
+    Images with a valid checkpoint from an earlier (possibly interrupted)
+    run, or a reviewed answer in the review queue, are not sent again;
+    failed images map to [].
+    """
+    own_store = store is None
+    store = store or CheckpointStore()
+
+    input_hashes = {img_path: identify_input_hash(save_path) for img_path, save_path in jobs}
+    results = store.get_many(CHECKPOINT_STAGE, input_hashes)
+    reviewed = REVIEW_QUEUE.answers(input_hashes)
+    results.update(reviewed)
+    # dismissed in review: final, no ingredients and no more requests
+    dismissed = REVIEW_QUEUE.dismissed(input_hashes)
+    results.update({img_path: [] for img_path in dismissed if img_path not in results})
+    todo = [job for job in jobs if job[0] not in results]
+    print(f"Checkpoints: {len(results)} images done ({len(reviewed)} reviewed by hand, "
+          f"{len(dismissed)} dismissed), {len(todo)} to recognise")
+
+    scheduler = RequestScheduler(GEMINI_LIMITER, max_in_flight=GEMINI_MAX_IN_FLIGHT)
+
+    try:
+        with store.writer(CHECKPOINT_STAGE) as checkpoint:
+            hits = cached_answers(todo)
+            for img_path, ing in hits.items():
+                results[img_path] = ing
+                checkpoint.add(img_path, input_hashes[img_path], ing)
+            todo = [job for job in todo if job[0] not in hits]
+            if hits:
+                print(f"Vision cache: {len(hits)} images answered, {len(todo)} to send")
+            single_jobs = todo
+
+            if batch_size > 1:
+                batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+                for batch, answered, error in tqdm(
+                    scheduler.imap_unordered(identify_processed_batch, batches,
+                                             tokens=lambda batch: VISION_REQUEST_TOKENS * len(batch)),
+                    total=len(batches),
+                ):
+                    if error is not None:
+                        print("Gemini batch failed:", error)
+                    for img_path, ing in (answered or {}).items():
+                        results[img_path] = ing
+                        checkpoint.add(img_path, input_hashes[img_path], ing)
+
+                # anything a batch did not answer cleanly goes one image per request
+                single_jobs = [job for job in todo if job[0] not in results]
+                print(f"Batch mode: {len(todo) - len(single_jobs)} answered, {len(single_jobs)} retried one by one")
+
+            for (img_path, save_path), ing, error in tqdm(
+                scheduler.imap_unordered(identify_processed, single_jobs, tokens=VISION_REQUEST_TOKENS),
+                total=len(single_jobs),
+            ):
+                if error is not None:
+                    print("Gemini failed:", img_path, error)
+                    results[img_path] = []
+                    continue
+                results[img_path] = ing
+                if ing:   # [] = queued for review
+                    checkpoint.add(img_path, input_hashes[img_path], ing)
+    finally:
+        scheduler.close()
+        if own_store:
+            store.close()
+
+    return results
+
+
+def main(data_path=DATA_PATH, output_path=OUTPUT_PATH, processed_dir=PROCESSED_DIR):
+
+    df = read_table(data_path, columns=MEAL_PATH_COLUMNS)
+    records = []
+
+    print("Loaded dataset:", df.shape)
+
+    # --------------------------------------------
+    # 1. preprocessing (all unique images, in parallel)
+    # --------------------------------------------
+    image_paths = [
+        p for p in pd.unique(df[MEAL_PATH_COLUMNS].values.ravel())
+        if isinstance(p, str) and os.path.exists(p)
+    ]
+    processed_paths = preprocess_images(image_paths, processed_dir)
+
+    jobs = [(p, processed_paths[p]) for p in image_paths if processed_paths.get(p)]
+
+    # --------------------------------------------
+    # 2. Gemini recognition
+    # --------------------------------------------
+    results = identify_images(jobs)
+    print("Vision cache:", VISION_CACHE.stats())
+    print("LLM clients:", llm_stats())
+    pending = REVIEW_QUEUE.counts().get("pending", 0)
+    if pending:
+        print(f"Review queue: {pending} images need manual input (python food_tools/review_queue.py review)")
+
+    # --------------------------------------------
+    # 3. Save records (dataset order)
+    # --------------------------------------------
+    for img_path, save_path in jobs:
         records.append({
             "image": os.path.basename(img_path),
             "raw_image_path": img_path,
             "processed_image_path": save_path,
-            "ingredients_json": json.dumps(ing)
+            "ingredients_json": json.dumps(results[img_path])
         })
 
 
-df_out = pd.DataFrame(records)
-df_out.to_csv(OUTPUT_PATH, index=False)
+    df_out = pd.DataFrame(records)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    df_out.to_csv(output_path, index=False)
 
-print("Saved:", OUTPUT_PATH)
-df_out.head()
+    print("Saved:", output_path)
+    return df_out
 
 
-# %%
+if __name__ == "__main__":
+    main()
 
 
+# %%
+
 
@@ -0,0 +1,190 @@
+# %%
+import os
+import re
+import csv
+import math
+import hashlib
+from collections import defaultdict
+from functools import lru_cache
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+INGREDIENT_ALIAS_PATH = os.getenv(
+    "INGREDIENT_ALIAS_PATH", os.path.join(BASE_DIR, "../Data/ingredient_aliases.csv")
+)
+
+# Cut / preparation words that do not change kcal per 100 g.
+# Cooking methods (fried, grilled, ...) are kept on purpose.
+DESCRIPTORS = {
+    "diced", "sliced", "chopped", "minced", "shredded", "grated", "crushed",
+    "fresh", "melted", "whole", "large", "small", "medium",
+    "slice", "slices", "piece", "pieces", "chunk", "chunks",
+    "cube", "cubes", "strip", "strips", "fillet", "fillets",
+}
+
+# Bump when the matching rules change: kcal checkpoints depend on it.
+NORMALIZER_VERSION = 2
+
+FUZZY_THRESHOLD = 0.75   # Dice similarity on character trigrams
+MEMO_SIZE = 65536
+
+
+def clean(name) -> str:
+    """'  Diced-Tomatoes!' → 'diced tomatoes'"""
+    if not isinstance(name, str):
+        return ""
+    return " ".join(re.findall(r"[a-z0-9]+", name.lower()))
+
+
+def singular(key: str) -> str:
+    """Crude plural → singular on the last word ('carrots' → 'carrot')."""
+    head, _, last = key.rpartition(" ")
+    if len(last) > 4 and last.endswith("oes"):
+        last = last[:-2]
+    elif len(last) > 3 and last.endswith("s") and not last.endswith("ss"):
+        last = last[:-1]
+    return f"{head} {last}".strip()
+
+
+def trigrams(key: str):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def load_aliases(path=INGREDIENT_ALIAS_PATH):
+    """alias,canonical CSV → dict (missing file → empty)."""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, newline="", encoding="utf-8") as f:
+        return {
+            row["alias"]: row["canonical"]
+            for row in csv.DictReader(f)
+            if row.get("alias") and row.get("canonical")
+        }
+
+
+# ============================================================
+# Normalization engine
+# ============================================================
+class IngredientNormalizer:
+    """
+    name → canonical USDA-friendly name, first rule that matches wins:
+      1. exact alias (also tried singular)
+      2. exact alias after dropping DESCRIPTORS
+      3. trigram fuzzy match above FUZZY_THRESHOLD, same word count (typos)
+      4. otherwise the cleaned, descriptor-free name itself, for USDA search
+    There is no "trailing words" rule: 'peanut butter' is not 'butter'.
+    Results are memoized per raw input string, per instance.
+    """
+
+    def __init__(self, aliases=None, threshold=FUZZY_THRESHOLD):
+        self.threshold = threshold
+        self._normalize = lru_cache(maxsize=MEMO_SIZE)(self._resolve)
+        self._version = None
+        self._canonical = {}                       # cleaned alias → canonical
+        self._by_trigram = defaultdict(set)        # trigram → {cleaned alias}
+        self._grams = {}                           # cleaned alias → trigram set
+        for alias, canonical in (aliases or {}).items():
+            self.add_alias(alias, canonical)
+
+    @classmethod
+    def from_file(cls, path=INGREDIENT_ALIAS_PATH, seed=None, **kwargs):
+        aliases = dict(seed or {})
+        aliases.update(load_aliases(path))
+        return cls(aliases, **kwargs)
+
+    def add_alias(self, alias, canonical):
+        key = clean(alias)
+        if not key:
+            return
+        canonical = canonical.strip().lower()
+        self._index(key, canonical)
+
+        # canonical names are aliases of themselves (unless mapped elsewhere)
+        canonical_key = clean(canonical)
+        if canonical_key and canonical_key not in self._canonical:
+            self._index(canonical_key, canonical)
+
+        self._normalize.cache_clear()
+        self._version = None
+
+    def _index(self, key, canonical):
+        self._canonical[key] = canonical
+        if key not in self._grams:
+            grams = trigrams(key)
+            self._grams[key] = grams
+            for g in grams:
+                self._by_trigram[g].add(key)
+
+        # 'carrots' also answers for 'carrot' (and fuzzy 'carot')
+        single = singular(key)
+        if single != key and single not in self._canonical:
+            self._index(single, canonical)
+
+    def __len__(self):
+        return len(self._canonical)
+
+    @property
+    def version(self) -> str:
+        """Hash of the rules and the alias table: changes when any name could map differently."""
+        if self._version is None:
+            h = hashlib.sha1(f"{NORMALIZER_VERSION}|{self.threshold}".encode())
+            for key in sorted(self._canonical):
+                h.update(f"\n{key}\t{self._canonical[key]}".encode())
+            self._version = h.hexdigest()
+        return self._version
+
+    # ---- matching rules ----
+    def _exact(self, key):
+        for k in (key, singular(key)):
+            if k in self._canonical:
+                return self._canonical[k]
+        return None
+
+    def _fuzzy(self, key):
+        t = self.threshold
+        words = key.count(" ")
+        query = trigrams(key)
+        n = len(query)
+        # Dice ≥ t is impossible outside this trigram-count window ...
+        lo, hi = n * t / (2 - t), n * (2 - t) / t
+        # ... and needs at least this many shared trigrams, so any match must
+        # contain one of the (n - need + 1) rarest query trigrams (prefix filter)
+        need = math.ceil(t * (n + lo) / 2)
+        rarest = sorted(query, key=lambda g: len(self._by_trigram.get(g, ())))[:max(1, n - need + 1)]
+
+        best, best_score = None, t
+        for g in rarest:
+            for alias in self._by_trigram.get(g, ()):
+                grams = self._grams[alias]
+                m = len(grams)
+                if not lo <= m <= hi or alias.count(" ") != words:
+                    continue
+                score = 2 * len(query & grams) / (n + m)
+                if score > best_score or (score == best_score and best is None):
+                    best, best_score = alias, score
+        return self._canonical[best] if best else None
+
+    def _resolve(self, name):
+        key = clean(name)
+        if not key:
+            return ""
+
+        hit = self._exact(key)
+        if hit:
+            return hit
+
+        stripped = " ".join(w for w in key.split() if w not in DESCRIPTORS) or key
+        hit = self._exact(stripped) or self._fuzzy(stripped)
+        return hit or stripped
+
+    def normalize(self, name) -> str:
+        if not isinstance(name, str):
+            return ""
+        return self._normalize(name)
+
+
+# %%
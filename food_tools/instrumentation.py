@@ -0,0 +1,344 @@
+# %%
+"""
+Spans, counters and timers for the pipeline's hot paths.
+
+Off by default; turn it on with METRICS=1 (or enable() from code):
+
+    METRICS=1 python food_tools/run_pipeline.py --force
+
+Every finished span becomes one JSON line in METRICS_LOG_PATH
+
+    {"ts": 1760000000.12, "span": "gemini_call", "ms": 812.4, "thread": "llm_0",
+     "parent": "identify_image", "kind": "single"}
+
+and all spans, counters and timers are aggregated into a Prometheus
+text-format file (METRICS_PROM_PATH, rewritten every METRICS_FLUSH_SECONDS
+and at exit) for node_exporter's textfile collector or a plain `cat`. A
+"where did the time go" table is printed at exit.
+
+When disabled, span() hands back one shared no-op object and count() /
+observe() return right away, so the instrumented code pays about one
+function call per site.
+"""
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+METRICS_DIR = os.path.join(BASE_DIR, "../Data/metrics")
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+METRICS_ENABLED = os.getenv("METRICS", "0").lower() in ("1", "true", "yes", "on")
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH", os.path.join(METRICS_DIR, "events.jsonl"))
+METRICS_PROM_PATH = os.getenv("METRICS_PROM_PATH", os.path.join(METRICS_DIR, "food_tools.prom"))
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "15"))
+
+PREFIX = "food_tools"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+# ============================================================
+# Aggregates
+# ============================================================
+class Metrics:
+    """Counters and histograms keyed by (name, labels). Thread-safe."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.counters = {}      # (name, label key) → value
+        self.histograms = {}    # (name, label key) → [bucket counts..., sum, count]
+
+    def inc(self, name, n, labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, upper in enumerate(self.buckets):
+                if seconds <= upper:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def prometheus(self) -> str:
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+
+        for (name, labels), h in histograms:
+            metric = f"{PREFIX}_{name}_seconds"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            for upper, n in zip(self.buckets, h):
+                lines.append(f"{metric}_bucket{_format_labels(labels, [('le', f'{upper:g}')])} {n}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, [('le', '+Inf')])} {h[-1]}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {h[-2]:.6f}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Spans by total time, then timers and counters: where the wall-clock time went."""
+        with self._lock:
+            spans, timers = {}, []
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name != "span":
+                    timers.append((name, labels, h[-1], h[-2]))
+                    continue
+                span_name = dict(labels)["span"]
+                total, calls = spans.get(span_name, (0.0, 0))
+                spans[span_name] = (total + h[-2], calls + h[-1])
+            counters = sorted(self.counters.items())
+
+        lines = [f"{'span':<18}{'calls':>8}{'total s':>10}{'mean ms':>10}"]
+        for name, (total, calls) in sorted(spans.items(), key=lambda kv: -kv[1][0]):
+            lines.append(f"{name:<18}{calls:>8}{total:>10.2f}{1000 * total / calls:>10.1f}")
+        for name, labels, calls, total in timers:
+            lines.append(f"{name}{_format_labels(labels)}: {calls} × {total:.2f}s")
+        for (name, labels), value in counters:
+            lines.append(f"{name}{_format_labels(labels)}: {value:g}")
+        return "\n".join(lines)
+
+
+class EventLog:
+    """Append-only JSON lines file, opened on the first event."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, event):
+        line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# ============================================================
+# Spans
+# ============================================================
+METRICS = Metrics()
+_enabled = False
+_log = None
+_prom_path = None
+_last_flush = 0.0
+_stack = threading.local()     # per-thread open span names, for "parent"
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Timed block. `labels` go to both the histogram and the log line, so
+    keep them low-cardinality (kind, mode, stage); set() adds log-only
+    fields such as an image name.
+    """
+    __slots__ = ("name", "labels", "fields", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.fields = None
+
+    def set(self, **fields):
+        self.fields = {**(self.fields or {}), **fields}
+
+    def __enter__(self):
+        stack = getattr(_stack, "names", None)
+        if stack is None:
+            stack = _stack.names = []
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        stack = _stack.names
+        stack.pop()
+
+        METRICS.observe("span", seconds, {"span": self.name, **self.labels})
+        if exc_type is not None:
+            METRICS.inc("span_errors", 1, {"span": self.name, "error": exc_type.__name__})
+
+        if _log is not None:
+            event = {"ts": time.time(), "span": self.name, "ms": round(seconds * 1000, 3),
+                     "thread": threading.current_thread().name}
+            if stack:
+                event["parent"] = stack[-1]
+            if exc_type is not None:
+                event["error"] = exc_type.__name__
+            event.update(self.labels)
+            if self.fields:
+                event.update(self.fields)
+            _log.write(event)
+        _maybe_flush()
+        return False
+
+
+def span(name, **labels):
+    """`with span("usda_search"):` times the block (no-op when disabled)."""
+    if not _enabled:
+        return _NULL_SPAN
+    return Span(name, labels)
+
+
+def traced(name=None):
+    """Decorator: every call of the function is a span (named after it by default)."""
+    def wrap(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return wrap
+
+
+def count(name, n=1, **labels):
+    """Add n to a counter, e.g. count("vision_cache", result="hit")."""
+    if _enabled and n:
+        METRICS.inc(name, n, labels)
+
+
+def observe(name, seconds, **labels):
+    """Record a duration that is not a block of code, e.g. a rate limit wait."""
+    if _enabled:
+        METRICS.observe(name, seconds, labels)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+# ============================================================
+# Output
+# ============================================================
+def write_prometheus(path=None):
+    path = path or _prom_path
+    if not path:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(METRICS.prometheus())
+    os.replace(tmp, path)   # scrapers never see a half-written file
+
+
+def _maybe_flush():
+    global _last_flush
+    now = time.monotonic()
+    if now - _last_flush < METRICS_FLUSH_SECONDS:
+        return
+    _last_flush = now
+    try:
+        write_prometheus()
+    except OSError as e:
+        print(f"[WARN] Could not write metrics to {_prom_path}: {e}")
+
+
+def flush():
+    """Write the Prometheus file now and print the summary table."""
+    if not _enabled:
+        return
+    write_prometheus()
+    print("\n==== Instrumentation ====")
+    print(METRICS.summary())
+    print(f"Spans → {_log.path if _log else '-'} | metrics → {_prom_path or '-'}")
+
+
+def enable(log_path=METRICS_LOG_PATH, prom_path=METRICS_PROM_PATH):
+    """Turn instrumentation on for this process (log_path/prom_path None: skip that output)."""
+    global _enabled, _log, _prom_path, _last_flush
+    if _enabled:
+        return
+    _log = EventLog(log_path) if log_path else None
+    _prom_path = prom_path
+    _last_flush = time.monotonic()
+    _enabled = True
+    atexit.register(_shutdown)
+
+
+def disable():
+    global _enabled, _log
+    if not _enabled:
+        return
+    flush()
+    _enabled = False
+    if _log is not None:
+        _log.close()
+        _log = None
+    atexit.unregister(_shutdown)
+
+
+def _shutdown():
+    flush()
+    if _log is not None:
+        _log.close()
+
+
+if METRICS_ENABLED:
+    enable()
+
+# %%
@@ -1,22 +1,35 @@
 from utils_00 import *
 import os
+import threading
 import pandas as pd
 import json
 import numpy as np
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.agents import Tool, AgentExecutor, create_tool_calling_agent
-from langchain.prompts import ChatPromptTemplate
+from instrumentation import span
+from pipeline_state import CheckpointStore, hash_obj, run_output_path
+from prompt_packing import count_tokens, pack_user_week, pack_weekly_kcal
+from rate_limiter import GEMINI_LIMITER, GEMINI_MAX_IN_FLIGHT, RequestScheduler
+from storage import STORAGE_FORMAT, read_table
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_LINKED = os.path.join(BASE_DIR, "../Data/linked_dataset.csv")
-USER_REPORT_DIR = os.path.join(BASE_DIR, "../Data/user_reports")
+DATA_LINKED = run_output_path(os.path.join(BASE_DIR, "../Data/linked_dataset.csv"))
+USER_REPORT_DIR = run_output_path(os.path.join(BASE_DIR, "../Data/user_reports"))
+USER_REPORTS_TABLE = run_output_path(os.path.join(BASE_DIR, "../Data/user_reports.parquet"))
 
-FINAL_OUTPUT_DIR = os.path.join(BASE_DIR, "../weekly_ai_reports")
-os.makedirs(FINAL_OUTPUT_DIR, exist_ok=True)
+FINAL_OUTPUT_DIR = run_output_path(os.path.join(BASE_DIR, "../weekly_ai_reports"))
 
-df_linked = pd.read_csv(DATA_LINKED)
-print("Loaded linked dataset:", df_linked.shape)
+# "direct": weekly kcal goes straight into the prompt, one LLM call per user
+# "agent":  ToolCalling agent loads it through LoadWeeklyKcal (2+ calls per user)
+REPORT_MODE = os.getenv("REPORT_MODE", "direct").lower()
+REPORT_MODEL = "gemini-2.5-flash" if LLM_BACKEND != "fake" else "fake-gemini"
+REPORT_TEMPERATURE = 0.25
+
+# "compact": packed tables + weekly stats (prompt_packing.py)
+# "json":    demographics / lifestyle / kcal rows as indented JSON
+PROMPT_FORMAT = os.getenv("PROMPT_FORMAT", "compact").lower()
+
+# checkpoint stage in Data/cache/pipeline_state.sqlite
+REPORT_STAGE = "weekly_reports"
 
 
 def to_json_safe(obj) -> str:
@@ -29,29 +42,41 @@ def to_json_safe(obj) -> str:
     return json.dumps(obj, indent=2, default=_convert)
 
 
-def load_weekly_kcal(user_id: str):
-    path = os.path.join(USER_REPORT_DIR, f"{user_id}.csv")
+def load_weekly_report(user_id: str, reports_dir=USER_REPORT_DIR):
+    """The user's per-day kcal report as a DataFrame (empty when there is none)."""
+    if STORAGE_FORMAT == "parquet":
+        # only this user's row groups are read; nested columns as JSON, like the CSV files
+        if not os.path.exists(USER_REPORTS_TABLE):
+            return pd.DataFrame()
+        df = read_table(USER_REPORTS_TABLE, filters=[("ID", "==", user_id)], nested="json")
+        return df.drop(columns="ID")
+
+    path = os.path.join(reports_dir, f"{user_id}.csv")
     if not os.path.exists(path):
+        return pd.DataFrame()
+    return pd.read_csv(path)
+
+
+def load_weekly_reports(user_ids, reports_dir=USER_REPORT_DIR):
+    """{user_id: report DataFrame} — one table read in parquet mode, one file per user for CSV."""
+    if STORAGE_FORMAT != "parquet" or not os.path.exists(USER_REPORTS_TABLE):
+        return {user_id: load_weekly_report(user_id, reports_dir) for user_id in user_ids}
+
+    df = read_table(USER_REPORTS_TABLE, nested="json")
+    by_user = {str(k): g.drop(columns="ID") for k, g in df.groupby("ID", sort=False)}
+    return {user_id: by_user.get(user_id, pd.DataFrame()) for user_id in user_ids}
+
+
+def weekly_kcal_text(user_id: str, report, fmt=PROMPT_FORMAT) -> str:
+    if report.empty:
         return f"No weekly calorie report found for user {user_id}"
-    df = pd.read_csv(path)
-    return df.to_json(orient="records")
+    if fmt == "json":
+        return report.to_json(orient="records")
+    return pack_weekly_kcal(report)
 
-tools = [
-    Tool(
-        name="LoadWeeklyKcal",
-        func=load_weekly_kcal,
-        description="Load user's USDA-based 7-day calories (breakfast, lunch, dinner). Returns JSON string."
-    )
-]
 
-# --------------------------
-# LLM（Gemini）
-# --------------------------
-llm = ChatGoogleGenerativeAI(
-    model="gemini-2.5-flash",
-    google_api_key=GOOGLE_API_KEY,
-    temperature=0.25,
-)
+def load_weekly_kcal(user_id: str, reports_dir=USER_REPORT_DIR):
+    return weekly_kcal_text(user_id, load_weekly_report(user_id, reports_dir))
 
 # --------------------------
 # Prompt
@@ -76,38 +101,120 @@ Your output MUST use the following Markdown structure:
 Be concise, scientific, and user-friendly.
 """
 
-PROMPT = ChatPromptTemplate.from_messages(
-    [
-        ("system", SYSTEM_PROMPT),
-        ("human", "{input}"),
-        ("placeholder", "{agent_scratchpad}"),
-    ]
-)
+AGENT_INSTRUCTIONS = """
+You MUST first call the tool `LoadWeeklyKcal` with user_id="{user_id}"
+to load the USDA-based calorie summary for 7 days (breakfast, lunch, dinner).
+
+After you have the calorie data:
+- Combine it with demographics and lifestyle info above.
+- Then produce the structured weekly nutrition report following the required sections.
+"""
+
+DIRECT_INSTRUCTIONS = """
+USDA-based calorie summary for 7 days (breakfast, lunch, dinner):
+{weekly_kcal}
 
-# --------------------------
-# Create ToolCalling Agent
-# --------------------------
-agent_core = create_tool_calling_agent(
-    llm=llm,
-    tools=tools,
-    prompt=PROMPT
-)
-
-agent = AgentExecutor(
-    agent=agent_core,
-    tools=tools,
-    verbose=True,
-    max_iterations=5
-)
+Combine the calorie data with the demographics and lifestyle info above,
+then produce the structured weekly nutrition report following the required sections.
+"""
+
+DIRECT_INSTRUCTIONS_PACKED = """
+Combine the calorie data with the demographics and lifestyle info above,
+then produce the structured weekly nutrition report following the required sections.
+"""
+
+_agents = {}    # reports_dir → agent whose tool reads from it
+_agent_lock = threading.Lock()
+
+
+def report_llm():
+    """
+    Gemini chat model for the reports, shared by all threads (llm_clients
+    registry). Every call takes its share of the shared Gemini budget.
+    """
+    return chat_model(REPORT_MODEL, REPORT_TEMPERATURE, limiter=GEMINI_LIMITER)
+
+
+def get_agent(reports_dir=USER_REPORT_DIR):
+    """
+    ToolCalling agent over Gemini whose LoadWeeklyKcal tool reads from
+    reports_dir. Built on first use (langchain is only imported here) and
+    shared by all threads.
+    """
+    llm = report_llm()
+    with _agent_lock:
+        if reports_dir in _agents:
+            return _agents[reports_dir]
+
+        from langchain.agents import Tool, AgentExecutor, create_tool_calling_agent
+        from langchain.prompts import ChatPromptTemplate
+
+        tools = [
+            Tool(
+                name="LoadWeeklyKcal",
+                func=lambda user_id: load_weekly_kcal(user_id, reports_dir),
+                description=("Load user's USDA-based 7-day calories (breakfast, lunch, dinner). "
+                             + ("Returns JSON string." if PROMPT_FORMAT == "json" else
+                                "Returns a dish list and a per-day table."))
+            )
+        ]
+
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", SYSTEM_PROMPT),
+                ("human", "{input}"),
+                ("placeholder", "{agent_scratchpad}"),
+            ]
+        )
+
+        # --------------------------
+        # Create ToolCalling Agent
+        # --------------------------
+        agent_core = create_tool_calling_agent(
+            llm=llm,
+            tools=tools,
+            prompt=prompt
+        )
+
+        agent = _agents[reports_dir] = AgentExecutor(
+            agent=agent_core,
+            tools=tools,
+            verbose=True,
+            max_iterations=5
+        )
+        return agent
 
 # --------------------------
 # Weekly Summary
 # --------------------------
-def generate_weekly_report(user_id: str) -> str:
-    user_rows = df_linked[df_linked["ID"].astype(str) == str(user_id)].sort_values("Day")
-    if user_rows.empty:
-        return f"No rows found for user {user_id}"
-
+def build_report_input(user_id: str, user_rows, report=None, mode=REPORT_MODE, fmt=PROMPT_FORMAT) -> str:
+    """
+    Prompt for one user (their linked_dataset rows, any order).
+    direct mode puts their kcal report in the prompt; agent mode tells the
+    model to load it.
+    """
+    if mode == "agent":
+        report, instructions = None, AGENT_INSTRUCTIONS.format(user_id=user_id)
+    elif report is None:
+        report = load_weekly_report(user_id)
+
+    if fmt != "json":
+        if mode == "agent":
+            # dishes and kcal come from LoadWeeklyKcal, not from this prompt
+            return f"""
+Weekly lifestyle data (one person):
+{pack_user_week(user_rows, None, kcal_from_tool=True)}
+{instructions}"""
+        # direct mode: dishes and daily kcal share one table with the lifestyle metrics
+        return f"""
+Weekly data (one person; Dn = dish id):
+{pack_user_week(user_rows, report)}
+{DIRECT_INSTRUCTIONS_PACKED}"""
+
+    if mode != "agent":
+        instructions = DIRECT_INSTRUCTIONS.format(weekly_kcal=weekly_kcal_text(user_id, report, fmt))
+
+    user_rows = user_rows.sort_values("Day")
     first = user_rows.iloc[0]
 
     demographics = {
@@ -129,43 +236,105 @@ def generate_weekly_report(user_id: str) -> str:
             "ScreenTime(min)": int(r["Screen Time (minute)"]),
         })
 
-    
     demographics_str = to_json_safe(demographics)
     lifestyle_str = to_json_safe(lifestyle)
 
-    input_text = f"""
+    return f"""
 User Demographics (one person):
 {demographics_str}
 
 Lifestyle over 7 days:
 {lifestyle_str}
+{instructions}"""
 
-You MUST first call the tool `LoadWeeklyKcal` with user_id="{user_id}"
-to load the USDA-based calorie summary for 7 days (breakfast, lunch, dinner).
-
-After you have the calorie data:
-- Combine it with demographics and lifestyle info above.
-- Then produce the structured weekly nutrition report following the required sections.
-"""
-
-    result = agent.invoke({"input": input_text})
-    return result["output"]
-
-# --------------------------
-# weekly report
-# --------------------------
-for raw_id in df_linked["ID"].unique():
-    user_id = str(raw_id)
-    print(f"\n===== Generating weekly AI report for user {user_id} =====")
-    summary = generate_weekly_report(user_id)
 
-    save_path = os.path.join(FINAL_OUTPUT_DIR, f"{user_id}_weekly_report.txt")
-    with open(save_path, "w") as f:
-        f.write(summary)
+def run_report(input_text: str, mode=REPORT_MODE, reports_dir=USER_REPORT_DIR) -> str:
+    with span("agent_invoke", mode=mode):
+        if mode == "agent":
+            return get_agent(reports_dir).invoke({"input": input_text})["output"]
 
-    print(f"Saved → {save_path}")
+        from langchain_core.messages import SystemMessage, HumanMessage
+        response = report_llm().invoke([SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=input_text)])
+        return response.content
 
 
+def report_input_hash(input_text: str, weekly_kcal: str, mode=REPORT_MODE) -> str:
+    """A saved report stays valid while its prompt, calorie data, backend and model settings are unchanged."""
+    return hash_obj([mode, LLM_BACKEND, REPORT_MODEL, REPORT_TEMPERATURE, SYSTEM_PROMPT, input_text, weekly_kcal])
 
 
+def generate_weekly_report(user_id: str, df_linked, mode=REPORT_MODE, fmt=PROMPT_FORMAT,
+                           reports_dir=USER_REPORT_DIR) -> str:
+    user_rows = df_linked[df_linked["ID"].astype(str) == str(user_id)]
+    if user_rows.empty:
+        return f"No rows found for user {user_id}"
+    report = load_weekly_report(user_id, reports_dir) if mode != "agent" else None
+    return run_report(build_report_input(user_id, user_rows, report, mode=mode, fmt=fmt), mode, reports_dir)
 
+# --------------------------
+# weekly report
+# --------------------------
+def main(linked_path=DATA_LINKED, out_dir=FINAL_OUTPUT_DIR, mode=REPORT_MODE, force=False, fmt=PROMPT_FORMAT,
+         reports_dir=USER_REPORT_DIR):
+    """
+    Reports for every user, several in flight under the shared Gemini limiter.
+    Users whose prompt and calorie data are unchanged since their saved
+    report are skipped (force=True regenerates everything).
+    """
+    df_linked = read_table(linked_path)
+    print("Loaded linked dataset:", df_linked.shape)
+    print(f"Report mode: {mode}, prompt format: {fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    # one pass over the dataset instead of one filter per user
+    user_rows = {str(raw_id): rows for raw_id, rows in df_linked.groupby("ID", sort=False)}
+    reports = load_weekly_reports(list(user_rows), reports_dir)
+
+    inputs, input_hashes, prompt_tokens = {}, {}, {}
+    for user_id, rows in user_rows.items():
+        inputs[user_id] = build_report_input(user_id, rows, reports[user_id], mode, fmt)
+        # agent mode: the tool output is not in the prompt, but a change in it must still count
+        weekly_kcal = weekly_kcal_text(user_id, reports[user_id], fmt)
+        input_hashes[user_id] = report_input_hash(inputs[user_id], weekly_kcal, mode)
+        prompt_tokens[user_id] = count_tokens(SYSTEM_PROMPT) + count_tokens(inputs[user_id])
+
+    def save_path_of(user_id):
+        return os.path.join(out_dir, f"{user_id}_weekly_report.txt")
+
+    store = CheckpointStore()
+    done = {} if force else store.get_many(REPORT_STAGE, input_hashes)
+    todo = [user_id for user_id in user_rows if not (user_id in done and os.path.exists(save_path_of(user_id)))]
+    print(f"Weekly reports: {len(user_rows) - len(todo)} unchanged, {len(todo)} to generate")
+    if todo:
+        tokens = [prompt_tokens[user_id] for user_id in todo]
+        print(f"Estimated prompt tokens per user (~4 chars/token): mean {sum(tokens) / len(tokens):.0f}, max {max(tokens)}, "
+              f"total {sum(tokens)}")
+
+    # several users in flight; the LLM callback paces the actual calls
+    scheduler = RequestScheduler(GEMINI_LIMITER, max_in_flight=GEMINI_MAX_IN_FLIGHT)
+
+    def report(user_id):
+        return run_report(inputs[user_id], mode, reports_dir)
+
+    try:
+        with store.writer(REPORT_STAGE, batch_size=1) as checkpoint:
+            for user_id, summary, error in scheduler.imap_unordered(report, todo, tokens=None):
+                print(f"\n===== Weekly AI report for user {user_id} =====")
+                if error is not None:
+                    print(f"Report failed for user {user_id}: {error}")
+                    continue
+
+                save_path = save_path_of(user_id)
+                with open(save_path, "w") as f:
+                    f.write(summary)
+                checkpoint.add(user_id, input_hashes[user_id], save_path)
+
+                print(f"Saved → {save_path} (prompt ~{prompt_tokens[user_id]} tokens)")
+    finally:
+        scheduler.close()
+        store.close()
+    print("LLM clients:", llm_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# %%
+"""
+Process-wide registry of chat model clients.
+
+One client per (backend, model, temperature, JSON mode, limiter) is built
+on first use and shared by every thread, so auth and connection setup
+(gRPC channel / HTTP pool) happen once per process instead of once per
+call. Clients are closed at interpreter exit.
+
+Every client carries a timing callback: `llm_stats()` reports how much
+time went into building clients versus waiting on requests, e.g.
+
+    setup: 1 clients in 0.085s | requests: 17 in 13.2s (p50 0.71s)
+"""
+import time
+import atexit
+import threading
+
+
+class LLMStats:
+    """Setup vs request time, per registry key. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.setup = {}         # key → seconds spent building it
+        self.requests = {}      # key → [request seconds, ...]
+        self.errors = {}        # key → failed request count
+
+    def record_setup(self, key, seconds):
+        with self._lock:
+            self.setup[key] = self.setup.get(key, 0.0) + seconds
+
+    def record_request(self, key, seconds, failed=False):
+        with self._lock:
+            self.requests.setdefault(key, []).append(seconds)
+            if failed:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def durations(self):
+        """Every request duration so far, in completion order per key."""
+        with self._lock:
+            return [d for ds in self.requests.values() for d in ds]
+
+    def summary(self):
+        with self._lock:
+            durations = sorted(d for ds in self.requests.values() for d in ds)
+            return {
+                "clients": len(self.setup),
+                "setup_seconds": sum(self.setup.values()),
+                "requests": len(durations),
+                "request_seconds": sum(durations),
+                "request_p50": durations[len(durations) // 2] if durations else 0.0,
+                "errors": sum(self.errors.values()),
+            }
+
+    def format(self):
+        s = self.summary()
+        return (f"setup: {s['clients']} clients in {s['setup_seconds']:.3f}s | "
+                f"requests: {s['requests']} in {s['request_seconds']:.1f}s "
+                f"(p50 {s['request_p50']:.2f}s, {s['errors']} failed)")
+
+
+def _timing_callback(stats, key):
+    """LangChain handler timing each chat model call from start to end/error."""
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TimingCallback(BaseCallbackHandler):
+        run_inline = True
+
+        def __init__(self):
+            self._started = {}
+            self._lock = threading.Lock()
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+            with self._lock:
+                self._started[run_id] = time.perf_counter()
+
+        def _finish(self, run_id, failed):
+            with self._lock:
+                start = self._started.pop(run_id, None)
+            if start is not None:
+                stats.record_request(key, time.perf_counter() - start, failed)
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            self._finish(run_id, failed=False)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            self._finish(run_id, failed=True)
+
+    return TimingCallback()
+
+
+# ============================================================
+# Registry
+# ============================================================
+class ClientRegistry:
+    """
+    key → client, built once by `factory(callbacks)`. Concurrent first
+    calls for the same key build it only once; other keys are not held
+    up meanwhile. Creation never awaits, so async code can call get()
+    directly and share the same clients.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.stats = LLMStats()
+
+    def get(self, key, factory):
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            client = self._clients.get(key)
+            if client is None:
+                start = time.perf_counter()
+                client = factory([_timing_callback(self.stats, key)])
+                self.stats.record_setup(key, time.perf_counter() - start)
+                self._clients[key] = client
+        return client
+
+    def close(self):
+        """Close every client's transport (gRPC channel / HTTP session)."""
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            for name in ("client", "async_client"):
+                inner = getattr(client, name, None)
+                transport = getattr(inner, "transport", None)
+                try:
+                    if transport is not None and hasattr(transport, "close"):
+                        transport.close()
+                    elif hasattr(inner, "close"):
+                        inner.close()
+                except Exception:
+                    pass
+
+    def __len__(self):
+        return len(self._clients)
+
+
+LLM_CLIENTS = ClientRegistry()
+atexit.register(LLM_CLIENTS.close)
+
+
+def llm_stats():
+    return LLM_CLIENTS.stats.format()
+
+
+# %%
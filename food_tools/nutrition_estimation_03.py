@@ -1,88 +1,217 @@
 from utils_00 import *
+from pipeline_state import CheckpointStore, hash_obj, run_output_path
+from storage import STORAGE_FORMAT, read_table, write_table
 import pandas as pd
+import numpy as np
 import os
 import json
+import hashlib
 from tqdm import tqdm
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_LINKED = os.path.join(BASE_DIR, "../Data/linked_dataset.csv")
-DATA_ING = os.path.join(BASE_DIR, "../Data/image_ingredients.csv")
-
-OUTPUT_DIR = os.path.join(BASE_DIR, "../Data/user_reports")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-df_linked = pd.read_csv(DATA_LINKED)
-df_ing = pd.read_csv(DATA_ING)
-
-print("Loaded linked dataset:", df_linked.shape)
-print("Loaded ingredients:", df_ing.shape)
+DATA_LINKED = run_output_path(os.path.join(BASE_DIR, "../Data/linked_dataset.csv"))
+DATA_ING = run_output_path(os.path.join(BASE_DIR, "../Data/image_ingredients.csv"))
+
+OUTPUT_DIR = run_output_path(os.path.join(BASE_DIR, "../Data/user_reports"))
+# STORAGE_FORMAT=parquet: all users in one table, clustered by ID
+USER_REPORTS_TABLE = run_output_path(os.path.join(BASE_DIR, "../Data/user_reports.parquet"))
+
+# meal name → path column in linked_dataset.csv
+MEAL_PATH_COLUMNS = {
+    "Breakfast": "First Meal Path",
+    "Lunch":     "Second Meal Path",
+    "Dinner":    "Third Meal Path",
+}
+
+# checkpoint stages in Data/cache/pipeline_state.sqlite
+KCAL_STAGE = "kcal"
+REPORT_STAGE = "user_reports"
+
+REPORT_COLUMNS = ["Day"] + [
+    f"{meal}_{field}"
+    for meal in MEAL_PATH_COLUMNS
+    for field in ("Ingredients", "Kcal", "Detail")
+] + ["Daily_Total_Kcal"]
 
 # ---------------------------------------------------------
-# Build image_path → ingredient_list mapping
+# Helpers
 # ---------------------------------------------------------
-image_to_ing = {}
-
-for _, row in df_ing.iterrows():
-
-    raw_path = row["raw_image_path"]   # <— KEY FIX
-
+def parse_ingredients(raw):
     try:
-        ings = json.loads(row["ingredients_json"])
-    except:
-        ings = []
-
-    image_to_ing[raw_path] = ings
+        ings = json.loads(raw)
+    except Exception:
+        return []
+    return ings if isinstance(ings, list) else []
+
+
+def ingredients_hash(ingredients) -> str:
+    """Stable hash of an ingredient list (dict key order does not matter)."""
+    blob = json.dumps(ingredients, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+def kcal_input_hash(ingredients) -> str:
+    """
+    A checkpointed kcal stays valid while the ingredients, the name
+    normalization (rules + alias table) and the nutrient source are unchanged.
+    """
+    return hash_obj([
+        ingredients_hash(ingredients), ingredient_normalizer().version,
+        USDA_BACKEND, USDA_LOOKUP_MODE, NUTRIENT_CACHE.version,
+    ])
+
+
+def build_image_kcal_table(df_ing, store):
+    """
+    One row per distinct image:
+    raw_image_path | Ingredients | Kcal | Detail
+    compute_kcal runs once per image, no matter how many user-days reuse it,
+    and only for images without a valid checkpoint from an earlier run.
+    """
+    df = df_ing.drop_duplicates("raw_image_path", keep="last")
+    parsed = dict(zip(df["raw_image_path"], (parse_ingredients(raw) for raw in df["ingredients_json"])))
+
+    input_hashes = {path: kcal_input_hash(ings) for path, ings in parsed.items()}
+    done = store.get_many(KCAL_STAGE, input_hashes)
+    todo = [path for path in parsed if path not in done]
+    print(f"Checkpoints: {len(done)} images done, {len(todo)} to compute")
+
+    # warm the nutrient cache for every distinct new name in one concurrent batch
+    warmed = usda_search_many(
+        normalize_ingredient(item.get("ingredient", ""))
+        for path in todo for item in parsed[path]
+    )
+    # names without a USDA record (no match, or a transient failure): their
+    # images are not checkpointed, so they are looked up again once the
+    # negative cache entry expires instead of staying 0 kcal for good.
+    # Within this run every name is looked up once: compute_kcal reuses
+    # `warmed`, transient failures included.
+    unresolved = {name for name, record in warmed.items() if record is None}
+
+    with store.writer(KCAL_STAGE) as checkpoint:
+        for path in tqdm(todo):
+            total_kcal, detail = compute_kcal(parsed[path], warmed)
+            done[path] = (total_kcal, detail)
+            if not any(d["normalized"] in unresolved for d in detail):
+                checkpoint.add(path, input_hashes[path], [total_kcal, detail])
+
+    rows = []
+    for path, ingredients in parsed.items():
+        total_kcal, detail = done[path]
+        rows.append({
+            "raw_image_path": path,
+            "Ingredients": json.dumps(ingredients),
+            "Kcal": total_kcal,
+            "Detail": json.dumps(detail),
+        })
+
+    return pd.DataFrame(rows, columns=["raw_image_path", "Ingredients", "Kcal", "Detail"])
+
+
+def link_meal_kcal(df_linked, image_table):
+    """
+    Per-image Ingredients / Kcal / Detail mapped onto every (user, day, meal)
+    with one hash lookup per meal column, in the wide per-day report layout.
+    """
+    by_path = image_table.set_index("raw_image_path")
+
+    daily = df_linked[["ID", "Day"]].copy()
+    for meal, col in MEAL_PATH_COLUMNS.items():
+        paths = df_linked[col].astype(object)
+        daily[f"{meal}_Ingredients"] = paths.map(by_path["Ingredients"]).fillna("[]")
+        daily[f"{meal}_Kcal"] = paths.map(by_path["Kcal"]).fillna(0.0)
+        daily[f"{meal}_Detail"] = paths.map(by_path["Detail"]).fillna("[]")
+
+    daily["Daily_Total_Kcal"] = (
+        daily["Breakfast_Kcal"] +
+        daily["Lunch_Kcal"] +
+        daily["Dinner_Kcal"]
+    )
+    return daily
+
+
+def user_row_ranges(ids):
+    """Sorted ID array → [(user_id, start, end), ...], one pass, no per-user scans."""
+    if len(ids) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)]
+    return [(ids[s], s, e) for s, e in zip(starts, ends)]
 
 
 # ---------------------------------------------------------
-# Loop through users
+# Per-user reports
+# (a report is rewritten only when its content changed, so its mtime
+#  stays put and the weekly-report stage can skip the user)
 # ---------------------------------------------------------
-for user_id in df_linked["ID"].unique():
+def write_user_reports(daily, out_dir, store):
+    """
+    Sort once by (ID, Day), render the whole table to CSV once, then cut
+    each user's file out of it by row range. Linear in total rows.
+    """
+    if STORAGE_FORMAT == "parquet":
+        return write_user_reports_table(daily, store)
 
-    print(f"\n===== Processing user {user_id} =====")
+    os.makedirs(out_dir, exist_ok=True)
 
-    user_df = df_linked[df_linked["ID"] == user_id].sort_values("Day")
-    daily_records = []
+    table = daily.sort_values(["ID", "Day"], kind="stable")
+    # JSON columns are ASCII-escaped, so one CSV row is exactly one line
+    header, *rows = table[REPORT_COLUMNS].to_csv(index=False, lineterminator="\n").split("\n")[:-1]
 
-    for _, r in user_df.iterrows():
+    contents = {}
+    for user_id, start, end in user_row_ranges(table["ID"].to_numpy()):
+        contents[str(user_id)] = "\n".join([header, *rows[start:end]]) + "\n"
 
-        day_record = {"Day": r["Day"]}
+    content_hashes = {user_id: hash_obj(content) for user_id, content in contents.items()}
+    done = store.get_many(REPORT_STAGE, content_hashes)
 
-        meal_paths = {
-            "Breakfast": r["First Meal Path"],
-            "Lunch":     r["Second Meal Path"],
-            "Dinner":    r["Third Meal Path"]
-        }
+    written = 0
+    with store.writer(REPORT_STAGE) as checkpoint:
+        for user_id, content in contents.items():
+            save_path = os.path.join(out_dir, f"{user_id}.csv")
+            if user_id in done and os.path.exists(save_path):
+                continue
 
-        for meal_name, path in meal_paths.items():
+            with open(save_path, "w", newline="") as f:
+                f.write(content)
+            checkpoint.add(user_id, content_hashes[user_id], save_path)
+            written += 1
 
-            if isinstance(path, str) and path in image_to_ing:
-                ingredients = image_to_ing[path]
-                total_kcal, detail = compute_kcal(ingredients)
-            else:
-                ingredients = []
-                total_kcal = 0
-                detail = []
+    print(f"\nUser reports: {written} saved → {out_dir}, {len(contents) - written} unchanged")
 
-            day_record[f"{meal_name}_Ingredients"] = json.dumps(ingredients)
-            day_record[f"{meal_name}_Kcal"] = total_kcal
-            day_record[f"{meal_name}_Detail"] = json.dumps(detail)
 
-        day_record["Daily_Total_Kcal"] = (
-            day_record["Breakfast_Kcal"] +
-            day_record["Lunch_Kcal"] +
-            day_record["Dinner_Kcal"]
-        )
+def write_user_reports_table(daily, store, path=USER_REPORTS_TABLE):
+    """Every user in one Parquet file (ID + report columns), rewritten only when it changed."""
+    table = daily[["ID"] + REPORT_COLUMNS].sort_values(["ID", "Day"], kind="stable").reset_index(drop=True)
+    content_hash = hash_obj(pd.util.hash_pandas_object(table, index=False).tolist())
 
-        daily_records.append(day_record)
+    if os.path.exists(path) and store.get_many(REPORT_STAGE, {"*": content_hash}):
+        print("\nUser reports: unchanged")
+        return
+    saved = write_table(table, path, fmt="parquet")
+    store.put_many(REPORT_STAGE, [("*", content_hash, saved)])
+    print(f"\nSaved {table['ID'].nunique()} user reports → {saved}")
 
-    out_df = pd.DataFrame(daily_records)
-    save_path = os.path.join(OUTPUT_DIR, f"{user_id}.csv")
-    out_df.to_csv(save_path, index=False)
 
-    print(f"Saved → {save_path}")
+def main(linked_path=DATA_LINKED, ingredients_path=DATA_ING, out_dir=OUTPUT_DIR):
+    df_linked = read_table(linked_path, columns=["ID", "Day", *MEAL_PATH_COLUMNS.values()])
+    df_ing = pd.read_csv(ingredients_path)
 
+    print("Loaded linked dataset:", df_linked.shape)
+    print("Loaded ingredients:", df_ing.shape)
 
+    # per-image calories → per-day table
+    store = CheckpointStore()
+    try:
+        image_table = build_image_kcal_table(df_ing, store)
+        print("Unique images:", len(image_table))
 
+        daily = link_meal_kcal(df_linked, image_table)
+        write_user_reports(daily, out_dir, store)
+    finally:
+        store.close()
+    return daily
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+# %%
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from instrumentation import count
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "../Data")
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+# runs on the offline fakes (fake_backends.py) write their outputs, checkpoints
+# and caches under FAKE_RUN_DIR, never over the real ones in Data/
+FAKE_RUN = "fake" in (os.getenv("LLM_BACKEND", "").lower(), os.getenv("USDA_BACKEND", "").lower())
+FAKE_RUN_DIR = os.getenv("FAKE_RUN_DIR", os.path.join(DATA_DIR, "fake_run"))
+CACHE_DIR = os.path.join(FAKE_RUN_DIR if FAKE_RUN else DATA_DIR, "cache")
+
+PIPELINE_STATE_PATH = os.getenv("PIPELINE_STATE_PATH", os.path.join(CACHE_DIR, "pipeline_state.sqlite"))
+CHECKPOINT_BATCH = int(os.getenv("CHECKPOINT_BATCH", "50"))   # rows per commit
+
+
+def run_output_path(path):
+    """A pipeline output (linked dataset, ingredients, reports), moved under FAKE_RUN_DIR on a fake run."""
+    if not FAKE_RUN:
+        return path
+    return os.path.join(FAKE_RUN_DIR, os.path.basename(os.path.normpath(path)))
+
+
+# ------------------------------
+# Input fingerprints
+# ------------------------------
+def hash_obj(obj) -> str:
+    """Stable hash of any JSON-serialisable value."""
+    blob = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+def stat_fingerprint(path):
+    """(size, mtime) of a file, or None if it does not exist. Cheap, no read."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def hash_file(path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_paths(paths) -> str:
+    """
+    Fingerprint of inputs: files by content (a rewritten but identical CSV
+    does not trigger downstream work), directories by name, size and mtime
+    of the files directly inside (enough for Images/raw_images).
+    """
+    parts = []
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as it:
+                entries = sorted(
+                    (e.name, e.stat().st_size, e.stat().st_mtime_ns)
+                    for e in it if e.is_file() and not e.name.startswith(".")
+                )
+            parts.append([path, entries])
+        elif os.path.exists(path):
+            parts.append([path, hash_file(path)])
+        else:
+            parts.append([path, None])
+    return hash_obj(parts)
+
+
+# ============================================================
+# Checkpoint store
+# ============================================================
+class CheckpointStore:
+    """
+    Per-item results of every pipeline stage, keyed by (stage, key).
+
+    Each row remembers the hash of the inputs it was computed from; a row
+    whose input hash no longer matches is stale and gets recomputed.
+    Rows are appended as items finish (see writer()), so an interrupted
+    run resumes from the last commit.
+    """
+
+    def __init__(self, path=PIPELINE_STATE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    stage      TEXT NOT NULL,
+                    key        TEXT NOT NULL,
+                    input_hash TEXT NOT NULL,
+                    output     TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (stage, key)
+                );
+                CREATE TABLE IF NOT EXISTS stages (
+                    stage       TEXT PRIMARY KEY,
+                    input_hash  TEXT NOT NULL,
+                    finished_at REAL NOT NULL
+                );
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    # ---- per-item checkpoints ----
+    def get_many(self, stage, wanted):
+        """
+        wanted: key → current input hash.
+        Returns key → output for the keys whose checkpoint is still valid.
+        """
+        wanted = dict(wanted)
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            keys = list(wanted)
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT key, input_hash, output FROM checkpoints "
+                    f"WHERE stage = ? AND key IN ({','.join('?' * len(chunk))})",
+                    (stage, *chunk),
+                ).fetchall()
+                for key, input_hash, output in rows:
+                    if wanted[key] == input_hash:
+                        found[key] = json.loads(output) if output is not None else None
+        count("checkpoint_hits", len(found), stage=stage)
+        return found
+
+    def put_many(self, stage, rows):
+        """rows: iterable of (key, input_hash, output)."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                [(stage, key, input_hash, json.dumps(output), now) for key, input_hash, output in rows],
+            )
+            conn.commit()
+
+    def writer(self, stage, batch_size=CHECKPOINT_BATCH):
+        """Buffered appender: `with store.writer("identify") as w: w.add(key, h, out)`."""
+        return CheckpointWriter(self, stage, batch_size)
+
+    def prune(self, stage, keep_keys):
+        """Drop checkpoints of items that left the dataset."""
+        keep_keys = set(keep_keys)
+        with self._lock:
+            conn = self._connect()
+            stale = [k for (k,) in conn.execute("SELECT key FROM checkpoints WHERE stage = ?", (stage,))
+                     if k not in keep_keys]
+            conn.executemany("DELETE FROM checkpoints WHERE stage = ? AND key = ?", [(stage, k) for k in stale])
+            conn.commit()
+        return len(stale)
+
+    def count(self, stage):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM checkpoints WHERE stage = ?", (stage,)
+            ).fetchone()[0]
+
+    # ---- whole-stage state ----
+    def stage_hash(self, stage):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT input_hash FROM stages WHERE stage = ?", (stage,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_stage_hash(self, stage, input_hash):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?)", (stage, input_hash, time.time()))
+            conn.commit()
+
+    def reset(self, stage=None):
+        """Forget one stage (or everything): the next run recomputes it."""
+        with self._lock:
+            conn = self._connect()
+            if stage is None:
+                conn.execute("DELETE FROM checkpoints")
+                conn.execute("DELETE FROM stages")
+            else:
+                conn.execute("DELETE FROM checkpoints WHERE stage = ?", (stage,))
+                conn.execute("DELETE FROM stages WHERE stage = ?", (stage,))
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class CheckpointWriter:
+    """Collects finished items and commits them every `batch_size` rows."""
+
+    def __init__(self, store, stage, batch_size=CHECKPOINT_BATCH):
+        self.store = store
+        self.stage = stage
+        self.batch_size = max(1, batch_size)
+        self.written = 0
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def add(self, key, input_hash, output):
+        with self._lock:
+            self._rows.append((key, input_hash, output))
+            if len(self._rows) < self.batch_size:
+                return
+            rows, self._rows = self._rows, []
+        self._write(rows)
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if rows:
+            self._write(rows)
+
+    def _write(self, rows):
+        self.store.put_many(self.stage, rows)
+        with self._lock:
+            self.written += len(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # commit what finished, even when the run is interrupted
+        self.flush()
+        return False
+
+
+# %%
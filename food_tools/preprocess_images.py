@@ -0,0 +1,159 @@
+# %%
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from utils_00 import enhance_for_gemini, encode_for_gemini, PREPROCESS_SIZE, GAMMA, WB_STRENGTH
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RAW_DIR = os.path.join(BASE_DIR, "../Images/raw_images")
+PROCESSED_DIR = os.path.join(BASE_DIR, "../Images/processed_images")
+
+# raw path → what its output was produced from: PREPROCESS_VERSION
+# (check="mtime") or the content hash, which includes it (check="hash").
+# Switching modes reprocesses everything once.
+MANIFEST_NAME = ".manifest.json"
+
+# part of every content hash: changing the enhancement invalidates outputs
+PREPROCESS_VERSION = f"{PREPROCESS_SIZE}-{GAMMA}-{WB_STRENGTH}"
+
+
+# ------------------------------
+# Up-to-date checks
+# ------------------------------
+def file_hash(path):
+    h = hashlib.sha1(PREPROCESS_VERSION.encode())
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def output_path(raw_path, out_dir=PROCESSED_DIR):
+    return os.path.join(out_dir, os.path.basename(raw_path))
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def is_up_to_date(raw_path, out_path, check, manifest, digest=None):
+    if not os.path.exists(out_path):
+        return False
+    if check == "hash":
+        return manifest.get(raw_path) == digest
+    # an output made with other enhancement settings is stale, however new
+    if manifest.get(raw_path) != PREPROCESS_VERSION:
+        return False
+    return os.path.getmtime(out_path) >= os.path.getmtime(raw_path)
+
+
+# ------------------------------
+# Worker (runs in a separate process)
+# ------------------------------
+def _init_worker():
+    # one image per process; OpenCV's own threads would oversubscribe cores
+    import cv2
+    cv2.setNumThreads(1)
+
+
+def _preprocess_one(job):
+    import cv2
+
+    raw_path, out_path = job
+    try:
+        img = cv2.imread(raw_path)
+        if img is None:
+            raise ValueError("Image not found.")
+        # these exact bytes are what gets sent to Gemini later
+        jpeg = encode_for_gemini(enhance_for_gemini(img))
+
+        tmp = out_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(jpeg)
+        os.replace(tmp, out_path)
+        return raw_path, out_path, None
+    except Exception as e:
+        return raw_path, None, str(e)
+
+
+# ============================================================
+# Stage: raw images → Images/processed_images/
+# ============================================================
+def preprocess_images(raw_paths, out_dir=PROCESSED_DIR, workers=None, check="mtime"):
+    """
+    Preprocess many images in parallel, skipping outputs that are up to date.
+    check: "mtime" (output newer than input) or "hash" (input content);
+    both also require the PREPROCESS_VERSION recorded in the manifest.
+    Returns raw path → processed path (None when preprocessing failed).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    raw_paths = list(dict.fromkeys(raw_paths))
+    manifest = load_manifest(out_dir)
+
+    results, jobs, digests = {}, [], {}
+    for raw_path in raw_paths:
+        out_path = output_path(raw_path, out_dir)
+        digest = file_hash(raw_path) if check == "hash" else None
+        if is_up_to_date(raw_path, out_path, check, manifest, digest):
+            results[raw_path] = out_path
+        else:
+            jobs.append((raw_path, out_path))
+            digests[raw_path] = digest or PREPROCESS_VERSION
+
+    print(f"Preprocessing: {len(jobs)} to do, {len(results)} up to date")
+    if not jobs:
+        return results
+
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 8))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        for raw_path, out_path, error in tqdm(pool.map(_preprocess_one, jobs, chunksize=chunksize), total=len(jobs)):
+            if error:
+                print("Preprocessing failed:", raw_path, error)
+            else:
+                manifest[raw_path] = digests[raw_path]
+            results[raw_path] = out_path
+
+    save_manifest(out_dir, manifest)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Preprocess raw meal images in parallel")
+    parser.add_argument("raw_dir", nargs="?", default=RAW_DIR)
+    parser.add_argument("--out", default=PROCESSED_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--check", choices=["mtime", "hash"], default="mtime")
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(os.path.join(args.raw_dir, "*.jpg")))
+    results = preprocess_images(paths, args.out, args.workers, args.check)
+    failed = sum(v is None for v in results.values())
+    print(f"Done: {len(results) - failed} processed → {args.out}, {failed} failed")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
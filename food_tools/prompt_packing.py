@@ -0,0 +1,215 @@
+# %%
+"""
+Compact prompt payloads for the weekly report LLM.
+
+The per-user report CSV repeats every ingredient twice (`*_Ingredients` and
+`*_Detail`), with 15-digit floats, and the same dish photo often comes back
+on several days. Packed, a user's week becomes:
+
+    Profile: M, 27 y, 1.68 m, 60 kg, BMI 21.3
+    Dishes (ingredient grams kcal; total kcal):
+    D1: waffle 30g 163; 163
+    ...
+    Day|Breakfast|Lunch|Dinner|Total kcal|Steps|Sleep min|HR|Screen min
+    1|D1|D2|D3|2521|3255|495|74|600
+    ...
+    Weekly stats: ...
+
+Token counts are estimates, not tokenizer counts: the same ~4
+characters/token rule as the rate limiter, so what is printed is what
+the TPM budget is charged.
+"""
+import json
+
+from rate_limiter import estimate_tokens
+
+MEALS = ["Breakfast", "Lunch", "Dinner"]
+
+# linked_dataset column → packed lifestyle column
+LIFESTYLE_COLUMNS = {
+    "Step Count": "Steps",
+    "Sleep Duration (minutes)": "Sleep min",
+    "Heart Rate (BPM)": "HR",
+    "Screen Time (minute)": "Screen min",
+}
+
+
+def count_tokens(text) -> int:
+    """Estimated tokens (~4 characters each), as charged to the TPM budget."""
+    return estimate_tokens(text)
+
+
+def _num(value, digits=0):
+    """Rounded, without a trailing '.0' (163.20000000000002 → '163')."""
+    try:
+        value = round(float(value), digits)
+    except (TypeError, ValueError):
+        return "?"
+    return f"{value:.{digits}f}" if digits and not value.is_integer() else str(int(value))
+
+
+def _detail(raw):
+    if isinstance(raw, list):
+        return raw
+    try:
+        items = json.loads(raw)
+    except Exception:
+        return []
+    return items if isinstance(items, list) else []
+
+
+# ------------------------------
+# Sections
+# ------------------------------
+def pack_profile(first) -> str:
+    return "Profile: {}, {} y, {} m, {} kg, BMI {}".format(
+        first["Gender"], _num(first["Age (years)"]), _num(first["Height (meter)"], 2),
+        _num(first["Weight (kg)"], 1), _num(first["BMI"], 1),
+    )
+
+
+def pack_dishes(report):
+    """
+    Distinct meals (by their ingredient detail) → 'D1'.. ids.
+    Returns (dish lines, {(day, meal): dish id or '-'}).
+    """
+    ids, lines, cells = {}, [], {}
+    for _, row in report.iterrows():
+        for meal in MEALS:
+            items = _detail(row.get(f"{meal}_Detail", "[]"))
+            if not items:
+                cells[(int(row["Day"]), meal)] = "-"
+                continue
+            key = json.dumps(items, sort_keys=True)
+            if key not in ids:
+                ids[key] = f"D{len(ids) + 1}"
+                parts = ", ".join(
+                    f"{item.get('ingredient', '?')} {_num(item.get('grams'))}g {_num(item.get('kcal'))}"
+                    for item in items
+                )
+                lines.append(f"{ids[key]}: {parts}; {_num(row.get(f'{meal}_Kcal'))}")
+            cells[(int(row["Day"]), meal)] = ids[key]
+    return lines, cells
+
+
+def pack_week_table(report, lifestyle, cells, meals=True) -> str:
+    """One row per day: dish ids, daily kcal (meals=False: left out) and the lifestyle metrics."""
+    header = ["Day", *((*MEALS, "Total kcal") if meals else ()),
+              *(LIFESTYLE_COLUMNS.values() if lifestyle is not None else [])]
+    by_day = {int(r["Day"]): r for _, r in lifestyle.iterrows()} if lifestyle is not None else {}
+    kcal_by_day = {int(r["Day"]): r["Daily_Total_Kcal"] for _, r in report.iterrows()} if report is not None else {}
+
+    rows = ["|".join(header)]
+    for day in sorted(set(kcal_by_day) | set(by_day)):
+        row = [str(day)]
+        if meals:
+            row += [cells.get((day, meal), "-") for meal in MEALS]
+            row.append(_num(kcal_by_day[day]) if day in kcal_by_day else "-")
+        if lifestyle is not None:
+            life = by_day.get(day)
+            row += [_num(life[col]) if life is not None else "-" for col in LIFESTYLE_COLUMNS]
+        rows.append("|".join(row))
+    return "\n".join(rows)
+
+
+def _slope(days, values):
+    """Least-squares change per day."""
+    n = len(days)
+    if n < 2:
+        return 0.0
+    mean_d, mean_v = sum(days) / n, sum(values) / n
+    var = sum((d - mean_d) ** 2 for d in days)
+    if var == 0:
+        return 0.0
+    return sum((d - mean_d) * (v - mean_v) for d, v in zip(days, values)) / var
+
+
+def weekly_stats(report, lifestyle=None) -> dict:
+    """Means, ranges, day-over-day trend and meal share of the week."""
+    stats = {}
+    if report is not None and len(report):
+        days = [int(d) for d in report["Day"]]
+        totals = [float(v) for v in report["Daily_Total_Kcal"]]
+        stats["kcal_mean"] = sum(totals) / len(totals)
+        stats["kcal_min"] = min(totals)
+        stats["kcal_max"] = max(totals)
+        stats["kcal_trend_per_day"] = _slope(days, totals)
+        week_total = sum(totals)
+        stats["meal_share_pct"] = {
+            meal: 100.0 * float(report[f"{meal}_Kcal"].sum()) / week_total if week_total else 0.0
+            for meal in MEALS
+        }
+    if lifestyle is not None and len(lifestyle):
+        days = [int(d) for d in lifestyle["Day"]]
+        for col, name in LIFESTYLE_COLUMNS.items():
+            values = [float(v) for v in lifestyle[col]]
+            stats[f"{name}_mean"] = sum(values) / len(values)
+            stats[f"{name}_trend_per_day"] = _slope(days, values)
+    return stats
+
+
+def pack_stats(stats) -> str:
+    if not stats:
+        return "Weekly stats: none"
+    parts = []
+    if "kcal_mean" in stats:
+        parts.append(
+            f"kcal/day mean {_num(stats['kcal_mean'])}, range {_num(stats['kcal_min'])}-{_num(stats['kcal_max'])}, "
+            f"trend {stats['kcal_trend_per_day']:+.0f}/day"
+        )
+        parts.append("meal share " + " ".join(
+            f"{meal[0]} {_num(share)}%" for meal, share in stats["meal_share_pct"].items()
+        ))
+    for name in LIFESTYLE_COLUMNS.values():
+        if f"{name}_mean" in stats:
+            parts.append(f"{name} mean {_num(stats[f'{name}_mean'])}, trend {stats[f'{name}_trend_per_day']:+.0f}/day")
+    return "Weekly stats: " + "; ".join(parts)
+
+
+# ============================================================
+# Whole payload
+# ============================================================
+def pack_weekly_kcal(report) -> str:
+    """Calorie part only (dishes + per-day meals and totals), e.g. for the agent's tool."""
+    if report is None or report.empty:
+        return ""
+    report = report.sort_values("Day")
+    dish_lines, cells = pack_dishes(report)
+    return "\n".join([
+        "Dishes (ingredient grams kcal; total kcal):",
+        *dish_lines,
+        pack_week_table(report, None, cells),
+        pack_stats(weekly_stats(report)),
+    ])
+
+
+def pack_user_week(user_rows, report, kcal_from_tool=False) -> str:
+    """
+    user_rows: the user's linked_dataset rows; report: their per-day
+    kcal report (None/empty when nutrition estimation has not run).
+    kcal_from_tool: the model loads dishes and kcal itself (agent mode),
+    so only the profile and lifestyle are packed.
+    """
+    lifestyle = user_rows.sort_values("Day")
+    lines = [pack_profile(lifestyle.iloc[0])]
+
+    cells = {}
+    if kcal_from_tool:
+        lines.append(pack_week_table(None, lifestyle, cells, meals=False))
+        lines.append(pack_stats(weekly_stats(None, lifestyle)))
+        return "\n".join(lines)
+
+    if report is None or report.empty:
+        report = None
+        lines.append("Dishes: no calorie report available")
+    else:
+        report = report.sort_values("Day")
+        dish_lines, cells = pack_dishes(report)
+        lines += ["Dishes (ingredient grams kcal; total kcal):", *dish_lines]
+
+    lines.append(pack_week_table(report, lifestyle, cells))
+    lines.append(pack_stats(weekly_stats(report, lifestyle)))
+    return "\n".join(lines)
+
+
+# %%
@@ -0,0 +1,231 @@
+# %%
+import os
+import re
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from instrumentation import count, observe
+
+# --------------------------
+# Config (override through .env to match your Gemini tier)
+# --------------------------
+# the offline fake chat model (LLM_BACKEND=fake) has no quota: unlimited
+# unless GEMINI_RPM / GEMINI_TPM are set. 0 means no limit.
+_FAKE_LLM = os.getenv("LLM_BACKEND", "").lower() == "fake"
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "0" if _FAKE_LLM else "10"))        # free tier: 10 req/min
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "0" if _FAKE_LLM else "250000"))    # input + output tokens/min
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "4"))
+
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2.0       # first 429 backoff without Retry-After, doubled each time
+MAX_BACKOFF_SECONDS = 120.0
+
+
+def estimate_tokens(text) -> int:
+    """Rough token count (~4 characters per token)."""
+    return max(1, len(str(text)) // 4)
+
+
+# ============================================================
+# Token bucket
+# ============================================================
+class TokenBucket:
+    """
+    `rate` units per minute, bursts up to `capacity`; rate 0 = unlimited,
+    apart from block_for(). Thread-safe; waiting happens outside the lock.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate_per_minute / 60.0))
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount=1.0):
+        """Take `amount` now (may go negative) and return how long to wait for it."""
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            wait_s = max(0.0, self._blocked_until - now)
+            if self.rate:
+                self._refill(now)
+                self._level -= amount
+                wait_s = max(wait_s, -self._level / self.rate)
+        return wait_s
+
+    def block_for(self, seconds):
+        """Nobody gets through for `seconds` (server asked us to back off)."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Requests-per-minute + tokens-per-minute budget shared by every caller (0 = no limit)."""
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm, capacity=tpm) if tpm else None
+
+        self.waited_seconds = 0.0
+        self.throttled = 0
+        self._stats_lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """Block until one request with ~`tokens` tokens fits the budget."""
+        wait_s = self.requests.reserve(1)
+        if self.tokens is not None and tokens:
+            wait_s = max(wait_s, self.tokens.reserve(tokens))
+        if wait_s > 0:
+            with self._stats_lock:
+                self.waited_seconds += wait_s
+            observe("rate_limit_wait", wait_s)
+            time.sleep(wait_s)
+        return wait_s
+
+    def penalize(self, seconds):
+        """Pause everyone after a 429."""
+        with self._stats_lock:
+            self.throttled += 1
+        count("rate_limited", client="llm")
+        self.requests.block_for(seconds)
+
+
+# ------------------------------
+# 429 detection
+# ------------------------------
+_RETRY_IN = re.compile(r"retry(?:[ _-]?delay)?[^0-9]{0,20}([0-9]+(?:\.[0-9]+)?)\s*s", re.IGNORECASE)
+
+
+def is_rate_limited(exc) -> bool:
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    response = getattr(exc, "response", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None)
+    if status == 429 or type(exc).__name__ in ("ResourceExhausted", "RateLimitError"):
+        return True
+    text = str(exc)
+    return "429" in text or "RESOURCE_EXHAUSTED" in text or "rate limit" in text.lower()
+
+
+def retry_after_seconds(exc):
+    """Server-requested delay: Retry-After header, or 'retry in 12.3s' style text."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    match = _RETRY_IN.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+# ============================================================
+# Scheduler: several requests in flight, within the budget
+# ============================================================
+class RequestScheduler:
+    """
+    Runs calls on up to `max_in_flight` threads.
+    Each call first takes its share of the limiter (tokens=None skips this,
+    for callees that rate-limit themselves, e.g. via LimiterCallback).
+    429s are retried after Retry-After or exponential backoff, and pause
+    the shared limiter so other threads back off too.
+    """
+
+    def __init__(self, limiter, max_in_flight=GEMINI_MAX_IN_FLIGHT, max_retries=MAX_RETRIES,
+                 backoff=BACKOFF_SECONDS):
+        self.limiter = limiter
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="llm")
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            if tokens is not None:
+                self.limiter.acquire(tokens)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not is_rate_limited(e):
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = self.backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+                delay = min(delay, MAX_BACKOFF_SECONDS)
+                print(f"Rate limited, retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                count("retries", client="llm")
+                self.limiter.penalize(delay)
+
+    def submit(self, fn, *args, tokens=0, **kwargs):
+        return self._executor.submit(self.call, fn, *args, tokens=tokens, **kwargs)
+
+    def imap_unordered(self, fn, items, tokens=0):
+        """
+        fn(item) for every item, at most 2 × max_in_flight queued at a time.
+        tokens is a number, or a function of the item (e.g. per batch size).
+        Yields (item, result, error) as calls finish.
+        """
+        pending = {}
+        items = iter(items)
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) < 2 * self.max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                share = tokens(item) if callable(tokens) else tokens
+                pending[self.submit(fn, item, tokens=share)] = item
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                item = pending.pop(fut)
+                try:
+                    yield item, fut.result(), None
+                except Exception as e:
+                    yield item, None, e
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+# ------------------------------
+# LangChain hook: throttle every LLM call an agent makes
+# ------------------------------
+def limiter_callback(limiter, output_tokens=1024):
+    """
+    Callback handler that takes limiter budget before each chat model call.
+    Use for chains/agents that make several LLM calls per invocation.
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class LimiterCallback(BaseCallbackHandler):
+        run_inline = True   # block the calling thread, not a callback worker
+
+        def on_chat_model_start(self, serialized, messages, **kwargs):
+            prompt_tokens = sum(estimate_tokens(m.content) for batch in messages for m in batch)
+            limiter.acquire(prompt_tokens + output_tokens)
+
+    return LimiterCallback()
+
+
+# one budget per API key: shared by the vision and report stages
+GEMINI_LIMITER = RateLimiter()
+
+
+# %%
@@ -0,0 +1,258 @@
+# %%
+"""
+Manual review queue for images the vision model could not answer.
+
+Batch runs never wait for a person: an image whose answer stays
+unparseable after the strict JSON retry is queued here and the run goes on.
+Work the queue whenever convenient:
+
+    python food_tools/review_queue.py list
+    python food_tools/review_queue.py review          # type the ingredients
+    python food_tools/review_queue.py merge           # → Data/image_ingredients.csv
+
+Answers are kept in the queue after merging, so a later recognition run
+reuses them instead of asking the model again.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from pipeline_state import CACHE_DIR, run_output_path
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_ING = run_output_path(os.path.join(BASE_DIR, "../Data/image_ingredients.csv"))
+
+REVIEW_QUEUE_PATH = os.getenv("REVIEW_QUEUE_PATH", os.path.join(CACHE_DIR, "review_queue.sqlite"))
+
+PENDING, RESOLVED, MERGED, DISMISSED = "pending", "resolved", "merged", "dismissed"
+
+
+class ReviewQueue:
+    """
+    image_id (raw image path) → why it failed, the model's raw answer, and
+    the reviewed ingredient list once someone entered it. Thread-safe.
+    """
+
+    def __init__(self, path=REVIEW_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS review (
+                    image_id   TEXT PRIMARY KEY,
+                    status     TEXT NOT NULL,
+                    reason     TEXT,
+                    raw_answer TEXT,
+                    answer     TEXT,
+                    attempts   INTEGER NOT NULL DEFAULT 1,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    # ---- batch side ----
+    def add(self, image_id, reason, raw_answer=None):
+        """
+        Queue an image, or count another failed attempt on a pending one.
+        Reviewed answers and dismissals are final and left as they are.
+        """
+        if not image_id:
+            raise ValueError("image_id is required (raw image path or content hash)")
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                """
+                INSERT INTO review (image_id, status, reason, raw_answer, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(image_id) DO UPDATE SET
+                    reason = excluded.reason,
+                    raw_answer = excluded.raw_answer,
+                    attempts = attempts + 1,
+                    updated_at = excluded.updated_at
+                WHERE status = ?
+                """,
+                (image_id, PENDING, reason, raw_answer, now, now, PENDING),
+            )
+            conn.commit()
+
+    def answers(self, image_ids=None):
+        """image_id → reviewed ingredient list (resolved or merged entries)."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT image_id, answer FROM review WHERE status IN (?, ?)", (RESOLVED, MERGED)
+            ).fetchall()
+        found = {image_id: json.loads(answer) for image_id, answer in rows}
+        if image_ids is None:
+            return found
+        return {image_id: found[image_id] for image_id in image_ids if image_id in found}
+
+    def dismissed(self, image_ids=None):
+        """image_ids someone dismissed: final, not sent to the model again."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT image_id FROM review WHERE status = ?", (DISMISSED,)
+            ).fetchall()
+        found = {image_id for image_id, in rows}
+        if image_ids is None:
+            return found
+        return {image_id for image_id in image_ids if image_id in found}
+
+    def discard(self, image_id):
+        """The model answered after all: drop a still-pending entry."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM review WHERE image_id = ? AND status = ?", (image_id, PENDING))
+            conn.commit()
+
+    # ---- review side ----
+    def items(self, status=PENDING):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT image_id, reason, raw_answer, attempts, answer FROM review "
+                "WHERE status = ? ORDER BY created_at",
+                (status,),
+            ).fetchall()
+        return [
+            {"image_id": r[0], "reason": r[1], "raw_answer": r[2], "attempts": r[3],
+             "answer": json.loads(r[4]) if r[4] else None}
+            for r in rows
+        ]
+
+    def resolve(self, image_id, ingredients):
+        self._set_status(image_id, RESOLVED, json.dumps(ingredients))
+
+    def dismiss(self, image_id):
+        self._set_status(image_id, DISMISSED)
+
+    def mark_merged(self, image_ids):
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "UPDATE review SET status = ?, updated_at = ? WHERE image_id = ? AND status = ?",
+                [(MERGED, time.time(), image_id, RESOLVED) for image_id in image_ids],
+            )
+            conn.commit()
+
+    def _set_status(self, image_id, status, answer=None):
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE review SET status = ?, answer = COALESCE(?, answer), updated_at = ? WHERE image_id = ?",
+                (status, answer, time.time(), image_id),
+            )
+            conn.commit()
+
+    def counts(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT status, COUNT(*) FROM review GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# ============================================================
+# Merge reviewed answers into image_ingredients.csv
+# ============================================================
+def merge_answers(queue, ingredients_path=DATA_ING):
+    """
+    Write resolved answers into the ingredients_json column of matching
+    rows (by raw_image_path). Returns the number of rows updated.
+    """
+    import pandas as pd
+
+    resolved = {item["image_id"]: item["answer"] for item in queue.items(RESOLVED)}
+    if not resolved or not os.path.exists(ingredients_path):
+        return 0
+
+    df = pd.read_csv(ingredients_path)
+    hit = df["raw_image_path"].isin(resolved.keys())
+    df.loc[hit, "ingredients_json"] = df.loc[hit, "raw_image_path"].map(lambda p: json.dumps(resolved[p]))
+
+    tmp = ingredients_path + ".tmp"
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, ingredients_path)
+
+    # answers for images not in the file yet stay resolved; the next
+    # recognition run picks them up from the queue
+    queue.mark_merged(set(df.loc[hit, "raw_image_path"]))
+    return int(hit.sum())
+
+
+def review(queue):
+    """Interactive pass over the pending images."""
+    from utils_00 import manual_input
+
+    pending = queue.items(PENDING)
+    print(f"{len(pending)} images to review")
+    done = 0
+    for item in pending:
+        print(f"\n{item['image_id']}  ({item['reason']}, {item['attempts']} attempt(s))")
+        if item["raw_answer"]:
+            print("Model said:", item["raw_answer"][:300])
+
+        choice = input("[e]nter ingredients, [s]kip, [d]ismiss (default e): ").strip().lower() or "e"
+        if choice.startswith("d"):
+            queue.dismiss(item["image_id"])
+            continue
+        if choice.startswith("s"):
+            continue
+
+        ingredients = manual_input(item["image_id"])
+        if ingredients:
+            queue.resolve(item["image_id"], ingredients)
+            done += 1
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Work the manual review queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="show pending images")
+    sub.add_parser("review", help="enter ingredients for pending images")
+    p_merge = sub.add_parser("merge", help="write reviewed answers into image_ingredients.csv")
+    p_merge.add_argument("--ingredients", default=DATA_ING)
+    args = parser.parse_args(argv)
+
+    # review imports utils_00 as a sibling
+    sys.path.insert(0, BASE_DIR)
+
+    queue = ReviewQueue()
+    try:
+        if args.command == "list":
+            for item in queue.items(PENDING):
+                print(f"{item['image_id']}\t{item['reason']}\t{item['attempts']}")
+            print("Queue:", queue.counts())
+        elif args.command == "review":
+            print(f"Reviewed: {review(queue)}. Run `merge` to update image_ingredients.csv")
+        else:
+            print(f"Merged {merge_answers(queue, args.ingredients)} rows → {args.ingredients}")
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
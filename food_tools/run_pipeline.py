@@ -0,0 +1,223 @@
+# %%
+"""
+Incremental pipeline runner: 01 → 02 → 03 → 04.
+
+    python food_tools/run_pipeline.py                # run what changed
+    python food_tools/run_pipeline.py --only nutrition --force
+    python food_tools/run_pipeline.py --dry-run
+    python food_tools/run_pipeline.py --reset identify
+
+A stage is skipped when the hash of its inputs (data files, image folder,
+stage script, utils_00.py) matches the last successful run and its outputs
+exist. Stages that do run resume from per-item checkpoints in
+Data/cache/pipeline_state.sqlite, so only new or changed images and users
+are recomputed. --force also regenerates the weekly reports, which
+otherwise keep every report whose prompt is unchanged.
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+from dataclasses import dataclass, field
+from graphlib import TopologicalSorter
+from dotenv import load_dotenv
+
+load_dotenv()   # before the local modules below read their config
+
+from instrumentation import span
+from ingredient_normalizer import INGREDIENT_ALIAS_PATH
+from pipeline_state import CheckpointStore, hash_file, hash_obj, hash_paths, run_output_path
+from review_queue import ReviewQueue
+from storage import STORAGE_FORMAT, read_table, table_path
+from utils_00 import LLM_BACKEND, USDA_BACKEND, USDA_LOOKUP_MODE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, "../Data")
+
+DATASET_PATH = os.path.join(DATA_DIR, "Smart Healthcare - Daily Lifestyle Dataset (Wearable device).csv")
+RAW_DIR = os.path.join(BASE_DIR, "../Images/raw_images")
+# stage outputs (under Data/fake_run/ on the fake backends, see pipeline_state.py)
+LINKED_PATH = table_path(run_output_path(os.path.join(DATA_DIR, "linked_dataset.csv")))
+INGREDIENTS_PATH = run_output_path(os.path.join(DATA_DIR, "image_ingredients.csv"))
+USER_REPORT_DIR = run_output_path(os.path.join(DATA_DIR, "user_reports.parquet") if STORAGE_FORMAT == "parquet"
+                                  else os.path.join(DATA_DIR, "user_reports"))
+WEEKLY_REPORT_DIR = run_output_path(os.path.join(BASE_DIR, "../weekly_ai_reports"))
+
+# shared code: a change here invalidates every stage
+# (instrumentation.py only observes, it is left out)
+COMMON_CODE = [
+    "utils_00.py", "storage.py", "pipeline_state.py", "preprocess_images.py",
+    "ingredient_normalizer.py", "usda_client.py", "usda_cache.py", "fdc_local.py",
+    "vision_cache.py", "review_queue.py", "rate_limiter.py", "llm_clients.py",
+    "prompt_packing.py", "fake_backends.py",
+]
+
+
+def unanswered_images(ingredients_path=None, queue=None):
+    """
+    Images left without ingredients (failed, or waiting in the review
+    queue). Images dismissed in review are final and do not count.
+    """
+    ingredients_path = ingredients_path or INGREDIENTS_PATH
+    if not os.path.exists(ingredients_path):
+        return 0
+    df = read_table(ingredients_path, columns=["raw_image_path", "ingredients_json"], nested="json")
+    empty = set(df.loc[df["ingredients_json"].fillna("[]") == "[]", "raw_image_path"])
+    if not empty:
+        return 0
+    own_queue = queue is None
+    queue = queue or ReviewQueue()
+    try:
+        return len(empty - queue.dismissed(empty))
+    finally:
+        if own_queue:
+            queue.close()
+
+
+@dataclass
+class Stage:
+    script: str
+    inputs: list
+    outputs: list
+    deps: list = field(default_factory=list)
+    # number of items the last run left unfinished: while > 0 the stage
+    # is not recorded as done, so the next run looks at them again
+    unfinished: object = None
+    # main() takes force=True to redo items its own checkpoints would skip
+    takes_force: bool = False
+
+
+# ============================================================
+# Dependency graph
+# ============================================================
+STAGES = {
+    "link": Stage(
+        script="data_preprocessing_01.py",
+        inputs=[DATASET_PATH, RAW_DIR],
+        outputs=[LINKED_PATH],
+    ),
+    "identify": Stage(
+        script="food_identification_02.py",
+        inputs=[LINKED_PATH, RAW_DIR],
+        outputs=[INGREDIENTS_PATH],
+        deps=["link"],
+        unfinished=unanswered_images,
+    ),
+    "nutrition": Stage(
+        script="nutrition_estimation_03.py",
+        inputs=[LINKED_PATH, INGREDIENTS_PATH, INGREDIENT_ALIAS_PATH],
+        outputs=[USER_REPORT_DIR],
+        deps=["identify"],
+    ),
+    "reports": Stage(
+        script="langchain_agent_analysis_04.py",
+        inputs=[LINKED_PATH, USER_REPORT_DIR],
+        outputs=[WEEKLY_REPORT_DIR],
+        deps=["nutrition"],
+        takes_force=True,
+    ),
+}
+
+
+def stage_order(stages=STAGES):
+    return list(TopologicalSorter({name: s.deps for name, s in stages.items()}).static_order())
+
+
+def stage_config():
+    """Settings that change stage outputs without changing any file."""
+    return {"llm_backend": LLM_BACKEND, "usda_backend": USDA_BACKEND, "usda_lookup_mode": USDA_LOOKUP_MODE}
+
+
+def stage_input_hash(stage):
+    code = [hash_file(os.path.join(BASE_DIR, f)) for f in [stage.script, *COMMON_CODE]]
+    return hash_obj([hash_paths(stage.inputs), code, stage_config()])
+
+
+def outputs_exist(stage):
+    return all(os.path.exists(p) for p in stage.outputs)
+
+
+def run_stage(name, stage, force=False):
+    print(f"\n######## {name}: {stage.script} ########")
+    start = time.perf_counter()
+    # stage modules have no import-time side effects: import, then call main()
+    module = importlib.import_module(os.path.splitext(stage.script)[0])
+    with span("stage", stage=name):
+        if force and stage.takes_force:
+            module.main(force=True)
+        else:
+            module.main()
+    print(f"######## {name} finished in {time.perf_counter() - start:.1f}s ########")
+
+
+# ============================================================
+# Runner
+# ============================================================
+def run_pipeline(only=None, force=False, dry_run=False, store=None, stages=None):
+    """
+    Run stages in dependency order, skipping those whose inputs did not
+    change. Input hashes are taken right before a stage runs, so a stage
+    sees the outputs its upstream stages just wrote.
+    """
+    store = store or CheckpointStore()
+    stages = stages or STAGES
+    ran = []
+
+    for name in stage_order(stages):
+        if only and name not in only:
+            continue
+        stage = stages[name]
+
+        input_hash = stage_input_hash(stage)
+        if not force and outputs_exist(stage) and store.stage_hash(name) == input_hash:
+            print(f"{name}: up to date, skipped")
+            continue
+
+        if dry_run:
+            print(f"{name}: would run")
+            continue
+
+        run_stage(name, stage, force)
+        ran.append(name)
+
+        unfinished = stage.unfinished() if stage.unfinished else 0
+        if unfinished:
+            print(f"{name}: {unfinished} items unfinished, the stage runs again next time")
+            continue
+        # recorded only after success: a crash reruns the stage, which
+        # then resumes from its per-item checkpoints
+        store.set_stage_hash(name, input_hash)
+
+    return ran
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the pipeline incrementally")
+    parser.add_argument("--only", nargs="+", choices=list(STAGES), help="run just these stages")
+    parser.add_argument("--force", action="store_true", help="run stages even if their inputs are unchanged")
+    parser.add_argument("--dry-run", action="store_true", help="show which stages would run")
+    parser.add_argument("--reset", nargs="*", choices=["identify", "kcal", "user_reports", "weekly_reports", *STAGES],
+                        help="forget checkpoints (all when no stage is given) and exit")
+    args = parser.parse_args(argv)
+
+    # stage scripts import their siblings (from utils_00 import *)
+    sys.path.insert(0, BASE_DIR)
+
+    store = CheckpointStore()
+    if args.reset is not None:
+        for stage in args.reset or [None]:
+            store.reset(stage)
+        print("Checkpoints reset:", ", ".join(args.reset) or "all")
+        return 0
+
+    ran = run_pipeline(only=args.only, force=args.force, dry_run=args.dry_run, store=store)
+    print("\nStages run:", ", ".join(ran) or "none")
+    store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
@@ -0,0 +1,391 @@
+# %%
+"""
+Table storage shared by the pipeline stages: CSV (default) or Parquet.
+
+    STORAGE_FORMAT=parquet python food_tools/run_pipeline.py
+    python food_tools/storage.py convert Data/linked_dataset.csv
+    python food_tools/storage.py export Data/user_reports.parquet
+
+Parquet tables are typed: string columns (image paths, meal codes, gender…)
+are dictionary-encoded, and `*_Ingredients` / `*_Detail` JSON strings are
+stored as nested list<struct> columns. Readers pass `columns=` (projection)
+and `filters=` (predicate pushdown, e.g. one user's rows) straight to
+pyarrow; the same arguments work on CSV, just without the savings.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import pandas as pd
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+STORAGE_FORMAT = os.getenv("STORAGE_FORMAT", "csv").lower()   # "csv" | "parquet"
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+PARQUET_ROW_GROUP = 64 * 1024   # rows; small enough for ID filters to skip most groups
+
+EXTENSIONS = {"csv": ".csv", "parquet": ".parquet"}
+
+# JSON-in-CSV columns stored as list<struct> in Parquet
+NESTED_SUFFIXES = ("_Ingredients", "_Detail")
+
+
+def _arrow_types():
+    import pyarrow as pa
+
+    ingredient = pa.struct([("ingredient", pa.string()), ("grams", pa.float64())])
+    detail = pa.struct([
+        ("ingredient", pa.string()),
+        ("normalized", pa.string()),
+        ("grams", pa.float64()),
+        ("kcal", pa.float64()),
+    ])
+    return {"_Ingredients": pa.list_(ingredient), "_Detail": pa.list_(detail)}
+
+
+# ------------------------------
+# Paths
+# ------------------------------
+def table_path(path, fmt=None) -> str:
+    """'Data/linked_dataset.csv' → 'Data/linked_dataset.parquet' when fmt is parquet."""
+    fmt = fmt or STORAGE_FORMAT
+    base, ext = os.path.splitext(path)
+    if ext not in EXTENSIONS.values():
+        base = path
+    return base + EXTENSIONS[fmt]
+
+
+def resolve_path(path, fmt=None) -> str:
+    """The file to read: the configured format if present, else whichever exists."""
+    preferred = table_path(path, fmt)
+    if os.path.exists(preferred) or fmt:
+        return preferred
+    for other in EXTENSIONS:
+        candidate = table_path(path, other)
+        if os.path.exists(candidate):
+            return candidate
+    return preferred
+
+
+def _format_of(path):
+    return "parquet" if path.endswith(EXTENSIONS["parquet"]) else "csv"
+
+
+def _is_nested(column):
+    return str(column).endswith(NESTED_SUFFIXES)
+
+
+# ------------------------------
+# Nested columns: JSON strings ⇄ lists of dicts
+# ------------------------------
+def _parse_nested(value):
+    if isinstance(value, list):
+        return value
+    try:
+        items = json.loads(value)
+    except Exception:
+        return []
+    return items if isinstance(items, list) else []
+
+
+def _json_grams(value):
+    # grams are float64 in Parquet; the model answers whole grams, so 30.0 goes back out as 30
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _to_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_str(value):
+    return None if value is None else str(value)
+
+
+def _dump_nested(items):
+    if items is None:
+        return "[]"
+    return json.dumps([
+        {k: _json_grams(v) if k == "grams" else v for k, v in item.items()}
+        for item in items
+    ])
+
+
+# ============================================================
+# Write
+# ============================================================
+def write_table(df, path, fmt=None, sort_by=None) -> str:
+    """
+    Write df as CSV or Parquet (path extension is replaced to match fmt).
+    sort_by clusters rows (e.g. by ID) so row-group statistics make
+    filters cheap. Returns the written path.
+    """
+    fmt = fmt or STORAGE_FORMAT
+    out = table_path(path, fmt)
+    if sort_by:
+        df = df.sort_values(sort_by, kind="stable")
+
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    tmp = out + ".tmp"
+    if fmt == "csv":
+        df = df.copy()
+        for col in df.columns:
+            if _is_nested(col) and df[col].map(lambda v: isinstance(v, list)).any():
+                df[col] = df[col].map(_dump_nested)
+        df.to_csv(tmp, index=False)
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(
+            to_arrow(df),
+            tmp,
+            compression=PARQUET_COMPRESSION,
+            row_group_size=PARQUET_ROW_GROUP,
+            use_dictionary=True,
+            write_statistics=True,
+        )
+    os.replace(tmp, out)
+    return out
+
+
+class TableWriter:
+    """
+    Streams DataFrame chunks into one CSV or Parquet table, for inputs
+    larger than memory. Every chunk must have the same columns; Parquet
+    chunks are cast to the schema of the first one.
+    """
+
+    def __init__(self, path, fmt=None):
+        self.fmt = fmt or STORAGE_FORMAT
+        self.path = table_path(path, self.fmt)
+        self.rows = 0
+        self._tmp = self.path + ".tmp"
+        self._parquet = None
+        self._first = True
+
+    def write(self, df):
+        if self._first:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if self.fmt == "csv":
+            df.to_csv(self._tmp, index=False, mode="w" if self._first else "a", header=self._first)
+        else:
+            import pyarrow.parquet as pq
+            table = to_arrow(df)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self._tmp, table.schema, compression=PARQUET_COMPRESSION,
+                                                 use_dictionary=True, write_statistics=True)
+            else:
+                table = table.cast(self._parquet.schema)
+            self._parquet.write_table(table, row_group_size=PARQUET_ROW_GROUP)
+        self._first = False
+        self.rows += len(df)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if os.path.exists(self._tmp):
+            os.replace(self._tmp, self.path)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the previous table; drop the partial one
+            if self._parquet is not None:
+                self._parquet.close()
+            if os.path.exists(self._tmp):
+                os.remove(self._tmp)
+        return False
+
+
+def to_arrow(df):
+    """pandas → Arrow table with dictionary strings and list<struct> ingredient columns."""
+    import pyarrow as pa
+
+    nested_types = _arrow_types()
+    arrays, names = [], []
+    for col in df.columns:
+        values = df[col]
+        suffix = next((s for s in NESTED_SUFFIXES if str(col).endswith(s)), None)
+        if suffix:
+            list_type = nested_types[suffix]
+            fields = [(f.name, pa.types.is_floating(f.type)) for f in list_type.value_type]
+            items = [
+                [
+                    {name: _to_float(item.get(name)) if numeric else _to_str(item.get(name))
+                     for name, numeric in fields}
+                    for item in _parse_nested(v) if isinstance(item, dict)
+                ]
+                for v in values
+            ]
+            array = pa.array(items, type=list_type)
+        elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            array = pa.array(values, from_pandas=True)
+        elif pd.api.types.infer_dtype(values, skipna=True) in ("floating", "integer", "mixed-integer-float"):
+            # numbers in an object column (e.g. after a pivot)
+            array = pa.array(pd.to_numeric(values), from_pandas=True)
+        else:
+            # paths, meal codes, categories: few distinct values, many repeats
+            array = pa.array(values.astype(object).where(values.notna(), None), type=pa.string(),
+                             from_pandas=True).dictionary_encode()
+        arrays.append(array)
+        names.append(str(col))
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+# ============================================================
+# Read
+# ============================================================
+def read_table(path, columns=None, filters=None, fmt=None, nested="python"):
+    """
+    Load a table as a DataFrame.
+    columns: only these columns are read.
+    filters: [(column, op, value), ...], ANDed; ops ==, !=, <, <=, >, >=, in.
+    nested:  "python" → ingredient columns as lists of dicts,
+             "json"   → JSON strings, like the CSV layout.
+    """
+    src = resolve_path(path, fmt)
+    filters = list(filters or [])
+
+    if _format_of(src) == "parquet":
+        import pyarrow.parquet as pq
+        read_columns = None
+        if columns is not None:
+            # filter columns must be read too; they are dropped afterwards
+            read_columns = list(dict.fromkeys([*columns, *(f[0] for f in filters)]))
+        table = pq.read_table(src, columns=read_columns, filters=_coerce_filters(pq.read_schema(src), filters) or None)
+        df = table.to_pandas()
+        for col in df.columns:
+            if _is_nested(col):
+                df[col] = [list(v) if v is not None else [] for v in df[col]]
+                if nested == "json":
+                    df[col] = df[col].map(_dump_nested)
+    else:
+        usecols = None
+        if columns is not None:
+            usecols = list(dict.fromkeys([*columns, *(f[0] for f in filters)]))
+        df = pd.read_csv(src, usecols=usecols)
+        if filters:
+            df = df[_filter_mask(df, filters)].reset_index(drop=True)
+        if nested == "python":
+            for col in df.columns:
+                if _is_nested(col):
+                    df[col] = df[col].map(_parse_nested)
+
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def iter_table(path, columns=None, chunk_rows=10_000, fmt=None):
+    """
+    Read a table chunk by chunk (DataFrames of at most chunk_rows rows), so
+    memory does not grow with the file. Nested columns come back as stored
+    (JSON strings for CSV).
+    """
+    src = resolve_path(path, fmt)
+    if _format_of(src) == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(src).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(src, usecols=columns, chunksize=chunk_rows)
+
+
+def _coerce_filters(schema, filters):
+    """Cast filter values to the column type ('7' matches an int64 ID)."""
+    import pyarrow as pa
+
+    coerced = []
+    for col, op, value in filters:
+        field = schema.field(col).type
+        if pa.types.is_dictionary(field):
+            field = field.value_type
+        cast = str if pa.types.is_string(field) else (float if pa.types.is_floating(field) else
+                                                     int if pa.types.is_integer(field) else None)
+        if cast is not None:
+            value = [cast(v) for v in value] if op == "in" else cast(value)
+        coerced.append((col, op, value))
+    return coerced
+
+
+def _filter_mask(df, filters):
+    ops = {
+        "==": lambda s, v: s == v, "=": lambda s, v: s == v, "!=": lambda s, v: s != v,
+        "<": lambda s, v: s < v, "<=": lambda s, v: s <= v,
+        ">": lambda s, v: s > v, ">=": lambda s, v: s >= v,
+        "in": lambda s, v: s.isin(v),
+    }
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        series = df[col]
+        if op == "in":
+            value = [_cast_like(series, v) for v in value]
+        else:
+            value = _cast_like(series, value)
+        mask &= ops[op](series, value)
+    return mask
+
+
+def _cast_like(series, value):
+    if pd.api.types.is_integer_dtype(series):
+        return int(value)
+    if pd.api.types.is_float_dtype(series):
+        return float(value)
+    return value
+
+
+# ------------------------------
+# Conversion / export
+# ------------------------------
+def convert(path, fmt, sort_by=None) -> str:
+    """Rewrite a table in another format (CSV export stays one call away)."""
+    df = read_table(path, fmt=_format_of(path))
+    return write_table(df, path, fmt=fmt, sort_by=sort_by)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert pipeline tables between CSV and Parquet")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_convert = sub.add_parser("convert", help="CSV → Parquet, with load-time and size comparison")
+    p_convert.add_argument("path")
+    p_convert.add_argument("--sort-by", nargs="+", default=None)
+
+    p_export = sub.add_parser("export", help="Parquet → CSV (nested columns as JSON strings)")
+    p_export.add_argument("path")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        print("Exported:", convert(args.path, "csv"))
+        return 0
+
+    src = table_path(args.path, "csv")
+    out = convert(src, "parquet", sort_by=args.sort_by)
+
+    timings = {}
+    for name, p in (("csv", src), ("parquet", out)):
+        start = time.perf_counter()
+        read_table(p, fmt=name)
+        timings[name] = (time.perf_counter() - start) * 1000
+    print(f"{'':8} {'MiB':>9} {'load ms':>9}")
+    for name, p in (("csv", src), ("parquet", out)):
+        print(f"{name:8} {os.path.getsize(p) / 2**20:9.3f} {timings[name]:9.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
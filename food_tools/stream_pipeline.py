@@ -0,0 +1,409 @@
+# %%
+"""
+Streaming mode: raw meal images → per-meal kcal, image by image.
+
+    python food_tools/stream_pipeline.py
+    python food_tools/stream_pipeline.py --queue-size 8 --out Data/meal_kcal_stream.csv
+
+    linked_dataset (read in chunks)
+      → preprocess  (CPU, STREAM_PREPROCESS_WORKERS threads)
+      → identify    (Gemini, GEMINI_MAX_IN_FLIGHT threads, shared RPM/TPM budget)
+      → kcal        (normalize + USDA, STREAM_KCAL_WORKERS threads)
+      → one CSV row per (user, day, meal), written as each image finishes
+
+Stages are thread pools joined by bounded queues. A full queue blocks the
+stage feeding it (backpressure), so while Gemini is the bottleneck the
+preprocessing runs only a queue ahead of it instead of over the whole
+dataset, and CPU work, Gemini calls and USDA lookups overlap. Memory
+holds a few queues of images, at most STREAM_MAX_PENDING_MEALS meals
+waiting for their image and the kcal of the STREAM_DONE_CACHE most recent
+images, not the dataset. A meal on an image that fell out of that cache
+sends the image through the stages again, answered from the checkpoints.
+
+Results go into the same `identify` / `kcal` checkpoints as the batch
+stages, so a later run_pipeline.py only assembles its tables from them.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from utils_00 import (
+    REVIEW_QUEUE, VISION_CACHE,
+    compute_kcal, encode_for_gemini, identify_food_with_gemini, llm_stats, normalize_ingredient,
+    preprocess_for_gemini, usda_search_many, vision_cache_lookup,
+)
+from food_identification_02 import CHECKPOINT_STAGE as IDENTIFY_STAGE, VISION_REQUEST_TOKENS, identify_input_hash
+from nutrition_estimation_03 import KCAL_STAGE, MEAL_PATH_COLUMNS, kcal_input_hash
+from preprocess_images import (
+    PREPROCESS_VERSION, PROCESSED_DIR, is_up_to_date, load_manifest, output_path, save_manifest,
+)
+from instrumentation import count
+from pipeline_state import CheckpointStore, run_output_path
+from rate_limiter import GEMINI_LIMITER, GEMINI_MAX_IN_FLIGHT, RequestScheduler
+from storage import iter_table
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_LINKED = run_output_path(os.path.join(BASE_DIR, "../Data/linked_dataset.csv"))
+STREAM_OUTPUT = run_output_path(os.path.join(BASE_DIR, "../Data/meal_kcal_stream.csv"))
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "16"))       # images per queue
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "5000"))     # linked_dataset rows per read
+STREAM_PREPROCESS_WORKERS = int(os.getenv("STREAM_PREPROCESS_WORKERS", str(os.cpu_count() or 1)))
+STREAM_KCAL_WORKERS = int(os.getenv("STREAM_KCAL_WORKERS", "4"))
+STREAM_MAX_PENDING_MEALS = int(os.getenv("STREAM_MAX_PENDING_MEALS", "50000"))   # meals waiting for an image
+STREAM_DONE_CACHE = int(os.getenv("STREAM_DONE_CACHE", "100000"))   # finished images kept for later meals
+
+OUTPUT_COLUMNS = ["ID", "Day", "Meal", "raw_image_path", "Kcal", "Detail"]
+
+
+# ============================================================
+# Bounded-queue stages
+# ============================================================
+_DONE = object()
+
+
+@dataclass
+class StreamStage:
+    name: str
+    fn: object          # fn(job), updates the job in place
+    workers: int = 1
+
+
+def _put(q, item, stop, stage):
+    """Blocking put that gives up once the stream is stopped."""
+    if q.full():
+        count("backpressure", stage=stage)
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def stream(source, stages, queue_size=STREAM_QUEUE_SIZE):
+    """
+    Yield every job from `source` once it went through all stages, in
+    completion order. A stage that raises sets job.error and later stages
+    let the job pass untouched. At most queue_size jobs wait between two
+    stages; leaving the loop early stops every thread.
+    """
+    for stage in stages:
+        stage.workers = max(1, stage.workers)
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+    remaining = [stage.workers for stage in stages]
+    lock = threading.Lock()
+    errors = []
+
+    def feed():
+        try:
+            for job in source:
+                if not _put(queues[0], job, stop, stages[0].name):
+                    return
+        except Exception as e:
+            errors.append(e)
+        for _ in range(stages[0].workers):
+            _put(queues[0], _DONE, stop, stages[0].name)
+
+    def work(i):
+        stage, inbox, outbox = stages[i], queues[i], queues[i + 1]
+        downstream = stages[i + 1] if i + 1 < len(stages) else None
+        while True:
+            job = _get(inbox, stop)
+            if job is _DONE:
+                break
+            if job.error is None:
+                try:
+                    stage.fn(job)
+                except Exception as e:
+                    job.error = f"{stage.name}: {e}"
+            if not _put(outbox, job, stop, downstream.name if downstream else "sink"):
+                return
+
+        # the last worker out tells the next stage (or the consumer) to finish
+        with lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last:
+            for _ in range(downstream.workers if downstream else 1):
+                _put(outbox, _DONE, stop, downstream.name if downstream else "sink")
+
+    threads = [threading.Thread(target=feed, name="stream-feed", daemon=True)]
+    for i, stage in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(i,), name=f"stream-{stage.name}_{n}", daemon=True)
+                    for n in range(stage.workers)]
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            job = _get(queues[-1], stop)
+            if job is _DONE:
+                break
+            yield job
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+
+# ============================================================
+# Images → kcal
+# ============================================================
+@dataclass
+class ImageJob:
+    path: str                       # raw image path
+    processed: str = None
+    jpeg: bytes = None              # only between preprocess and identify
+    ingredients: list = None
+    kcal: float = None
+    detail: list = None
+    identify_hash: str = None
+    kcal_hash: str = None
+    new_identify: bool = False      # to checkpoint
+    new_kcal: bool = False
+    error: str = None
+
+
+class MealStream:
+    """The three stages, plus the bookkeeping from images back to meals."""
+
+    def __init__(self, store, processed_dir=PROCESSED_DIR,
+                 max_pending=STREAM_MAX_PENDING_MEALS, done_cache=STREAM_DONE_CACHE):
+        self.store = store
+        self.processed_dir = processed_dir
+        self.manifest = load_manifest(processed_dir)    # saved at the end of run()
+        self.scheduler = RequestScheduler(GEMINI_LIMITER, max_in_flight=GEMINI_MAX_IN_FLIGHT)
+        self.max_pending = max(1, max_pending)
+        self.done_cache = max(1, done_cache)
+
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)   # pending dropped below max_pending
+        self._closed = threading.Event()
+        self.waiting = {}               # raw path → meals waiting for it
+        self.pending = 0                # meals in waiting
+        self.done = OrderedDict()       # raw path → (kcal, detail JSON), least recent first
+        self.meals = 0
+        self.images = 0
+        self.writer = None
+        self._file = None
+
+    # ---- stages ----
+    def preprocess(self, job):
+        os.makedirs(self.processed_dir, exist_ok=True)
+        out_path = output_path(job.path, self.processed_dir)
+        if is_up_to_date(job.path, out_path, "mtime", self.manifest):
+            job.processed = out_path
+            return
+
+        jpeg = encode_for_gemini(preprocess_for_gemini(job.path))
+        tmp = out_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(jpeg)
+        os.replace(tmp, out_path)
+        with self._lock:
+            self.manifest[job.path] = PREPROCESS_VERSION
+        job.processed, job.jpeg = out_path, jpeg
+
+    def identify(self, job):
+        job.identify_hash = identify_input_hash(job.processed)
+        found = self.store.get_many(IDENTIFY_STAGE, {job.path: job.identify_hash})
+        if job.path not in found:
+            found = REVIEW_QUEUE.answers([job.path])
+        if job.path not in found and REVIEW_QUEUE.dismissed([job.path]):
+            found = {job.path: []}   # dismissed in review: final
+        if job.path in found:
+            job.ingredients, job.jpeg = found[job.path], None
+            return
+
+        if job.jpeg is None:
+            with open(job.processed, "rb") as f:
+                job.jpeg = f.read()
+        # a cache hit is answered here, without waiting for rate-limit budget
+        _, cached = vision_cache_lookup(job.jpeg, os.path.basename(job.path))
+        if cached is not None:
+            job.ingredients, job.jpeg, job.new_identify = cached, None, True
+            return
+        try:
+            job.ingredients = self.scheduler.call(
+                identify_food_with_gemini, job.jpeg, image_id=job.path, check_cache=False,
+                tokens=VISION_REQUEST_TOKENS,
+            )
+        except Exception as e:
+            print("Gemini failed:", job.path, e)
+            job.ingredients = []
+        job.jpeg = None
+        job.new_identify = bool(job.ingredients)   # [] = queued for review
+
+    def kcal(self, job):
+        job.kcal_hash = kcal_input_hash(job.ingredients)
+        found = self.store.get_many(KCAL_STAGE, {job.path: job.kcal_hash})
+        if job.path in found:
+            job.kcal, job.detail = found[job.path]
+            return
+
+        # one lookup per name; any name without a USDA record (no match or a
+        # transient failure): not checkpointed, looked up again next run
+        records = usda_search_many(normalize_ingredient(item.get("ingredient", "")) for item in job.ingredients)
+        job.kcal, job.detail = compute_kcal(job.ingredients, records)
+        job.new_kcal = all(record is not None for record in records.values())
+
+    # ---- meals in, rows out ----
+    def _write(self, meals, kcal, detail_json, path):
+        for user_id, day, meal in meals:
+            self.writer.writerow([user_id, day, meal, path, kcal, detail_json])
+        self.meals += len(meals)
+
+    def jobs(self, linked_path, chunk_rows=STREAM_CHUNK_ROWS):
+        """
+        One ImageJob per image not done yet; meals on images already done
+        are written right away. Blocks while max_pending meals wait: every
+        waiting image has its job in the stream, so finishing them makes room.
+        """
+        columns = ["ID", "Day", *MEAL_PATH_COLUMNS.values()]
+        for chunk in iter_table(linked_path, columns=columns, chunk_rows=chunk_rows):
+            for row in chunk.itertuples(index=False):
+                for meal, path in zip(MEAL_PATH_COLUMNS, row[2:]):
+                    if not isinstance(path, str) or not os.path.exists(path):
+                        continue
+                    with self._room:
+                        if self.pending >= self.max_pending and path not in self.done:
+                            count("backpressure", stage="meals")
+                        while self.pending >= self.max_pending and path not in self.done:
+                            if self._closed.is_set():
+                                return
+                            self._room.wait(0.1)
+                        if path in self.done:
+                            self.done.move_to_end(path)
+                            self._write([(row[0], row[1], meal)], *self.done[path], path)
+                            continue
+                        new = path not in self.waiting
+                        self.waiting.setdefault(path, []).append((row[0], row[1], meal))
+                        self.pending += 1
+                    if new:
+                        yield ImageJob(path)
+
+    def _release(self, path):
+        """Meals waiting for `path`, taken out of waiting (call with the lock held)."""
+        meals = self.waiting.pop(path, [])
+        self.pending -= len(meals)
+        self._room.notify_all()
+        return meals
+
+    def finish(self, job):
+        detail_json = json.dumps(job.detail)
+        with self._lock:
+            self.done[job.path] = (job.kcal, detail_json)
+            self.done.move_to_end(job.path)
+            if len(self.done) > self.done_cache:
+                self.done.popitem(last=False)
+            self._write(self._release(job.path), job.kcal, detail_json, job.path)
+            self._file.flush()   # rows are readable as soon as their image is done
+            self.images += 1
+
+    # ---- whole run ----
+    def run(self, linked_path, out_path, queue_size=STREAM_QUEUE_SIZE,
+            preprocess_workers=STREAM_PREPROCESS_WORKERS, kcal_workers=STREAM_KCAL_WORKERS):
+        stages = [
+            StreamStage("preprocess", self.preprocess, preprocess_workers),
+            StreamStage("identify", self.identify, GEMINI_MAX_IN_FLIGHT),
+            StreamStage("kcal", self.kcal, kcal_workers),
+        ]
+        start = time.perf_counter()
+        first = None
+        failed = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+        with open(out_path, "w", newline="", encoding="utf-8") as f, \
+                self.store.writer(IDENTIFY_STAGE) as identified, \
+                self.store.writer(KCAL_STAGE) as computed:
+            self._file, self.writer = f, csv.writer(f)
+            self.writer.writerow(OUTPUT_COLUMNS)
+
+            results = stream(self.jobs(linked_path), stages, queue_size)
+            try:
+                for job in results:
+                    if job.error is not None:
+                        print("[ERROR]", job.path, job.error)
+                        failed += 1
+                        with self._lock:
+                            self._release(job.path)
+                        continue
+                    if job.new_identify:
+                        identified.add(job.path, job.identify_hash, job.ingredients)
+                    if job.new_kcal:
+                        computed.add(job.path, job.kcal_hash, [job.kcal, job.detail])
+
+                    self.finish(job)
+                    if first is None:
+                        first = time.perf_counter() - start
+                        print(f"First result after {first:.1f}s: {os.path.basename(job.path)} → {job.kcal:.0f} kcal")
+                    elif self.images % 100 == 0:
+                        print(f"{self.images} images, {self.meals} meals ({time.perf_counter() - start:.0f}s)")
+            finally:
+                self._closed.set()      # a feeder waiting for room gives up
+                results.close()         # stops and joins the stage threads
+                if os.path.isdir(self.processed_dir):
+                    save_manifest(self.processed_dir, self.manifest)
+
+        elapsed = time.perf_counter() - start
+        self.scheduler.close()
+        print(f"Streamed {self.images} images / {self.meals} meals in {elapsed:.1f}s "
+              f"({self.images / elapsed if elapsed else 0:.2f} images/s), {failed} failed → {out_path}")
+        return {"images": self.images, "meals": self.meals, "failed": failed,
+                "first_result_seconds": first, "seconds": elapsed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream meal images through preprocess → identify → kcal")
+    parser.add_argument("--linked", default=DATA_LINKED)
+    parser.add_argument("--out", default=STREAM_OUTPUT)
+    parser.add_argument("--processed-dir", default=PROCESSED_DIR)
+    parser.add_argument("--queue-size", type=int, default=STREAM_QUEUE_SIZE)
+    parser.add_argument("--preprocess-workers", type=int, default=STREAM_PREPROCESS_WORKERS)
+    parser.add_argument("--kcal-workers", type=int, default=STREAM_KCAL_WORKERS)
+    args = parser.parse_args(argv)
+
+    store = CheckpointStore()
+    try:
+        MealStream(store, args.processed_dir).run(
+            args.linked, args.out, args.queue_size, args.preprocess_workers, args.kcal_workers
+        )
+    finally:
+        store.close()
+
+    print("Vision cache:", VISION_CACHE.stats())
+    print("LLM clients:", llm_stats())
+    pending = REVIEW_QUEUE.counts().get("pending", 0)
+    if pending:
+        print(f"Review queue: {pending} images need manual input (python food_tools/review_queue.py review)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# %%
@@ -0,0 +1,224 @@
+# %%
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(BASE_DIR, "../Data/cache")
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+USDA_CACHE_PATH = os.getenv("USDA_CACHE_PATH", os.path.join(CACHE_DIR, "usda_nutrients.sqlite"))
+
+# Bump when the parsed USDA record format changes; older rows are ignored.
+USDA_CACHE_VERSION = 1
+
+USDA_CACHE_TTL = float(os.getenv("USDA_CACHE_TTL_DAYS", "90")) * 86400
+USDA_NEGATIVE_TTL = float(os.getenv("USDA_NEGATIVE_TTL_DAYS", "7")) * 86400
+FDC_ID_TTL = float(os.getenv("FDC_ID_TTL_DAYS", "365")) * 86400   # name → fdcId barely changes
+USDA_MEMORY_SIZE = 4096
+
+# Returned by NutrientCache.get when nothing usable is stored.
+MISS = object()
+
+
+def cache_key(name: str) -> str:
+    """'  Cooked  Rice ' → 'cooked rice'"""
+    if not isinstance(name, str):
+        return ""
+    return " ".join(name.strip().lower().split())
+
+
+# ============================================================
+# Disk-backed nutrient cache with an in-process LRU layer
+# ============================================================
+class NutrientCache:
+    """
+    Maps normalized ingredient names → parsed USDA records.
+
+    - value is the dict returned by usda_search, or None for
+      "USDA has no usable match" (negative result)
+    - rows written by another CACHE_VERSION or older than their TTL
+      are treated as missing
+    """
+
+    def __init__(self, path=USDA_CACHE_PATH, ttl=USDA_CACHE_TTL,
+                 negative_ttl=USDA_NEGATIVE_TTL, version=USDA_CACHE_VERSION,
+                 memory_size=USDA_MEMORY_SIZE, fdc_id_ttl=FDC_ID_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.fdc_id_ttl = fdc_id_ttl
+        self.negative_ttl = negative_ttl
+        self.version = version
+        self.memory_size = memory_size
+
+        self._memory = OrderedDict()
+        self._lock = threading.RLock()
+        self._conn = None
+
+        self.hits = 0
+        self.misses = 0
+
+    # ---- storage ----
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS nutrients (
+                    key        TEXT PRIMARY KEY,
+                    version    INTEGER NOT NULL,
+                    value      TEXT,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS fdc_ids (
+                    key        TEXT PRIMARY KEY,
+                    fdc_id     INTEGER,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _expired(self, value, created_at, now):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        return now - created_at > ttl
+
+    def _remember(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    # ---- public API ----
+    def get(self, name):
+        key = cache_key(name)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._expired(value, created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+            row = self._connect().execute(
+                "SELECT value, created_at FROM nutrients WHERE key = ? AND version = ?",
+                (key, self.version),
+            ).fetchone()
+
+            if row is not None:
+                value = json.loads(row[0]) if row[0] is not None else None
+                if not self._expired(value, row[1], now):
+                    self._remember(key, value, row[1])
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return MISS
+
+    def set(self, name, value):
+        key = cache_key(name)
+        now = time.time()
+        payload = json.dumps(value) if value is not None else None
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO nutrients (key, version, value, created_at) VALUES (?, ?, ?, ?)",
+                (key, self.version, payload, now),
+            )
+            conn.commit()
+            self._remember(key, value, now)
+
+    # ---- name → FDC ID (batch mode) ----
+    def get_fdc_id(self, name):
+        """Cached FDC ID, None for a cached "no match", MISS otherwise."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT fdc_id, created_at FROM fdc_ids WHERE key = ?", (cache_key(name),)
+            ).fetchone()
+        if row is None:
+            return MISS
+        ttl = self.fdc_id_ttl if row[0] is not None else self.negative_ttl
+        if time.time() - row[1] > ttl:
+            return MISS
+        return row[0]
+
+    def set_fdc_ids(self, mapping):
+        """Store many name → fdc_id (or None) pairs in one transaction."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO fdc_ids (key, fdc_id, created_at) VALUES (?, ?, ?)",
+                [(cache_key(name), fdc_id, now) for name, fdc_id in mapping.items()],
+            )
+            conn.commit()
+
+    def invalidate(self, name=None):
+        """Drop one entry, or everything when name is None."""
+        with self._lock:
+            conn = self._connect()
+            if name is None:
+                self._memory.clear()
+                conn.execute("DELETE FROM nutrients")
+                conn.execute("DELETE FROM fdc_ids")
+            else:
+                key = cache_key(name)
+                self._memory.pop(key, None)
+                conn.execute("DELETE FROM nutrients WHERE key = ?", (key,))
+                conn.execute("DELETE FROM fdc_ids WHERE key = ?", (key,))
+            conn.commit()
+
+    def purge_stale(self):
+        """Remove rows from other versions or past their TTL (nutrients and FDC IDs)."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                """
+                DELETE FROM nutrients
+                WHERE version != ?
+                   OR (value IS NOT NULL AND ? - created_at > ?)
+                   OR (value IS NULL AND ? - created_at > ?)
+                """,
+                (self.version, now, self.ttl, now, self.negative_ttl),
+            )
+            conn.execute(
+                """
+                DELETE FROM fdc_ids
+                WHERE (fdc_id IS NOT NULL AND ? - created_at > ?)
+                   OR (fdc_id IS NULL AND ? - created_at > ?)
+                """,
+                (now, self.fdc_id_ttl, now, self.negative_ttl),
+            )
+            conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# %%
@@ -0,0 +1,253 @@
+# %%
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import count, observe
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+USDA_BASE_URL = os.getenv("USDA_BASE_URL", "https://api.nal.usda.gov/fdc/v1")
+USDA_MAX_CONCURRENCY = int(os.getenv("USDA_MAX_CONCURRENCY", "8"))
+USDA_MAX_RETRIES = int(os.getenv("USDA_MAX_RETRIES", "4"))
+USDA_BACKOFF_SECONDS = 0.5      # first retry delay, doubled every attempt
+USDA_MAX_BACKOFF_SECONDS = 30.0
+USDA_TIMEOUT = 10
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# /foods accepts at most 20 fdcIds per request
+FDC_BULK_SIZE = 20
+
+# per-100 g nutrient vector layout: USDA nutrient number → record field
+NUTRIENT_NUMBERS = ("208", "203", "204", "205")
+NUTRIENT_FIELDS = ("kcal_per_100g", "protein_g", "fat_g", "carbs_g")
+
+
+class USDANoMatch(Exception):
+    """USDA answered, but has no usable kcal value for the query."""
+
+
+def parse_kcal(food):
+    """kcal per 100 g from a FoodData Central food object, or None."""
+    for n in food.get("foodNutrients", []):
+        if n.get("nutrientNumber") == "208" or n.get("nutrientName", "").lower().startswith("energy"):
+            return n.get("value")
+    return None
+
+
+def nutrient_vector(food):
+    """
+    Compact per-100 g vector (kcal, protein, fat, carbs) from any FDC food
+    object: search hits, abridged or full /foods entries.
+    """
+    values = dict.fromkeys(NUTRIENT_NUMBERS)
+    for n in food.get("foodNutrients", []):
+        nutrient = n.get("nutrient") or {}
+        number = str(n.get("nutrientNumber") or n.get("number") or nutrient.get("number") or "")
+        amount = n.get("value", n.get("amount"))
+
+        if number not in values:
+            name = (n.get("nutrientName") or n.get("name") or nutrient.get("name") or "").lower()
+            unit = (n.get("unitName") or nutrient.get("unitName") or "").lower()
+            if name.startswith("energy") and unit == "kcal":
+                number = "208"
+            else:
+                continue
+
+        if values[number] is None and amount is not None:
+            values[number] = float(amount)
+
+    return tuple(values[k] for k in NUTRIENT_NUMBERS)
+
+
+def vector_to_record(fdc_id, vector):
+    """Nutrient vector → usda_search-style record, or None without kcal."""
+    if vector[0] is None:
+        return None
+    record = dict(zip(NUTRIENT_FIELDS, vector))
+    record["fdc_id"] = fdc_id
+    return record
+
+
+def _retry_after(resp):
+    """Seconds requested by a Retry-After header, if any."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+# ============================================================
+# Pooled, thread-safe FoodData Central client
+# ============================================================
+class USDAClient:
+    """
+    - one keep-alive requests.Session shared by all worker threads
+    - at most `max_concurrency` requests in flight
+    - retries 429/5xx and connection errors with exponential backoff
+      (Retry-After wins when USDA sends it)
+    """
+
+    def __init__(self, api_key, base_url=USDA_BASE_URL, max_concurrency=USDA_MAX_CONCURRENCY,
+                 max_retries=USDA_MAX_RETRIES, backoff=USDA_BACKOFF_SECONDS, timeout=USDA_TIMEOUT):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # ---- transport ----
+    def _sleep_before_retry(self, attempt, resp=None):
+        delay = _retry_after(resp) if resp is not None else None
+        if delay is None:
+            delay = self.backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+        delay = min(delay, USDA_MAX_BACKOFF_SECONDS)
+
+        count("retries", client="usda")
+        if resp is not None and resp.status_code == 429:
+            count("rate_limited", client="usda")
+            observe("rate_limit_wait", delay, client="usda")
+        time.sleep(delay)
+
+    def request(self, method, path, params=None, json_body=None):
+        params = dict(params or {}, api_key=self.api_key)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+
+        for attempt in range(self.max_retries + 1):
+            last_try = attempt == self.max_retries
+            try:
+                resp = self.session.request(method, url, params=params, json=json_body, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_try:
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+
+            if resp.status_code == 200:
+                return resp.json()
+            if resp.status_code in RETRY_STATUS and not last_try:
+                self._sleep_before_retry(attempt, resp)
+                continue
+            raise RuntimeError(f"USDA HTTP {resp.status_code}")
+
+    # ---- lookups ----
+    def search(self, query):
+        """Best match for one query → {"kcal_per_100g": ...}; raises USDANoMatch."""
+        data = self.request("GET", "foods/search", params={"query": query, "pageSize": 1})
+        foods = data.get("foods", [])
+        if not foods:
+            raise USDANoMatch(query)
+
+        kcal_value = parse_kcal(foods[0])
+        if kcal_value is None:
+            raise USDANoMatch(query)
+
+        return {"kcal_per_100g": float(kcal_value)}
+
+    def search_food(self, query):
+        """
+        Best match for one query → (fdc_id, nutrient vector), both taken
+        from the search hit, no /foods round trip; raises USDANoMatch.
+        """
+        data = self.request("GET", "foods/search", params={"query": query, "pageSize": 1})
+        foods = data.get("foods", [])
+        if not foods or foods[0].get("fdcId") is None:
+            raise USDANoMatch(query)
+        return int(foods[0]["fdcId"]), nutrient_vector(foods[0])
+
+    def fetch_foods(self, fdc_ids):
+        """
+        Bulk nutrient fetch: FDC_BULK_SIZE ids per /foods request, chunks in
+        parallel. Returns fdc_id → nutrient vector (ids USDA did not return
+        are left out).
+        """
+        fdc_ids = list(dict.fromkeys(int(i) for i in fdc_ids))
+        chunks = [fdc_ids[i:i + FDC_BULK_SIZE] for i in range(0, len(fdc_ids), FDC_BULK_SIZE)]
+        body = {"format": "abridged", "nutrients": [int(n) for n in NUTRIENT_NUMBERS]}
+
+        futures = [
+            self._pool().submit(self.request, "POST", "foods", json_body=dict(body, fdcIds=chunk))
+            for chunk in chunks
+        ]
+
+        vectors = {}
+        for fut in futures:
+            for food in fut.result() or []:
+                if food.get("fdcId") is not None:
+                    vectors[int(food["fdcId"])] = nutrient_vector(food)
+        return vectors
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency, thread_name_prefix="usda"
+                )
+            return self._executor
+
+    def search_many(self, queries):
+        """
+        Look up many queries concurrently.
+        Returns (results, errors):
+          results: query → record, or None when USDA has no match
+          errors:  query → exception for requests that failed
+        """
+        queries = list(dict.fromkeys(queries))
+        futures = {q: self._pool().submit(self.search, q) for q in queries}
+
+        results, errors = {}, {}
+        for q, fut in futures.items():
+            try:
+                results[q] = fut.result()
+            except USDANoMatch:
+                results[q] = None
+            except Exception as e:
+                errors[q] = e
+        return results, errors
+
+    def search_food_many(self, queries):
+        """
+        Concurrent search_food.
+        Returns (hits, errors): hits maps query → (fdc_id, vector), or None for no match.
+        """
+        queries = list(dict.fromkeys(queries))
+        futures = {q: self._pool().submit(self.search_food, q) for q in queries}
+
+        hits, errors = {}, {}
+        for q, fut in futures.items():
+            try:
+                hits[q] = fut.result()
+            except USDANoMatch:
+                hits[q] = None
+            except Exception as e:
+                errors[q] = e
+        return hits, errors
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        self.session.close()
+
+
+# %%
@@ -1,53 +1,142 @@
 # %%
 import os
-import cv2
 import json
 import base64
-import numpy as np
-import requests
-import pandas as pd
+import hashlib
 from dotenv import load_dotenv
 
-from langchain_core.messages import HumanMessage
-from langchain_google_genai import ChatGoogleGenerativeAI
+# cv2, numpy, requests and langchain are imported where they are used:
+# importing this module (e.g. for compute_kcal) stays cheap.
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 IMAGE_DIR = os.path.join(BASE_DIR, "../Images/raw_images")
-load_dotenv()
+load_dotenv()   # before the local modules below read their config
+
+from usda_cache import NutrientCache, MISS
+from ingredient_normalizer import IngredientNormalizer
+from rate_limiter import GEMINI_LIMITER, is_rate_limited
+from vision_cache import VisionCache, dhash
+from review_queue import ReviewQueue
+from llm_clients import LLM_CLIENTS, llm_stats
+from instrumentation import span, traced, count
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 USDA_API_KEY = os.getenv("USDA_API_KEY")
 
+# "search": one foods/search per name (kcal only)
+# "batch":  full nutrient vectors; a new name costs one foods/search (record
+#           from the hit), a name with a known FDC ID a share of a bulk /foods
+USDA_LOOKUP_MODE = os.getenv("USDA_LOOKUP_MODE", "search")
+
+# where nutrient lookups come from:
+# "http"       → FoodData Central API (default)
+# "local"      → offline index built by fdc_local.py, no network at all
+# "local+http" → offline index first, API only for names it cannot match
+# "fake"       → in-process stand-in server (fake_backends.py), for load tests
+USDA_BACKEND = os.getenv("USDA_BACKEND", "http")
+
+# "gemini" (default) or "fake": canned answers from fake_backends.py, no API key needed
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+
+# normalized ingredient name → USDA record, shared by every stage
+if USDA_BACKEND == "fake":
+    from fake_backends import FAKE_USDA_CACHE_PATH
+    NUTRIENT_CACHE = NutrientCache(FAKE_USDA_CACHE_PATH)
+else:
+    NUTRIENT_CACHE = NutrientCache()
+
+_usda_client = None
+_local_index = None
+
+
+def usda_client():
+    """Pooled keep-alive client, lookups for a meal run concurrently (created on first use)."""
+    global _usda_client
+    if _usda_client is None:
+        from usda_client import USDAClient
+        if USDA_BACKEND == "fake":
+            from fake_backends import shared_usda_server
+            _usda_client = USDAClient(USDA_API_KEY or "fake", base_url=shared_usda_server().url)
+        else:
+            _usda_client = USDAClient(USDA_API_KEY)
+    return _usda_client
+
+
+def local_fdc_index():
+    global _local_index
+    if _local_index is None:
+        from fdc_local import LocalFDCIndex
+        _local_index = LocalFDCIndex()
+    return _local_index
+
 # ------------------------------
 # DIP IMAGE PREPROCESSING
 # ------------------------------
 
+PREPROCESS_SIZE = (768, 768)
+GAMMA = 1.1
+WB_STRENGTH = 1.1
+
+_gamma_lut = None
+
+
+def gamma_lut():
+    """(i / 255) ** GAMMA * 255, truncated — same values the per-pixel float path produced."""
+    global _gamma_lut
+    if _gamma_lut is None:
+        import numpy as np
+        _gamma_lut = (np.power(np.arange(256) / 255.0, GAMMA) * 255).astype("uint8")
+    return _gamma_lut
+
+
+@traced("preprocess")
 def preprocess_for_gemini(image_path):
     """High-quality enhancement without distorting the image."""
+    import cv2
     img = cv2.imread(image_path)
     if img is None:
         raise ValueError("Image not found.")
+    return enhance_for_gemini(img)
 
-    # Resize to model-friendly size
-    img = cv2.resize(img, (768, 768))
 
-    # ---- White Balance ----
-    result = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    avg_a = np.average(result[:, :, 1])
-    avg_b = np.average(result[:, :, 2])
-    result[:, :, 1] = result[:, :, 1] - ((avg_a - 128) * (result[:, :, 0] / 255.0) * 1.1)
-    result[:, :, 2] = result[:, :, 2] - ((avg_b - 128) * (result[:, :, 0] / 255.0) * 1.1)
-    img = cv2.cvtColor(result, cv2.COLOR_LAB2BGR)
+def enhance_for_gemini(img):
+    """
+    Resize → white balance → Y histogram equalization → gamma, on a decoded
+    BGR image. Works in small-integer OpenCV buffers reused across steps
+    instead of float64 copies of the whole image. Output is identical to
+    the old per-pixel float version, except that out-of-range a/b values
+    now saturate instead of wrapping around.
+    """
+    import cv2
+    import numpy as np
+
+    # Resize to model-friendly size
+    img = cv2.resize(img, PREPROCESS_SIZE)
+
+    # ---- White Balance (a, b shifted in one fused pass) ----
+    # old: a' = a - (avg_a - 128) * (L / 255) * 1.1, truncated to uint8.
+    # The shift only depends on L, so it becomes a 256-entry integer offset
+    # table per channel, applied to (L, a, b) with one LUT + saturating add.
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
+    _, avg_a, avg_b, _ = cv2.mean(lab)
+    levels = np.arange(256) / 255.0
+    offsets = np.zeros((256, 1, 3), dtype=np.int16)
+    offsets[:, 0, 1] = -np.ceil((avg_a - 128) * levels * WB_STRENGTH)
+    offsets[:, 0, 2] = -np.ceil((avg_b - 128) * levels * WB_STRENGTH)
+
+    lightness = cv2.cvtColor(cv2.extractChannel(lab, 0), cv2.COLOR_GRAY2BGR, dst=img)
+    cv2.add(lab, cv2.LUT(lightness, offsets), dst=lab, dtype=cv2.CV_8U)
+    cv2.cvtColor(lab, cv2.COLOR_LAB2BGR, dst=img)
 
     # ---- Histogram Equalization on Y channel ----
-    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
-    ycrcb[:, :, 0] = cv2.equalizeHist(ycrcb[:, :, 0])
-    img = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
+    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb, dst=lab)
+    y = cv2.extractChannel(ycrcb, 0)
+    cv2.equalizeHist(y, dst=y)
+    cv2.insertChannel(y, ycrcb, 0)
+    cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR, dst=img)
 
     # ---- Gamma correction (light adjustment) ----
-    gamma = 1.1
-    img = np.power(img / 255.0, gamma)
-    img = (img * 255).astype("uint8")
+    cv2.LUT(img, gamma_lut(), dst=img)
 
     return img
 
@@ -55,22 +144,15 @@ def preprocess_for_gemini(image_path):
 # GEMINI INGREDIENT + GRAMS RECOGNITION
 # ------------------------------
 
-def identify_food_with_gemini(image_path):
-    """
-    Use Gemini Vision to detect ingredients + estimated grams.
-    Unified preprocessing + strict JSON extraction + manual fallback.
-    """
-    try:
-        processed = preprocess_for_gemini(image_path)
-    except Exception as e:
-        print(f"[ERROR] Preprocessing failed for {image_path}: {e}")
-        processed = cv2.imread(image_path)
+GEMINI_JPEG_QUALITY = 95
 
-    # encode to base64
-    _, buffer = cv2.imencode('.jpg', processed)
-    img_b64 = base64.b64encode(buffer).decode("utf-8")
+VISION_MODEL = "gemini-2.5-flash" if LLM_BACKEND != "fake" else "fake-gemini"
+VISION_TEMPERATURE = 0.0
 
-    prompt = """
+# ---- Gemini quota: GEMINI_RPM / GEMINI_TPM / GEMINI_MAX_IN_FLIGHT in .env ----
+# image (~258) + prompt + JSON answer, per vision request
+VISION_REQUEST_TOKENS = 600
+VISION_PROMPT = """
     Identify the ingredients and approximate weight (grams) of each item in this meal image.
 
     Return ONLY a JSON array, like:
@@ -83,63 +165,321 @@ def identify_food_with_gemini(image_path):
     NO markdown.
     NO text outside JSON.
     """
+# editing the prompt changes the version, so old cached answers stop matching
+VISION_PROMPT_VERSION = hashlib.sha1(VISION_PROMPT.encode("utf-8")).hexdigest()[:12]
 
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash",
-        google_api_key=GOOGLE_API_KEY,
-        temperature=0.0
-    )
+# several images in one request; answer keyed by image id
+VISION_BATCH_PROMPT = """
+    You are given {n} meal images. Each image is preceded by its id.
+    For EVERY image, identify the ingredients and approximate weight (grams) of each item.
+
+    Return ONLY one JSON object mapping each image id to a JSON array, like:
+    {{
+      "img1": [{{"ingredient": "rice", "grams": 150}}, {{"ingredient": "chicken", "grams": 80}}],
+      "img2": [{{"ingredient": "salad", "grams": 120}}]
+    }}
+
+    Image ids: {ids}
+
+    NO explanation.
+    NO markdown.
+    NO text outside JSON.
+    """
+
+# second, cheaper try for an unparseable answer: JSON mode + a blunter prompt
+VISION_STRICT_PROMPT = """
+    Your previous answer could not be parsed.
+    List the ingredients and approximate weight (grams) of each item in this meal image
+    as a JSON array of objects with exactly two keys, "ingredient" (string) and "grams" (number):
+    [{"ingredient": "rice", "grams": 150}]
+    Output the JSON array and nothing else.
+    """
+
+# dHash-keyed store of model answers, reused across runs and near-duplicate photos
+VISION_CACHE_ENABLED = os.getenv("VISION_CACHE", "1") != "0"
+VISION_CACHE = VisionCache()
 
-    # call LLM
+# images still unparseable after the strict retry:
+# "queue"  → Data/cache/review_queue.sqlite, the batch goes on (review_queue.py)
+# "prompt" → ask on the terminal right away (blocks; interactive runs only)
+MANUAL_FALLBACK = os.getenv("MANUAL_FALLBACK", "queue").lower()
+REVIEW_QUEUE = ReviewQueue()
+
+
+@traced("json_parse")
+def extract_json(text):
+    """
+    Lenient JSON parse of a model answer: strips ```json fences and any
+    prose around the outermost [...] / {...}, tolerates trailing commas.
+    Returns None when nothing parses.
+    """
+    import re
+
+    if not isinstance(text, str):
+        return None
+    text = re.sub(r"```(?:json)?", "", text).strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+    end = text.rfind("]" if text[start] == "[" else "}")
+    if end <= start:
+        return None
+    candidate = text[start:end + 1]
+    for attempt in (candidate, re.sub(r",\s*([\]}])", r"\1", candidate)):
+        try:
+            return json.loads(attempt)
+        except ValueError:
+            continue
+    return None
+
+
+@traced("image_encode")
+def encode_for_gemini(img) -> bytes:
+    """Preprocessed BGR image → JPEG bytes (the exact payload sent to Gemini)."""
+    import cv2
+    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, GEMINI_JPEG_QUALITY])
+    if not ok:
+        raise ValueError("JPEG encode failed.")
+    return buffer.tobytes()
+
+
+def chat_model(model, temperature, json_mode=False, limiter=None):
+    """
+    Shared chat model for LLM_BACKEND (Gemini, or the offline fake), one per
+    (model, temperature, json_mode, limiter) for the whole process; see
+    llm_clients.py. json_mode asks Gemini for application/json output, and
+    limiter paces every call through a RateLimiter callback.
+    """
+    def build(callbacks):
+        if limiter is not None:
+            from rate_limiter import limiter_callback
+            # before the timing callback: waiting for budget is not request time
+            callbacks = [limiter_callback(limiter), *callbacks]
+
+        if LLM_BACKEND == "fake":
+            from fake_backends import fake_chat_model
+            return fake_chat_model(model=model, temperature=temperature, callbacks=callbacks)
+
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        extra = {"response_mime_type": "application/json"} if json_mode else {}
+        return ChatGoogleGenerativeAI(
+            model=model,
+            google_api_key=GOOGLE_API_KEY,
+            temperature=temperature,
+            callbacks=callbacks,
+            **extra,
+        )
+
+    key = (LLM_BACKEND, model, temperature, json_mode, id(limiter) if limiter is not None else None)
+    return LLM_CLIENTS.get(key, build)
+
+
+def vision_llm(json_mode=False):
+    """Chat model for ingredient recognition."""
+    return chat_model(VISION_MODEL, VISION_TEMPERATURE, json_mode=json_mode)
+
+
+def prepare_image_for_gemini(image_path) -> bytes:
+    """Raw image path → decoded, enhanced and encoded once."""
+    try:
+        return encode_for_gemini(preprocess_for_gemini(image_path))
+    except Exception as e:
+        print(f"[ERROR] Preprocessing failed for {image_path}: {e}")
+        import cv2
+        img = cv2.imread(image_path)
+        if img is None:
+            raise
+        return encode_for_gemini(img)
+
+
+def vision_cache_lookup(jpeg, image_name="image", check=True):
+    """
+    JPEG bytes → (dHash, cached ingredient list or None). check=False only
+    hashes, for images the caller already looked up. (None, None) when the
+    cache is off or unavailable.
+    """
+    if not VISION_CACHE_ENABLED:
+        return None, None
     try:
-        response = llm.invoke([
-            HumanMessage(content=[
-                {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": f"data:image/jpeg;base64,{img_b64}"}
-            ])
-        ])
-        text = response.content.strip()
+        h = dhash(jpeg)
+        if not check:
+            return h, None
+        cached = VISION_CACHE.get(h, VISION_MODEL, VISION_PROMPT_VERSION, VISION_TEMPERATURE)
     except Exception as e:
-        print("\n[Gemini Error] →", image_path, e)
-        text = ""
+        print(f"[WARN] Vision cache unavailable for {image_name}: {e}")
+        return None, None
+    count("vision_cache", result="hit" if cached is not None else "miss")
+    return h, cached
+
+
+@traced("identify_image")
+def identify_food_with_gemini(image, image_id=None, check_cache=True):
+    """
+    Use Gemini Vision to detect ingredients + estimated grams.
+    image can be:
+      - bytes:      already preprocessed + JPEG-encoded, sent as is
+      - np.ndarray: already preprocessed BGR image, encoded once
+      - str:        raw image path, preprocessed + encoded here
+    Lenient JSON extraction, one strict JSON-mode retry, then the image
+    goes to the review queue ([] is returned; MANUAL_FALLBACK=prompt asks
+    on the terminal instead).
+    The caller charges the first request to GEMINI_LIMITER (RequestScheduler
+    tokens=VISION_REQUEST_TOKENS); the strict retry takes its own share here.
+    Callers that schedule only cache misses (vision_cache_lookup first) pass
+    check_cache=False, so the cache is not asked twice.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        jpeg = bytes(image)
+    elif isinstance(image, str):
+        jpeg = prepare_image_for_gemini(image)
+        image_id = image_id or image
+    else:
+        jpeg = encode_for_gemini(image)
+
+    image_name = os.path.basename(image_id) if image_id else "image"
+    img_b64 = base64.b64encode(jpeg).decode("utf-8")
 
     # ---------------------------------------
-    # JSON PARSE
+    # RESULT CACHE (same / near-duplicate photo, same model + prompt)
     # ---------------------------------------
-    try:
-        parsed = json.loads(text)
-        if isinstance(parsed, list) and len(parsed) > 0:
-            print(f"Gemini recognized: {os.path.basename(image_path)}")
+    h, cached = vision_cache_lookup(jpeg, image_name, check=check_cache)
+    if cached is not None:
+        print(f"Vision cache hit: {image_name}")
+        return cached
+
+    # 1. normal request, 2. strict JSON-mode retry; both parsed leniently
+    text = ""
+    for prompt, json_mode in ((VISION_PROMPT, False), (VISION_STRICT_PROMPT, True)):
+        if json_mode:
+            GEMINI_LIMITER.acquire(VISION_REQUEST_TOKENS)
+        text = _ask_vision(prompt, img_b64, image_name, json_mode)
+        parsed = extract_json(text)
+        if is_valid_ingredient_list(parsed):
+            print(f"Gemini recognized: {image_name}" + (" (strict retry)" if json_mode else ""))
+            if h is not None:
+                VISION_CACHE.put(h, VISION_MODEL, VISION_PROMPT_VERSION, VISION_TEMPERATURE, parsed)
+            if image_id:
+                REVIEW_QUEUE.discard(image_id)
             return parsed
-        else:
-            raise ValueError("Invalid JSON")
-    except:
-        print(f"\nGemini failed — manual input required for {os.path.basename(image_path)}")
 
     # ---------------------------------------
-    # MANUAL INPUT (no loop, returns ONCE)
+    # MANUAL FALLBACK
     # ---------------------------------------
-    print(f"\n Manual entry for {os.path.basename(image_path)}")
-    manual_list = []
+    count("manual_fallbacks", mode=MANUAL_FALLBACK)
+    if MANUAL_FALLBACK == "prompt":
+        print(f"\nGemini failed — manual input required for {image_name}")
+        return manual_input(image_name)
 
-    while True:
-        name = input("Ingredient name (Enter to finish): ").strip()
-        if name == "":
-            break
+    # queued for review; [] is never checkpointed, so the next run looks again
+    # without a path, the image is known by its content, never by a shared placeholder
+    queue_id = image_id or "sha1:" + hashlib.sha1(jpeg).hexdigest()
+    REVIEW_QUEUE.add(queue_id, "unparseable answer" if text else "no answer", text or None)
+    print(f"Gemini failed — queued for manual review: {image_name}")
+    return []
 
-        grams = input(f"Weight (g) for {name}: ").strip()
-        try:
-            grams = int(float(grams))
-        except:
-            grams = None
 
-        manual_list.append({
-            "ingredient": name,
-            "grams": grams
-        })
+def _ask_vision(prompt, img_b64, image_name, json_mode=False) -> str:
+    """One vision request → answer text ("" on non-rate-limit errors)."""
+    from langchain_core.messages import HumanMessage
+
+    try:
+        with span("gemini_call", kind="strict" if json_mode else "single") as s:
+            s.set(image=image_name)
+            # image_ids only reaches tracing metadata (and the offline fake's answer lookup)
+            response = vision_llm(json_mode).invoke([
+                HumanMessage(content=[
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": f"data:image/jpeg;base64,{img_b64}"}
+                ])
+            ], config={"metadata": {"image_ids": [image_name]}})
+        return response.content.strip()
+    except Exception as e:
+        if is_rate_limited(e):
+            raise   # let the caller's RequestScheduler back off and retry
+        print("\n[Gemini Error] →", image_name, e)
+        return ""
+
+
+def is_valid_ingredient_list(parsed) -> bool:
+    return (
+        isinstance(parsed, list) and len(parsed) > 0
+        and all(isinstance(item, dict) and item.get("ingredient") for item in parsed)
+    )
+
+
+def identify_foods_batch_with_gemini(images, fallback=True, check_cache=True):
+    """
+    Several preprocessed JPEGs in ONE multimodal request.
+    images: {image_id: jpeg bytes}. Returns {image_id: ingredient list}.
+    The answer is split and validated per image; cached images are not
+    sent at all (check_cache=False: the caller already filtered them out).
+    Images whose entry is missing or malformed go through
+    single-image identify_food_with_gemini when fallback=True (each one
+    charged to GEMINI_LIMITER), otherwise they are left out so the caller
+    can schedule them itself.
+    """
+    results, pending, hashes = {}, {}, {}
+
+    for image_id, jpeg in images.items():
+        h, cached = vision_cache_lookup(jpeg, image_id, check=check_cache)
+        if h is not None:
+            hashes[image_id] = h
+        if cached is not None:
+            results[image_id] = cached
+            continue
+        pending[image_id] = jpeg
+
+    if pending:
+        # short neutral ids in the prompt, mapped back afterwards
+        slots = {f"img{i + 1}": image_id for i, image_id in enumerate(pending)}
 
-    print("Manual entry saved:", manual_list)
-    return manual_list   # THIS RETURN ENSURES NO LOOP
+        content = [{"type": "text", "text": VISION_BATCH_PROMPT.format(n=len(slots), ids=", ".join(slots))}]
+        for slot, image_id in slots.items():
+            img_b64 = base64.b64encode(pending[image_id]).decode("utf-8")
+            content.append({"type": "text", "text": f"Image id: {slot}"})
+            content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{img_b64}"})
+
+        from langchain_core.messages import HumanMessage
+
+        llm = vision_llm()
+        try:
+            with span("gemini_call", kind="batch") as s:
+                s.set(images=len(slots))
+                image_ids = [os.path.basename(image_id) for image_id in slots.values()]
+                text = llm.invoke([HumanMessage(content=content)], config={"metadata": {"image_ids": image_ids}}).content
+            answer = extract_json(text)
+        except Exception as e:
+            if is_rate_limited(e):
+                raise
+            print(f"[Gemini batch error] {len(slots)} images:", e)
+            answer = {}
+        if not isinstance(answer, dict):
+            answer = {}
+
+        for slot, image_id in slots.items():
+            parsed = answer.get(slot)
+            if not is_valid_ingredient_list(parsed):
+                continue
+            results[image_id] = parsed
+            # batch and single-image answers share one cache entry per image
+            if image_id in hashes:
+                VISION_CACHE.put(hashes[image_id], VISION_MODEL, VISION_PROMPT_VERSION, VISION_TEMPERATURE, parsed)
+
+        print(f"Gemini batch: {len(results) - (len(images) - len(pending))}/{len(pending)} images parsed")
+
+    if fallback:
+        for image_id, jpeg in pending.items():
+            if image_id not in results:
+                GEMINI_LIMITER.acquire(VISION_REQUEST_TOKENS)
+                results[image_id] = identify_food_with_gemini(jpeg, image_id=image_id, check_cache=False)
+
+    return results
 
 # -----------------------------
 # Ingredient normalization dict
@@ -172,13 +512,20 @@ INGREDIENT_NORMALIZATION = {
 }
 
 
+_normalizer = None
+
+
+def ingredient_normalizer():
+    """Built-in aliases above + Data/ingredient_aliases.csv (alias,canonical), loaded on first use."""
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = IngredientNormalizer.from_file(seed=INGREDIENT_NORMALIZATION)
+    return _normalizer
+
+
 def normalize_ingredient(name: str) -> str:
-    if not isinstance(name, str):
-        return ""
-    key = name.strip().lower()
-    if key in INGREDIENT_NORMALIZATION:
-        return INGREDIENT_NORMALIZATION[key]
-    return key
+    """Exact alias → descriptor-stripped → fuzzy trigram match (memoized)."""
+    return ingredient_normalizer().normalize(name)
 
 
 # ------------------------------
@@ -211,62 +558,136 @@ def manual_input(image_path):
 
 
 def usda_search(query: str):
-    if not USDA_API_KEY:
-        print("USDA_API_KEY missing, cannot query USDA.")
-        return None
+    """
+    Cached USDA lookup: every normalized name hits the network at most once
+    (per TTL), including names USDA has no match for.
+    """
+    return usda_search_many([query]).get(query)
 
-    url = "https://api.nal.usda.gov/fdc/v1/foods/search"
-    params = {
-        "api_key": USDA_API_KEY,
-        "query": query,
-        "pageSize": 1
-    }
 
-    try:
-        resp = requests.get(url, params=params, timeout=10)
-        if resp.status_code != 200:
-            print(f"USDA HTTP {resp.status_code} for '{query}'")
-            return None
+def usda_search_many(queries):
+    """
+    Lookup for a batch of names: the local FDC index when USDA_BACKEND asks
+    for it, then the cache, then concurrent usda_client() requests for misses.
+    Returns name → record (None when unavailable).
+    """
+    with span("usda_search"):
+        return _usda_search_many(queries)
+
+
+def _usda_search_many(queries):
+    queries = list(dict.fromkeys(queries))
+    results = {}
+
+    if USDA_BACKEND in ("local", "local+http"):
+        index = local_fdc_index()
+        for q in queries:
+            record = index.search(q)
+            if record is not None:
+                results[q] = record
+        if USDA_BACKEND == "local":
+            return {q: results.get(q) for q in queries}
+
+    local_hits = len(results)
+    pending = []
+    for q in queries:
+        if q in results:
+            continue
+        cached = NUTRIENT_CACHE.get(q)
+        if cached is MISS:
+            pending.append(q)
+        else:
+            results[q] = cached
 
-        data = resp.json()
-        foods = data.get("foods", [])
-        if not foods:
-            return None
+    count("usda_lookups", local_hits, source="local")
+    count("usda_lookups", len(queries) - len(pending) - local_hits, source="cache")
+    count("usda_lookups", len(pending), source="network")
+    if not pending:
+        return results
 
-        food = foods[0]
-        nutrients = food.get("foodNutrients", [])
+    if not USDA_API_KEY and USDA_BACKEND != "fake":
+        print("USDA_API_KEY missing, cannot query USDA.")
+        results.update({q: None for q in pending})
+        return results
 
-        kcal_value = None
-        for n in nutrients:
-            if n.get("nutrientNumber") == "208" or n.get("nutrientName", "").lower().startswith("energy"):
-                kcal_value = n.get("value")
-                break
+    if USDA_LOOKUP_MODE == "batch":
+        fetched, errors = _usda_batch_lookup(pending)
+    else:
+        fetched, errors = usda_client().search_many(pending)
 
-        if kcal_value is None:
-            return None
+    for q, record in fetched.items():
+        NUTRIENT_CACHE.set(q, record)
+        results[q] = record
 
-        return {"kcal_per_100g": float(kcal_value)}
+    count("usda_errors", len(errors))
+    for q, e in errors.items():
+        print(f"USDA query error for '{q}': {e}")
+        results[q] = None   # transient failure, not cached
 
-    except Exception as e:
-        print(f"USDA query error for '{query}': {e}")
-        return None
+    return results
+
+
+def _usda_batch_lookup(names):
+    """
+    Batch mode: a name whose FDC ID is already known (cached separately)
+    is fetched by one bulk /foods request per FDC_BULK_SIZE distinct IDs;
+    an unknown name is searched once and its record built from the search
+    hit itself. Same (results, errors) contract as USDAClient.search_many.
+    """
+    from usda_client import vector_to_record
+
+    known, unknown = {}, []
+    for name in names:
+        fdc_id = NUTRIENT_CACHE.get_fdc_id(name)
+        if fdc_id is MISS:
+            unknown.append(name)
+        else:
+            known[name] = fdc_id
+
+    results, errors = {}, {}
+    if unknown:
+        hits, errors = usda_client().search_food_many(unknown)
+        NUTRIENT_CACHE.set_fdc_ids({name: hit[0] if hit else None for name, hit in hits.items()})
+        for name, hit in hits.items():
+            results[name] = vector_to_record(*hit) if hit else None
+
+    results.update({name: None for name, fdc_id in known.items() if fdc_id is None})
+    known = {name: fdc_id for name, fdc_id in known.items() if fdc_id is not None}
+    if known:
+        try:
+            vectors = usda_client().fetch_foods(known.values())
+        except Exception as e:
+            errors.update({name: e for name in known})
+            return results, errors
+        for name, fdc_id in known.items():
+            vector = vectors.get(fdc_id)
+            results[name] = vector_to_record(fdc_id, vector) if vector else None
+    return results, errors
 
 # ------------------------------
 # CALORIE CALCULATION
 # ------------------------------
 
-def compute_kcal(ingredient_list):
-    
+@traced("compute_kcal")
+def compute_kcal(ingredient_list, lookups=None):
+    """
+    lookups: normalized name → record (None = no record) already fetched
+    for this run, e.g. by a usda_search_many warm-up; names found there
+    are not looked up again, transient failures included.
+    """
     total_kcal = 0.0
     detail_list = []
 
-    for item in ingredient_list:
+    norm_names = [normalize_ingredient(item.get("ingredient", "")) for item in ingredient_list]
+    known = lookups or {}
+    lookups = {**usda_search_many(n for n in norm_names if n not in known),
+               **{n: known[n] for n in norm_names if n in known}}
+
+    for item, norm_name in zip(ingredient_list, norm_names):
         name = item.get("ingredient", "")
         grams = item.get("grams", 0) or 0
 
-        norm_name = normalize_ingredient(name)
-
-        food_data = usda_search(norm_name)
+        food_data = lookups.get(norm_name)
 
         if not food_data:
             print(f"USDA failed for {name}. Using default = 0 kcal")
@@ -0,0 +1,203 @@
+# %%
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from pipeline_state import CACHE_DIR   # Data/cache, or FAKE_RUN_DIR/cache on a fake run
+
+# --------------------------
+# Config (override through .env if needed)
+# --------------------------
+VISION_CACHE_PATH = os.getenv("VISION_CACHE_PATH", os.path.join(CACHE_DIR, "vision_results.sqlite"))
+VISION_CACHE_MAX_ENTRIES = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "200000"))
+
+# dHash bits that may differ for two photos to count as the same meal.
+# ≤ 3 keeps the 4 × 16-bit band index exact (pigeonhole: one band must match).
+NEAR_DUPLICATE_BITS = min(3, int(os.getenv("VISION_NEAR_DUPLICATE_BITS", "3")))
+BANDS = 4
+
+
+# ------------------------------
+# Perceptual hash
+# ------------------------------
+def dhash(image) -> int:
+    """
+    64-bit difference hash of JPEG bytes, a BGR/gray ndarray or a path.
+    Robust to re-encoding, resizing and small colour changes.
+    """
+    import cv2
+    import numpy as np
+
+    if isinstance(image, (bytes, bytearray)):
+        # decoder downsamples on the fly: much cheaper than a full decode
+        gray = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    elif isinstance(image, np.ndarray):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    else:
+        gray = cv2.imread(image, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        raise ValueError("Cannot decode image for hashing.")
+
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def _bands(h):
+    return [(h >> (16 * i)) & 0xFFFF for i in range(BANDS)]
+
+
+# ============================================================
+# Persistent cache
+# ============================================================
+class VisionCache:
+    """
+    (dHash, model, prompt version, temperature) → ingredient list.
+    Near-duplicate photos (≤ NEAR_DUPLICATE_BITS differing bits) hit too.
+    Least-recently-used rows are evicted above max_entries.
+    """
+
+    def __init__(self, path=VISION_CACHE_PATH, max_entries=VISION_CACHE_MAX_ENTRIES,
+                 near_bits=NEAR_DUPLICATE_BITS):
+        self.path = path
+        self.max_entries = max_entries
+        self.near_bits = near_bits
+
+        self._lock = threading.RLock()
+        self._conn = None
+        self._count = None      # rows in `results`, counted once per connection
+
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        if self._conn is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    dhash       TEXT NOT NULL,
+                    model       TEXT NOT NULL,
+                    prompt      TEXT NOT NULL,
+                    temperature REAL NOT NULL,
+                    band0 INTEGER, band1 INTEGER, band2 INTEGER, band3 INTEGER,
+                    ingredients TEXT NOT NULL,
+                    created_at  REAL NOT NULL,
+                    last_used   REAL NOT NULL,
+                    PRIMARY KEY (dhash, model, prompt, temperature)
+                );
+                CREATE INDEX IF NOT EXISTS idx_band0 ON results (band0);
+                CREATE INDEX IF NOT EXISTS idx_band1 ON results (band1);
+                CREATE INDEX IF NOT EXISTS idx_band2 ON results (band2);
+                CREATE INDEX IF NOT EXISTS idx_band3 ON results (band3);
+                CREATE INDEX IF NOT EXISTS idx_last_used ON results (last_used);
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def get(self, h, model, prompt_version, temperature):
+        """Cached ingredient list for hash h, or None."""
+        key = (f"{h:016x}", model, prompt_version, float(temperature))
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT dhash, ingredients FROM results WHERE dhash = ? AND model = ? AND prompt = ? AND temperature = ?",
+                key,
+            ).fetchone()
+
+            near = False
+            if row is None and self.near_bits > 0:
+                row = self._nearest(conn, h, key[1:])
+                near = row is not None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            conn.execute(
+                "UPDATE results SET last_used = ? WHERE dhash = ? AND model = ? AND prompt = ? AND temperature = ?",
+                (time.time(), row[0], *key[1:]),
+            )
+            conn.commit()
+            if near:
+                self.near_hits += 1
+            else:
+                self.hits += 1
+            return json.loads(row[1])
+
+    def _nearest(self, conn, h, rest):
+        where = " OR ".join(f"band{i} = ?" for i in range(BANDS))
+        rows = conn.execute(
+            f"SELECT dhash, ingredients FROM results WHERE model = ? AND prompt = ? AND temperature = ? AND ({where})",
+            (*rest, *_bands(h)),
+        ).fetchall()
+
+        best, best_bits = None, self.near_bits + 1
+        for row in rows:
+            bits = bin(int(row[0], 16) ^ h).count("1")
+            if bits < best_bits:
+                best, best_bits = row, bits
+        return best
+
+    def put(self, h, model, prompt_version, temperature, ingredients):
+        now = time.time()
+        key = (f"{h:016x}", model, prompt_version, float(temperature))
+        with self._lock:
+            conn = self._connect()
+            if self._count is None:
+                self._count = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            exists = conn.execute(
+                "SELECT 1 FROM results WHERE dhash = ? AND model = ? AND prompt = ? AND temperature = ?", key
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, *_bands(h), json.dumps(ingredients), now, now),
+            )
+            if exists is None:
+                self._count += 1
+            self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        if self._count <= self.max_entries:
+            return
+        # the running count misses other processes' writes: recount before deleting
+        self._count = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = self._count - self.max_entries
+        if excess > 0:
+            # drop a little extra so we do not evict on every insert
+            n = excess + max(1, self.max_entries // 100)
+            deleted = conn.execute(
+                "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY last_used LIMIT ?)",
+                (n,),
+            ).rowcount
+            self._count -= deleted
+            self.evictions += deleted
+
+    def stats(self):
+        lookups = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+                self._count = None
+
+
+# %%
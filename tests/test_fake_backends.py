@@ -0,0 +1,54 @@
+"""
+Offline Gemini stand-in (fake_backends.py): canned answers per image.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+
+import pandas as pd
+import pytest
+from langchain_core.messages import HumanMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from fake_backends import CannedData, fake_answer   # noqa: E402
+
+RICE = [{"ingredient": "rice", "grams": 150}]
+EGG = [{"ingredient": "egg", "grams": 50}]
+
+
+@pytest.fixture
+def canned(tmp_path):
+    path = tmp_path / "image_ingredients.csv"
+    pd.DataFrame({
+        "raw_image_path": ["/data/raw/001.jpg", "/data/raw/002.jpg", "/data/raw/003.jpg"],
+        "ingredients_json": [json.dumps(RICE), json.dumps(EGG), "[]"],
+    }).to_csv(path, index=False)
+    return CannedData(str(path), str(tmp_path / "no_reports"), str(tmp_path / "none.parquet"))
+
+
+def vision_request(*images, batch=False):
+    content = [{"type": "text", "text": "List the ingredients."}]
+    for i, img in enumerate(images):
+        if batch:
+            content.append({"type": "text", "text": f"Image id: img{i + 1}"})
+        content.append({"type": "image_url", "image_url": f"data:image/jpeg;base64,{img}"})
+    return [HumanMessage(content=content)]
+
+
+def test_answers_follow_the_image_not_its_bytes(canned):
+    assert json.loads(fake_answer(vision_request("AAAA"), canned, ["001.jpg"])) == RICE
+    assert json.loads(fake_answer(vision_request("AAAA"), canned, ["002.jpg"])) == EGG
+
+
+def test_batch_answers_by_image(canned):
+    answer = json.loads(fake_answer(vision_request("AAAA", "BBBB", batch=True), canned, ["002.jpg", "001.jpg"]))
+    assert answer == {"img1": EGG, "img2": RICE}
+
+
+def test_images_without_a_recorded_answer(canned):
+    answer = json.loads(fake_answer(vision_request("CCCC"), canned, ["003.jpg"]))
+    assert answer in (RICE, EGG)
+    assert json.loads(fake_answer(vision_request("CCCC"), canned, ["003.jpg"])) == answer
@@ -0,0 +1,61 @@
+"""
+Local FoodData Central index (fdc_local.py): import and fuzzy lookup.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from fdc_local import LocalFDCIndex, import_fdc_dump   # noqa: E402
+
+
+def food(fdc_id, description, kcal, data_type="SR Legacy"):
+    return {
+        "fdcId": fdc_id, "description": description, "dataType": data_type,
+        "foodNutrients": [{"nutrient": {"id": 1008}, "amount": kcal},
+                          {"nutrient": {"id": 1003}, "amount": 1.0}],
+    }
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("fdc")
+    dump = tmp / "FoodData_Central_sr_legacy_food.json"
+    dump.write_text(json.dumps({"SRLegacyFoods": [
+        food(1, "Carrots, raw", 41),
+        food(2, "Tomatoes, red, ripe, raw", 18),
+        food(3, "Blueberries, raw", 57),
+        food(4, "Rice, white, cooked", 130),
+        food(5, "CARROT CAKE", 415, data_type="Branded"),
+    ]}))
+    db = str(tmp / "fdc.sqlite")
+    assert import_fdc_dump(str(dump), db) == 5
+    idx = LocalFDCIndex(db)
+    yield idx
+    idx.close()
+
+
+@pytest.mark.parametrize("query, fdc_id", [
+    ("carrots", 1), ("carrot", 1),
+    ("tomatoes", 2), ("tomato", 2),
+    ("blueberries", 3), ("blueberry", 3),
+    ("cooked rice", 4),
+])
+def test_singular_and_plural_names_match(index, query, fdc_id):
+    record = index.search(query)
+    assert record is not None and record["fdc_id"] == fdc_id
+
+
+def test_record_fields(index):
+    record = index.search("carrot")
+    assert record["kcal_per_100g"] == 41 and record["protein_g"] == 1.0
+    assert record["description"] == "Carrots, raw"
+
+
+def test_unknown_name(index):
+    assert index.search("dragon fruit smoothie") is None
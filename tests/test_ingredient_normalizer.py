@@ -0,0 +1,64 @@
+"""
+Ingredient name normalization (ingredient_normalizer.py).
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from ingredient_normalizer import IngredientNormalizer, clean, singular   # noqa: E402
+
+ALIASES = {
+    "rice": "cooked rice",
+    "white rice": "cooked white rice",
+    "tomatoes": "raw tomatoes",
+    "butter": "salted butter",
+    "peanut butter": "smooth peanut butter",
+    "chicken breast": "roasted chicken breast",
+}
+
+
+@pytest.fixture
+def normalizer():
+    return IngredientNormalizer(ALIASES)
+
+
+def test_clean_and_singular():
+    assert clean("  Diced-Tomatoes!") == "diced tomatoes"
+    assert clean(None) == ""
+    assert singular("cherry tomatoes") == "cherry tomato"
+    assert singular("carrots") == "carrot"
+    assert singular("glass") == "glass"
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("Rice", "cooked rice"),                                # exact alias
+    ("tomato", "raw tomatoes"),                             # singular of an alias
+    ("Diced tomatoes", "raw tomatoes"),                     # descriptor dropped
+    ("chiken breast", "roasted chicken breast"),            # typo, fuzzy
+    ("peanut butter", "smooth peanut butter"),              # not 'butter'
+    ("cooked white rice", "cooked white rice"),             # canonical names map to themselves
+    ("sliced dragon fruit", "dragon fruit"),                # unknown: cleaned name for USDA search
+    ("", ""),
+])
+def test_normalize(normalizer, name, expected):
+    assert normalizer.normalize(name) == expected
+
+
+def test_fuzzy_keeps_the_word_count(normalizer):
+    # 'rice' is close, but a one-word alias never answers for two words
+    assert normalizer.normalize("rice cake") == "rice cake"
+
+
+def test_version_follows_the_alias_table(normalizer):
+    before = normalizer.version
+    assert IngredientNormalizer(ALIASES).version == before
+    assert normalizer.normalize("oats") == "oats"
+
+    normalizer.add_alias("oats", "rolled oats")
+    assert normalizer.version != before
+    assert normalizer.normalize("oats") == "rolled oats"    # memo dropped with the change
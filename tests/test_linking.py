@@ -0,0 +1,38 @@
+"""
+Meal code → image path linking in data_preprocessing_01.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from data_preprocessing_01 import codes_to_file_names, link_meal_images, read_in_chunks   # noqa: E402
+
+IMAGES = {name: f"/img/{name}" for name in ("001.jpg", "004.jpg", "012.jpg", "soup.jpg")}
+
+
+def test_codes_to_file_names():
+    codes = pd.Series([1, 1.0, "12", " 4.jpg ", "soup", "012"], dtype=object)
+    assert list(codes_to_file_names(codes)) == ["001.jpg", "001.jpg", "012.jpg", "4.jpg", "soup.jpg", "012.jpg"]
+
+
+def test_chunks_with_mixed_code_types(tmp_path):
+    # first chunk: numeric codes only; a later chunk: codes with an extension
+    path = tmp_path / "wearable.csv"
+    path.write_text(
+        "ID,Day,Steps,First Meal,Second Meal,Third Meal\n"
+        "1,1,3000,001,012,4\n"
+        "1,2,3100,12,1,\n"
+        "2,1,,004.jpg,soup,999\n"
+    )
+    chunks = [link_meal_images(chunk, IMAGES) for chunk in read_in_chunks(str(path), chunk_rows=2)]
+    df = pd.concat(chunks, ignore_index=True)
+
+    assert df["ID"].dtype == "Int64" and df["Day"].dtype == "Int64"
+    assert list(df["First Meal Path"]) == ["/img/001.jpg", "/img/012.jpg", "/img/004.jpg"]
+    assert list(df["Second Meal Path"]) == ["/img/012.jpg", "/img/001.jpg", "/img/soup.jpg"]
+    assert list(df["Third Meal Path"]) == ["/img/004.jpg", None, None]
@@ -0,0 +1,101 @@
+"""
+Per-image kcal and per-user report assembly (nutrition_estimation_03.py).
+USDA lookups are replaced by a fixed table.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+import nutrition_estimation_03 as nutrition   # noqa: E402
+from pipeline_state import CheckpointStore    # noqa: E402
+
+KCAL_PER_100G = {"rice": 130.0, "egg": 150.0}
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = CheckpointStore(str(tmp_path / "state.sqlite"))
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """compute_kcal calls, against KCAL_PER_100G instead of USDA."""
+    made = []
+
+    def compute_kcal(ingredients, lookups=None):
+        made.append([item["ingredient"] for item in ingredients])
+        detail = [{"ingredient": i["ingredient"], "normalized": i["ingredient"], "grams": i["grams"],
+                   "kcal": KCAL_PER_100G.get(i["ingredient"], 0.0) * i["grams"] / 100} for i in ingredients]
+        return sum(d["kcal"] for d in detail), detail
+
+    monkeypatch.setattr(nutrition, "compute_kcal", compute_kcal)
+    monkeypatch.setattr(nutrition, "usda_search_many",
+                        lambda names: {n: {"kcal_per_100g": KCAL_PER_100G[n]} if n in KCAL_PER_100G else None
+                                       for n in names})
+    monkeypatch.setattr(nutrition, "normalize_ingredient", lambda name: name)
+    return made
+
+
+def ingredients_table(rows):
+    return pd.DataFrame([{"raw_image_path": path, "ingredients_json": json.dumps(ings)} for path, ings in rows])
+
+
+RICE = [{"ingredient": "rice", "grams": 200}]
+EGG = [{"ingredient": "egg", "grams": 100}]
+
+
+def test_user_row_ranges():
+    ids = np.array([1, 1, 2, 5, 5, 5])
+    assert nutrition.user_row_ranges(ids) == [(1, 0, 2), (2, 2, 3), (5, 3, 6)]
+    assert nutrition.user_row_ranges(np.array([])) == []
+
+
+def test_kcal_once_per_image_then_from_checkpoints(store, calls):
+    df = ingredients_table([("a.jpg", RICE), ("b.jpg", EGG), ("a.jpg", RICE)])
+    table = nutrition.build_image_kcal_table(df, store)
+    assert dict(zip(table["raw_image_path"], table["Kcal"])) == {"a.jpg": 260.0, "b.jpg": 150.0}
+    assert len(calls) == 2
+
+    nutrition.build_image_kcal_table(df, store)
+    assert len(calls) == 2
+
+
+def test_changed_inputs_are_recomputed(store, calls, monkeypatch):
+    df = ingredients_table([("a.jpg", RICE)])
+    nutrition.build_image_kcal_table(df, store)
+
+    # e.g. a new alias table: same ingredients, different kcal input hash
+    original = nutrition.kcal_input_hash
+    monkeypatch.setattr(nutrition, "kcal_input_hash", lambda ings: original(ings) + "-v2")
+    nutrition.build_image_kcal_table(df, store)
+    assert len(calls) == 2
+
+
+def test_images_with_unresolved_names_are_not_checkpointed(store, calls):
+    df = ingredients_table([("a.jpg", RICE + [{"ingredient": "mystery", "grams": 10}])])
+    nutrition.build_image_kcal_table(df, store)
+    nutrition.build_image_kcal_table(df, store)
+    assert len(calls) == 2
+
+
+def test_link_meal_kcal(store, calls):
+    table = nutrition.build_image_kcal_table(ingredients_table([("a.jpg", RICE), ("b.jpg", EGG)]), store)
+    linked = pd.DataFrame({
+        "ID": [1, 1], "Day": [1, 2],
+        "First Meal Path": ["a.jpg", None],
+        "Second Meal Path": ["b.jpg", "a.jpg"],
+        "Third Meal Path": [None, "missing.jpg"],
+    })
+    daily = nutrition.link_meal_kcal(linked, table)
+    assert list(daily["Daily_Total_Kcal"]) == [410.0, 260.0]
+    assert list(daily["Dinner_Ingredients"]) == ["[]", "[]"]
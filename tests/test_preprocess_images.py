@@ -0,0 +1,49 @@
+"""
+Up-to-date checks in preprocess_images.py.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+import cv2                          # noqa: E402
+import preprocess_images as pre     # noqa: E402
+
+
+@pytest.fixture
+def raw_paths(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    paths = []
+    for i in range(2):
+        path = str(raw / f"{i:03d}.jpg")
+        cv2.imwrite(path, np.full((64, 64, 3), 40 * (i + 1), dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize("check", ["mtime", "hash"])
+def test_outputs_are_reused_until_the_version_changes(raw_paths, tmp_path, monkeypatch, check, capsys):
+    out = str(tmp_path / "processed")
+    pre.preprocess_images(raw_paths, out, workers=1, check=check)
+    pre.preprocess_images(raw_paths, out, workers=1, check=check)
+    assert "0 to do, 2 up to date" in capsys.readouterr().out
+
+    monkeypatch.setattr(pre, "PREPROCESS_VERSION", "other-settings")
+    results = pre.preprocess_images(raw_paths, out, workers=1, check=check)
+    assert "2 to do, 0 up to date" in capsys.readouterr().out
+    assert all(os.path.exists(p) for p in results.values())
+
+
+def test_outputs_from_before_the_manifest_are_redone(raw_paths, tmp_path, capsys):
+    out = str(tmp_path / "processed")
+    pre.preprocess_images(raw_paths, out, workers=1)
+    os.remove(os.path.join(out, pre.MANIFEST_NAME))
+    capsys.readouterr()
+    pre.preprocess_images(raw_paths, out, workers=1)
+    assert "2 to do, 0 up to date" in capsys.readouterr().out
@@ -0,0 +1,65 @@
+"""
+Packed weekly report prompts (prompt_packing.py).
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from prompt_packing import pack_user_week, weekly_stats   # noqa: E402
+
+WAFFLE = json.dumps([{"ingredient": "waffle", "grams": 30.0, "kcal": 163.20000000000002}])
+RICE = json.dumps([{"ingredient": "rice", "grams": 150, "kcal": 195.0}])
+
+
+def user_rows(days=3):
+    return pd.DataFrame([{
+        "ID": 1, "Day": day, "Gender": "M", "Age (years)": 27, "Height (meter)": 1.68,
+        "Weight (kg)": 60, "BMI": 21.3, "Step Count": 3000 + 100 * day,
+        "Sleep Duration (minutes)": 480, "Heart Rate (BPM)": 70, "Screen Time (minute)": 600,
+    } for day in range(days, 0, -1)])
+
+
+def report(days=3):
+    rows = []
+    for day in range(1, days + 1):
+        rows.append({
+            "Day": day,
+            "Breakfast_Detail": WAFFLE, "Breakfast_Kcal": 163.2,
+            "Lunch_Detail": RICE, "Lunch_Kcal": 195.0,
+            "Dinner_Detail": "[]", "Dinner_Kcal": 0.0,
+            "Daily_Total_Kcal": 358.2 + day,
+        })
+    return pd.DataFrame(rows)
+
+
+def test_dishes_are_listed_once():
+    text = pack_user_week(user_rows(), report())
+    assert text.count("waffle") == 1 and text.count("rice") == 1
+    assert "D1: waffle 30g 163; 163" in text
+    assert "1|D1|D2|-|359|3100|480|70|600" in text
+
+
+def test_without_report():
+    text = pack_user_week(user_rows(), None)
+    assert "no calorie report available" in text
+
+
+def test_kcal_from_tool_leaves_out_dishes_and_kcal():
+    text = pack_user_week(user_rows(), None, kcal_from_tool=True)
+    assert "Dishes" not in text and "kcal" not in text
+    assert "Day|Steps|Sleep min|HR|Screen min" in text
+    assert "1|3100|480|70|600" in text
+
+
+def test_weekly_stats_trend():
+    stats = weekly_stats(report(), user_rows())
+    assert round(stats["kcal_trend_per_day"], 6) == 1.0
+    assert stats["Steps_trend_per_day"] == 100.0
+    assert stats["meal_share_pct"]["Dinner"] == 0.0
+    assert round(stats["meal_share_pct"]["Breakfast"], 3) == round(100 * 3 * 163.2 / (3 * 358.2 + 6), 3)
@@ -0,0 +1,127 @@
+"""
+Token buckets, the shared limiter and the request scheduler (rate_limiter.py).
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from rate_limiter import (   # noqa: E402
+    RateLimiter, RequestScheduler, TokenBucket, is_rate_limited, retry_after_seconds,
+)
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+# ------------------------------
+# TokenBucket
+# ------------------------------
+def test_bucket_burst_then_wait():
+    bucket = TokenBucket(600, capacity=3)           # 10 per second
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_bucket_caps_a_single_reservation():
+    bucket = TokenBucket(60, capacity=100)
+    assert bucket.reserve(1000) == 0.0              # taken as 100, not waited on forever
+    assert bucket.reserve(60) == pytest.approx(60, abs=0.1)
+
+
+def test_unlimited_bucket_still_honours_blocks():
+    bucket = TokenBucket(0)
+    assert all(bucket.reserve() == 0.0 for _ in range(1000))
+    bucket.block_for(5)
+    assert bucket.reserve() == pytest.approx(5, abs=0.1)
+
+
+# ------------------------------
+# RateLimiter
+# ------------------------------
+def test_limiter_waits_for_the_tighter_budget(monkeypatch):
+    slept = []
+    monkeypatch.setattr("rate_limiter.time.sleep", slept.append)
+    limiter = RateLimiter(rpm=60000, tpm=6000)      # 100 tokens/s, 6000 burst
+    limiter.acquire(6000)
+    limiter.acquire(300)
+    assert slept == [pytest.approx(3, abs=0.05)]
+    assert limiter.waited_seconds == pytest.approx(3, abs=0.05)
+
+
+def test_limiter_without_limits(monkeypatch):
+    slept = []
+    monkeypatch.setattr("rate_limiter.time.sleep", slept.append)
+    limiter = RateLimiter(rpm=0, tpm=0)
+    for _ in range(100):
+        limiter.acquire(10 ** 6)
+    assert slept == [] and limiter.waited_seconds == 0
+
+
+# ------------------------------
+# 429 handling
+# ------------------------------
+def test_rate_limit_detection():
+    assert is_rate_limited(RateLimited())
+    assert is_rate_limited(RuntimeError("429 RESOURCE_EXHAUSTED"))
+    assert not is_rate_limited(RuntimeError("500 INTERNAL"))
+    assert retry_after_seconds(RuntimeError("Quota exceeded, retry in 12.5s")) == 12.5
+    assert retry_after_seconds(RuntimeError("429")) is None
+
+
+def test_scheduler_retries_429_and_pauses_everyone():
+    limiter = RateLimiter(rpm=0, tpm=0)
+    scheduler = RequestScheduler(limiter, max_in_flight=2, max_retries=3)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RateLimited("429: retry in 0.01s")
+        return "ok"
+
+    try:
+        assert scheduler.call(flaky) == "ok"
+    finally:
+        scheduler.close()
+    assert len(attempts) == 3 and limiter.throttled == 2
+
+
+def test_scheduler_gives_up_on_other_errors():
+    scheduler = RequestScheduler(RateLimiter(rpm=0, tpm=0), max_retries=3)
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError("bad request")
+
+    try:
+        with pytest.raises(ValueError):
+            scheduler.call(broken)
+    finally:
+        scheduler.close()
+    assert len(attempts) == 1
+
+
+def test_imap_unordered_charges_per_item():
+    charged = []
+
+    class Recording(RateLimiter):
+        def acquire(self, tokens=0):
+            charged.append(tokens)
+            return 0.0
+
+    scheduler = RequestScheduler(Recording(rpm=0, tpm=0), max_in_flight=2)
+    try:
+        results = {item: (result, error) for item, result, error
+                   in scheduler.imap_unordered(len, [("a",), ("a", "b", "c")], tokens=lambda batch: 10 * len(batch))}
+    finally:
+        scheduler.close()
+    assert results == {("a",): (1, None), ("a", "b", "c"): (3, None)}
+    assert sorted(charged) == [10, 30]
@@ -0,0 +1,101 @@
+"""
+Manual review queue (review_queue.py): state changes and merging.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from review_queue import DISMISSED, MERGED, PENDING, RESOLVED, ReviewQueue, merge_answers   # noqa: E402
+
+RICE = [{"ingredient": "rice", "grams": 150}]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    q = ReviewQueue(str(tmp_path / "review.sqlite"))
+    yield q
+    q.close()
+
+
+def test_add_counts_attempts(queue):
+    queue.add("a.jpg", "no answer")
+    queue.add("a.jpg", "unparseable answer", "rice?")
+    [item] = queue.items(PENDING)
+    assert (item["reason"], item["raw_answer"], item["attempts"]) == ("unparseable answer", "rice?", 2)
+
+
+def test_add_requires_an_image_id(queue):
+    with pytest.raises(ValueError):
+        queue.add(None, "no answer")
+
+
+def test_resolved_answer_is_never_overwritten(queue):
+    queue.add("a.jpg", "no answer")
+    queue.resolve("a.jpg", RICE)
+    queue.add("a.jpg", "no answer")
+    assert queue.answers() == {"a.jpg": RICE}
+    assert queue.counts() == {RESOLVED: 1}
+
+
+def test_dismissal_is_final(queue):
+    queue.add("a.jpg", "no answer")
+    queue.add("b.jpg", "no answer")
+    queue.dismiss("a.jpg")
+    queue.add("a.jpg", "no answer")
+
+    assert queue.dismissed() == {"a.jpg"}
+    assert queue.dismissed(["a.jpg", "b.jpg", "c.jpg"]) == {"a.jpg"}
+    assert queue.counts() == {DISMISSED: 1, PENDING: 1}
+    assert [item["image_id"] for item in queue.items(PENDING)] == ["b.jpg"]
+
+
+def test_discard_drops_only_pending(queue):
+    queue.add("a.jpg", "no answer")
+    queue.add("b.jpg", "no answer")
+    queue.resolve("b.jpg", RICE)
+    queue.discard("a.jpg")
+    queue.discard("b.jpg")
+    assert queue.counts() == {RESOLVED: 1}
+
+
+def test_merge_answers(queue, tmp_path):
+    path = str(tmp_path / "image_ingredients.csv")
+    pd.DataFrame({
+        "raw_image_path": ["a.jpg", "b.jpg"],
+        "ingredients_json": ["[]", json.dumps([{"ingredient": "egg", "grams": 50}])],
+    }).to_csv(path, index=False)
+
+    queue.add("a.jpg", "no answer")
+    queue.add("z.jpg", "no answer")
+    queue.resolve("a.jpg", RICE)
+    queue.resolve("z.jpg", RICE)
+
+    assert merge_answers(queue, path) == 1
+    df = pd.read_csv(path)
+    assert json.loads(df.loc[0, "ingredients_json"]) == RICE
+    # not in the file yet: stays resolved for the next recognition run
+    assert queue.counts() == {MERGED: 1, RESOLVED: 1}
+    assert set(queue.answers()) == {"a.jpg", "z.jpg"}
+
+
+def test_dismissed_images_are_not_unanswered(queue, tmp_path):
+    from run_pipeline import unanswered_images
+
+    path = str(tmp_path / "image_ingredients.csv")
+    pd.DataFrame({
+        "raw_image_path": ["a.jpg", "b.jpg", "c.jpg"],
+        "ingredients_json": ["[]", "[]", json.dumps(RICE)],
+    }).to_csv(path, index=False)
+    queue.add("a.jpg", "no answer")
+    queue.add("b.jpg", "no answer")
+
+    assert unanswered_images(path, queue) == 2
+    queue.dismiss("a.jpg")
+    assert unanswered_images(path, queue) == 1
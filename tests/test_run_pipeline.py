@@ -0,0 +1,126 @@
+"""
+Stage graph of run_pipeline.py: what runs, what is skipped.
+Stages are tiny scripts that copy their input file to their output.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+import run_pipeline as rp                    # noqa: E402
+from pipeline_state import CheckpointStore   # noqa: E402
+
+STAGE_SCRIPT = """
+import os
+
+def main(force=False):
+    with open({log!r}, "a") as f:
+        f.write({name!r} + (" force" if force else "") + "\\n")
+    with open({src!r}) as f:
+        data = f.read()
+    with open({dst!r}, "w") as f:
+        f.write(data + {name!r})
+"""
+
+
+@pytest.fixture
+def graph(tmp_path, monkeypatch):
+    """a: src.txt → a.txt, b: a.txt → b.txt, c: b.txt + extra.txt → c.txt"""
+    files = {name: str(tmp_path / f"{name}.txt") for name in ("src", "extra", "a", "b", "c")}
+    for name in ("src", "extra"):
+        with open(files[name], "w") as f:
+            f.write(name)
+    log = str(tmp_path / "log.txt")
+
+    stages, modules = {}, []
+    for name, src, deps, inputs in (("a", "src", [], ["src"]), ("b", "a", ["a"], ["a"]),
+                                    ("c", "b", ["b"], ["b", "extra"])):
+        module = f"stage_{name}_{abs(hash(str(tmp_path)))}"
+        with open(tmp_path / f"{module}.py", "w") as f:
+            f.write(textwrap.dedent(STAGE_SCRIPT.format(log=log, name=name, src=files[src], dst=files[name])))
+        stages[name] = rp.Stage(script=f"{module}.py", inputs=[files[i] for i in inputs],
+                                outputs=[files[name]], deps=deps, takes_force=name == "c")
+        modules.append(module)
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(rp, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(rp, "COMMON_CODE", [])
+    store = CheckpointStore(str(tmp_path / "state.sqlite"))
+
+    def run(**kwargs):
+        open(log, "w").close()
+        ran = rp.run_pipeline(store=store, stages=stages, **kwargs)
+        with open(log) as f:
+            return ran, f.read().split("\n")[:-1]
+
+    yield run, files, stages
+    store.close()
+    for module in modules:
+        sys.modules.pop(module, None)
+
+
+def touch(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_stage_order(graph):
+    _, _, stages = graph
+    stages["c"].deps = ["b", "a"]
+    assert rp.stage_order(stages) == ["a", "b", "c"]
+
+
+def test_second_run_skips_everything(graph):
+    run, _, _ = graph
+    assert run() == (["a", "b", "c"], ["a", "b", "c"])
+    assert run() == ([], [])
+
+
+def test_changed_input_reruns_its_stage_and_what_depends_on_it(graph):
+    run, files, _ = graph
+    run()
+    touch(files["extra"], "extra v2")
+    assert run()[0] == ["c"]
+
+    touch(files["src"], "src v2")
+    assert run()[0] == ["a", "b", "c"]
+
+
+def test_identical_upstream_output_stops_the_cascade(graph):
+    run, _, stages = graph
+    run()
+    # a reruns (its script changed) but writes the same a.txt: b and c stay skipped
+    with open(os.path.join(rp.BASE_DIR, stages["a"].script), "a") as f:
+        f.write("\n# edited\n")
+    assert run()[0] == ["a"]
+
+
+def test_missing_output_reruns_the_stage(graph):
+    run, files, _ = graph
+    run()
+    os.remove(files["b"])
+    assert run()[0] == ["b"]
+
+
+def test_unfinished_stage_is_not_recorded(graph):
+    run, _, stages = graph
+    left = [2]
+    stages["b"].unfinished = lambda: left[0]
+    run()
+    assert run()[0] == ["b"]       # still unfinished: looked at again
+    left[0] = 0
+    assert run()[0] == ["b"]
+    assert run()[0] == []
+
+
+def test_only_dry_run_and_force(graph):
+    run, _, _ = graph
+    assert run(dry_run=True) == ([], [])
+    assert run(only=["a"]) == (["a"], ["a"])
+    assert run(only=["b", "c"], force=True) == (["b", "c"], ["b", "c force"])
+    assert run(force=True)[1] == ["a", "b", "c force"]
@@ -0,0 +1,80 @@
+"""
+CSV / Parquet tables (storage.py): round trips, projection, filters, streaming writes.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from storage import TableWriter, iter_table, read_table, table_path, write_table   # noqa: E402
+
+pytest.importorskip("pyarrow")
+
+RICE = [{"ingredient": "rice", "normalized": "cooked rice", "grams": 150, "kcal": 195.0}]
+WAFFLE = [{"ingredient": "waffle", "normalized": "waffle", "grams": 30.5, "kcal": 86.0}]
+
+
+def reports():
+    return pd.DataFrame({
+        "ID": [2, 1, 1],
+        "Day": [1, 2, 1],
+        "Gender": ["F", "M", "M"],
+        "First Meal": ["004", "soup", None],
+        "Breakfast_Detail": [json.dumps(RICE), json.dumps(WAFFLE), "[]"],
+        "Breakfast_Kcal": [195.0, 86.0, 0.0],
+    })
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_round_trip(tmp_path, fmt):
+    path = write_table(reports(), str(tmp_path / "out" / "user_reports.csv"), fmt=fmt, sort_by=["ID", "Day"])
+    assert path == table_path(str(tmp_path / "out" / "user_reports.csv"), fmt) and os.path.exists(path)
+
+    df = read_table(path)
+    assert list(df["ID"]) == [1, 1, 2] and list(df["Day"]) == [1, 2, 1]
+    assert list(df["Breakfast_Detail"]) == [[], WAFFLE, RICE]
+    assert df["First Meal"].isna().tolist() == [True, False, False]
+    assert df.loc[2, "First Meal"] == "004"         # codes keep their leading zeros
+
+    # the CSV layout: JSON strings, whole grams written back without ".0"
+    as_json = read_table(path, nested="json")
+    assert json.loads(as_json.loc[2, "Breakfast_Detail"]) == RICE
+    assert '"grams": 150,' in as_json.loc[2, "Breakfast_Detail"]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_columns_and_filters(tmp_path, fmt):
+    path = write_table(reports(), str(tmp_path / "user_reports"), fmt=fmt)
+    df = read_table(path, columns=["Day", "Breakfast_Kcal"], filters=[("ID", "==", "1"), ("Day", ">=", 2)])
+    assert list(df.columns) == ["Day", "Breakfast_Kcal"]
+    assert df.to_dict("records") == [{"Day": 2, "Breakfast_Kcal": 86.0}]
+    assert len(read_table(path, filters=[("ID", "in", [1, 2])])) == 3
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_table_writer_chunks(tmp_path, fmt):
+    df = reports()
+    with TableWriter(str(tmp_path / "linked" / "linked_dataset.csv"), fmt=fmt) as writer:
+        writer.write(df.iloc[:2])
+        writer.write(df.iloc[2:])
+    assert writer.rows == 3
+
+    chunks = list(iter_table(writer.path, chunk_rows=2))
+    assert [len(c) for c in chunks] == [2, 1]
+    assert list(pd.concat(chunks)["ID"]) == [2, 1, 1]
+
+
+def test_failed_write_keeps_the_previous_table(tmp_path):
+    path = write_table(reports(), str(tmp_path / "user_reports"), fmt="parquet")
+    with pytest.raises(RuntimeError):
+        with TableWriter(path, fmt="parquet") as writer:
+            writer.write(reports().iloc[:1])
+            raise RuntimeError("interrupted")
+    assert len(read_table(path)) == 3
+    assert not os.path.exists(path + ".tmp")
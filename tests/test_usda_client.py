@@ -0,0 +1,216 @@
+"""
+USDAClient against a local stub FoodData Central server: pooling,
+retry/backoff and Retry-After.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+from usda_client import USDAClient, USDANoMatch   # noqa: E402
+
+
+def food(fdc_id, kcal):
+    return {"fdcId": fdc_id, "foodNutrients": [{"nutrientNumber": "208", "value": kcal}]}
+
+
+class StubUSDA:
+    """
+    foods/search by query:
+      "missing"      → no foods
+      "flaky"        → 503 on the first `failures` calls, then a hit
+      "limited"      → 429 with Retry-After: `retry_after` once, then a hit
+      "down"         → always 503
+      anything else  → one hit (100 kcal), after `delay` seconds
+    POST /foods      → every requested fdcId (200 kcal)
+    """
+
+    def __init__(self, failures=2, retry_after="0.3", delay=0.0):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.delay = delay
+        self.calls = {}             # query or "POST foods" → request count
+        self.ports = set()          # client ports = TCP connections opened
+        self.bodies = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, so pooling is visible
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _enter(self, key):
+                with stub._lock:
+                    stub.ports.add(self.client_address[1])
+                    stub.calls[key] = stub.calls.get(key, 0) + 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    return stub.calls[key]
+
+            def _leave(self):
+                with stub._lock:
+                    stub.in_flight -= 1
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query).get("query", [""])[0]
+                n = self._enter(query)
+                try:
+                    if stub.delay:
+                        time.sleep(stub.delay)
+                    if query == "missing":
+                        self._send(200, {"foods": []})
+                    elif query == "down" or (query == "flaky" and n <= stub.failures):
+                        self._send(503, {"error": "unavailable"})
+                    elif query == "limited" and n == 1:
+                        self._send(429, {"error": "slow down"}, {"Retry-After": stub.retry_after})
+                    else:
+                        self._send(200, {"foods": [food(n, 100.0)]})
+                finally:
+                    self._leave()
+
+            def do_POST(self):
+                self._enter("POST foods")
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    body = json.loads(self.rfile.read(length))
+                    with stub._lock:
+                        stub.bodies.append(body)
+                    self._send(200, [food(i, 200.0) for i in body["fdcIds"]])
+                finally:
+                    self._leave()
+
+        return Handler
+
+
+@pytest.fixture
+def stub():
+    state = StubUSDA()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), state.handler())
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield state
+    server.shutdown()
+    server.server_close()
+
+
+def client_for(stub, **kwargs):
+    kwargs.setdefault("backoff", 0.01)
+    return USDAClient("test-key", base_url=stub.url, **kwargs)
+
+
+# ------------------------------
+# Lookups
+# ------------------------------
+def test_search_parses_kcal(stub):
+    assert client_for(stub).search("rice") == {"kcal_per_100g": 100.0}
+
+
+def test_search_without_foods_is_no_match(stub):
+    with pytest.raises(USDANoMatch):
+        client_for(stub).search("missing")
+
+
+def test_search_many_splits_results_and_errors(stub):
+    results, errors = client_for(stub, max_retries=1).search_many(["rice", "missing", "down", "rice"])
+    assert results == {"rice": {"kcal_per_100g": 100.0}, "missing": None}
+    assert list(errors) == ["down"]
+    assert stub.calls["rice"] == 1      # duplicates are looked up once
+
+
+def test_search_food_builds_the_vector_from_the_hit(stub):
+    hits, errors = client_for(stub, max_retries=0).search_food_many(["rice", "missing", "down"])
+    assert hits == {"rice": (1, (100.0, None, None, None)), "missing": None}
+    assert list(errors) == ["down"]
+    assert "POST foods" not in stub.calls   # no /foods round trip for new names
+
+
+def test_fetch_foods_chunks_ids(stub):
+    vectors = client_for(stub).fetch_foods(range(1, 46))
+    assert len(vectors) == 45
+    assert sorted(len(b["fdcIds"]) for b in stub.bodies) == [5, 20, 20]
+
+
+# ------------------------------
+# Retry / backoff
+# ------------------------------
+def test_retries_5xx_then_succeeds(stub):
+    assert client_for(stub).search("flaky") == {"kcal_per_100g": 100.0}
+    assert stub.calls["flaky"] == stub.failures + 1
+
+
+def test_gives_up_after_max_retries(stub):
+    with pytest.raises(RuntimeError, match="503"):
+        client_for(stub, max_retries=2).search("down")
+    assert stub.calls["down"] == 3
+
+
+def test_backoff_doubles(stub, monkeypatch):
+    import usda_client
+    delays = []
+    monkeypatch.setattr(usda_client.time, "sleep", delays.append)
+    monkeypatch.setattr(usda_client.random, "random", lambda: 0.0)
+
+    with pytest.raises(RuntimeError):
+        client_for(stub, max_retries=3, backoff=0.5).search("down")
+    assert delays == [0.5, 1.0, 2.0]
+
+
+def test_retry_after_header_wins(stub):
+    start = time.perf_counter()
+    assert client_for(stub, backoff=0.0).search("limited") == {"kcal_per_100g": 100.0}
+    assert time.perf_counter() - start >= 0.3
+    assert stub.calls["limited"] == 2
+
+
+def test_retry_after_is_capped(stub, monkeypatch):
+    import usda_client
+    delays = []
+    monkeypatch.setattr(usda_client.time, "sleep", delays.append)
+    stub.retry_after = "3600"
+
+    client_for(stub).search("limited")
+    assert delays == [usda_client.USDA_MAX_BACKOFF_SECONDS]
+
+
+# ------------------------------
+# Pooling
+# ------------------------------
+def test_connections_are_pooled_and_bounded(stub):
+    stub.delay = 0.05
+    client = client_for(stub, max_concurrency=4)
+    results, errors = client.search_many([f"food {i}" for i in range(24)])
+
+    assert len(results) == 24 and not errors
+    assert stub.max_in_flight <= 4
+    assert len(stub.ports) <= 4         # keep-alive: connections are reused
+
+    # a second batch reuses the same connections
+    client.search_many([f"other {i}" for i in range(8)])
+    assert len(stub.ports) <= 4
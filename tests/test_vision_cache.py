@@ -0,0 +1,78 @@
+"""
+dHash and VisionCache: exact and near-duplicate hits, LRU eviction.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../food_tools"))
+
+import cv2                                  # noqa: E402
+from vision_cache import VisionCache, dhash   # noqa: E402
+
+KEY = ("gemini-2.5-flash", "v1", 0.0)
+
+
+def meal_image(seed=0, size=256):
+    rng = np.random.default_rng(seed)
+    img = cv2.GaussianBlur(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), (31, 31), 0)
+    return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
+
+
+def jpeg(img, quality=95):
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+@pytest.fixture
+def cache(tmp_path):
+    c = VisionCache(str(tmp_path / "vision.sqlite"), max_entries=100)
+    yield c
+    c.close()
+
+
+# ------------------------------
+# dHash
+# ------------------------------
+def test_dhash_is_stable_across_encodings():
+    img = meal_image()
+    h = dhash(img)
+    assert dhash(jpeg(img)) == dhash(jpeg(img))
+    assert distance(h, dhash(jpeg(img, quality=60))) <= 3
+    assert distance(h, dhash(cv2.resize(img, (128, 128)))) <= 3
+
+
+def test_dhash_tells_different_meals_apart():
+    assert distance(dhash(meal_image(0)), dhash(meal_image(1))) > 10
+
+
+# ------------------------------
+# Cache
+# ------------------------------
+def test_exact_and_near_hits(cache):
+    h = dhash(meal_image())
+    answer = [{"ingredient": "rice", "grams": 150}]
+    cache.put(h, *KEY, answer)
+
+    assert cache.get(h, *KEY) == answer
+    assert cache.get(h ^ 0b101, *KEY) == answer     # 2 bits off
+    assert cache.get(h ^ 0b1111, *KEY) is None      # 4 bits off
+    assert cache.get(h, "other-model", "v1", 0.0) is None
+    assert (cache.hits, cache.near_hits, cache.misses) == (1, 1, 2)
+
+
+def test_evicts_least_recently_used(cache):
+    hashes = [int(h) for h in np.random.default_rng(0).integers(0, 2 ** 63, 150, dtype=np.int64)]
+    for h in hashes:
+        cache.put(h, *KEY, [{"ingredient": str(h), "grams": 1}])
+    rows = cache._connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    assert rows <= 100 and rows == cache._count
+    assert cache.get(hashes[-1], *KEY) is not None
+    assert cache.get(hashes[0], *KEY) is None